@@ -140,3 +140,48 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 #max file upload size 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600
+
+# Background image processing: 'thread' runs jobs in a thread pool inside the web process,
+# 'command' leaves them queued for `python manage.py run_processing_jobs`
+PROCESSOR_JOB_RUNNER = 'thread'
+PROCESSOR_JOB_WORKERS = 1
+# A running job whose process has not sent a heartbeat for this many seconds (it crashed or
+# was restarted) is marked failed
+PROCESSOR_JOB_STALE_AFTER = 5 * 60
+
+# Per-job workspaces under MEDIA_ROOT/jobs/ are reaped in the background (every
+# PROCESSOR_WORKSPACE_REAP_INTERVAL seconds) once older than PROCESSOR_WORKSPACE_MAX_AGE
+# seconds, or oldest first while all workspaces exceed PROCESSOR_WORKSPACE_MAX_BYTES. The
+# reaper runs in the processes that run jobs: the web process with the 'thread' runner,
+# every `run_processing_jobs` worker (without --once) with 'command'
+PROCESSOR_WORKSPACE_MAX_AGE = 24 * 60 * 60
+PROCESSOR_WORKSPACE_MAX_BYTES = 5 * 1024 ** 3
+PROCESSOR_WORKSPACE_REAP_INTERVAL = 10 * 60
+
+# Groups, crops and rendered outputs of already processed images are cached per (image
+# content, parameters) so re-runs link their outputs; least recently used entries are evicted
+# beyond PROCESSOR_CACHE_MAX_BYTES. Set PROCESSOR_CACHE_DIR = None to disable the cache.
+PROCESSOR_CACHE_DIR = os.path.join(BASE_DIR, 'processing_cache')
+PROCESSOR_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Jobs processed with on-demand crops cut them from the source image when requested; each
+# server process keeps up to PROCESSOR_CROP_CACHE_BYTES of encoded crops and its
+# PROCESSOR_CROP_SOURCES most recently used source images open
+PROCESSOR_CROP_CACHE_BYTES = 64 * 1024 ** 2
+PROCESSOR_CROP_SOURCES = 2
+
+# Processing logs go to the console: INFO has a line per image and a stage summary per job,
+# DEBUG adds every stage with its memory high-water mark (the metrics/ view aggregates them)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'processor': {'handlers': ['console'], 'level': os.environ.get('PROCESSOR_LOG_LEVEL', 'INFO')},
+    },
+}
@@ -1,3 +1,4 @@
+from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
@@ -5,6 +6,7 @@ from processor.views import landing_page, download_zip
 
 urlpatterns = [
     path('', landing_page, name='landing-page'),
+    path('admin/', admin.site.urls),
     path('upload/', include('processor.urls')),  # Include processor's URLs with 'upload/' prefix
     path('download/<str:zip_file>/', download_zip, name='download-zip'),
     # Remove the line with 'label/', include('processor.urls')
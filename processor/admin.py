@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ProcessingJob
+
+
+# Failed jobs keep their full traceback here; pages only show its last line
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('workspace', 'heartbeat_at', 'error', 'result', 'metrics')
@@ -0,0 +1,146 @@
+import logging
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from zipfile import ZIP_STORED, BadZipFile, ZipFile, ZipInfo
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# PNG crops are already compressed, so archives are stored rather than deflated
+CHUNK_SIZE = 64 * 1024
+
+
+class _Sink:
+    """Write-only file object that hands back whatever ZipFile has written so far.
+
+    It has no ``tell``/``seek``, so ZipFile writes in streaming mode (sizes and CRCs
+    go into data descriptors after each member).
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self._chunks:
+            yield b''.join(self._chunks)
+            self._chunks = []
+
+
+def stream_zip(members, chunk_size=CHUNK_SIZE):
+    """Yield a ZIP_STORED archive of ``(path, arcname)`` pairs as byte chunks.
+
+    Memory use is bounded by ``chunk_size`` whatever the archive size; missing files are
+    skipped. Meant for ``StreamingHttpResponse``.
+    """
+    sink = _Sink()
+    with ZipFile(sink, 'w', compression=ZIP_STORED) as zip_file:
+        for path, arcname in members:
+            if not os.path.exists(path):
+                continue
+            zinfo = ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = ZIP_STORED
+            with open(path, 'rb') as source, zip_file.open(zinfo, 'w') as destination:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    destination.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    # Closing the archive writes the central directory
+    yield from sink.drain()
+
+
+# Per-category archives are kept in the job workspace and grown as labels arrive, so
+# downloads are served straight from disk. Archives are only ever replaced whole, so a
+# download that is being served keeps reading the archive it opened. Updates of an archive
+# are serialised by an flock on a ``.lock`` file next to it, which excludes every worker
+# process; where flock is not available (Windows) one lock serialises the updates of this
+# process only.
+_archive_lock = threading.Lock()
+
+
+@contextmanager
+def _locked(archive_path):
+    if fcntl is None:
+        with _archive_lock:
+            yield
+        return
+    with open(f"{archive_path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield  # Closing the file releases the lock
+
+
+def category_archive_path(workspace, category_label):
+    return os.path.join(workspace, f"category_{category_label}_images.zip")
+
+
+def build_archive(archive_path, members):
+    """Write a ZIP_STORED archive of ``(path, arcname)`` pairs, replacing ``archive_path`` atomically."""
+    tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+    with _locked(archive_path):
+        with ZipFile(tmp_path, 'w', compression=ZIP_STORED) as zip_file:
+            for path, arcname in members:
+                if os.path.exists(path):
+                    zip_file.write(path, arcname=arcname)
+        os.replace(tmp_path, archive_path)
+
+
+def append_to_archive(archive_path, members):
+    """Add ``(path, arcname)`` pairs to an existing archive; returns False if there is no archive to grow.
+
+    The members are added to one copy of the archive that then replaces it, so callers pass
+    every member of a request at once. Members already in the archive are skipped. A
+    ``path`` may be a callable returning the path, for members whose file is only written
+    when it is needed (on-demand crops); it is called only if the member is added. An
+    archive that cannot be read is removed instead, so the next download rebuilds it.
+    """
+    with _locked(archive_path):
+        if not os.path.exists(archive_path):
+            return False
+        tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with ZipFile(archive_path) as zip_file:
+                present = set(zip_file.NameToInfo)
+            added = []
+            for path, arcname in members:
+                if arcname not in present:
+                    present.add(arcname)
+                    added.append((path, arcname))
+            if not added:
+                return True
+            shutil.copyfile(archive_path, tmp_path)
+            with ZipFile(tmp_path, 'a', compression=ZIP_STORED) as zip_file:
+                for path, arcname in added:
+                    zip_file.write(path() if callable(path) else path, arcname=arcname)
+            os.replace(tmp_path, archive_path)
+        except BadZipFile:
+            logger.warning("Removing unreadable archive %s", archive_path)
+            os.remove(archive_path)
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+
+def remove_archive(archive_path):
+    with _locked(archive_path):
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+
+def archive_etag(archive_path):
+    stat = os.stat(archive_path)
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
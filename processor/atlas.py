@@ -0,0 +1,99 @@
+import json
+import os
+import uuid
+
+from PIL import Image
+
+from .derivatives import DERIVATIVE_EXTENSION, DERIVATIVE_FORMAT, DERIVATIVES_DIRNAME, THUMBNAIL_WIDTHS, scale_to_width
+
+# Thumbnails of the crops are packed into a few sprite sheets per image instead of one file
+# per crop, so the result grid and the labeling queue load in a handful of requests. Sheets
+# are filled row by row in crop order; atlas.json gives the sheet and the box of every crop.
+ATLAS_FILENAME = 'atlas.json'
+ATLAS_THUMBNAIL_WIDTH = THUMBNAIL_WIDTHS[0]
+ATLAS_WIDTH = 2048
+ATLAS_MAX_HEIGHT = 4096  # 8 megapixels, within what mobile browsers decode
+ATLAS_GAP = 1  # Keeps neighbours from bleeding in when the page is zoomed
+
+
+def atlas_sheet_path(prefix, index):
+    """Relative path of sheet ``index`` of the atlas named after ``prefix``."""
+    return f"{DERIVATIVES_DIRNAME}/atlas_{prefix}{index}{DERIVATIVE_EXTENSION}"
+
+
+class Atlas:
+    """Shelf packer of the thumbnails of one image's crops.
+
+    ``add`` places a thumbnail and records its (sheet, x, y, width, height); ``save`` writes
+    the sheets, named after ``prefix``, and can run in another thread once all crops are added.
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.sheets = []  # Thumbnails and their positions, per sheet
+        self.entries = {}
+        self._x = self._y = self._row_height = 0
+
+    def add(self, name, image):
+        thumbnail = scale_to_width(image, ATLAS_THUMBNAIL_WIDTH)
+        if thumbnail.height > ATLAS_MAX_HEIGHT:
+            thumbnail = thumbnail.resize((max(round(thumbnail.width * ATLAS_MAX_HEIGHT / thumbnail.height), 1),
+                                          ATLAS_MAX_HEIGHT), Image.BOX)
+        width, height = thumbnail.size
+        if self._x + width > ATLAS_WIDTH:
+            self._x, self._y, self._row_height = 0, self._y + self._row_height + ATLAS_GAP, 0
+        if not self.sheets or self._y + height > ATLAS_MAX_HEIGHT:
+            self.sheets.append([])
+            self._x = self._y = self._row_height = 0
+        self.sheets[-1].append((thumbnail, self._x, self._y))
+        self.entries[name] = [len(self.sheets) - 1, self._x, self._y, width, height]
+        self._x += width + ATLAS_GAP
+        self._row_height = max(self._row_height, height)
+
+    def sheet_paths(self):
+        return [atlas_sheet_path(self.prefix, index) for index in range(len(self.sheets))]
+
+    def save(self, output_dir):
+        os.makedirs(os.path.join(output_dir, DERIVATIVES_DIRNAME), exist_ok=True)
+        paths = self.sheet_paths()
+        for path, placements in zip(paths, self.sheets):
+            # Sheets are cropped to the rows they use
+            width = max(x + thumbnail.width for thumbnail, x, _ in placements)
+            height = max(y + thumbnail.height for thumbnail, _, y in placements)
+            sheet = Image.new('RGB', (width, height))
+            for thumbnail, x, y in placements:
+                sheet.paste(thumbnail, (x, y))
+            sheet.save(os.path.join(output_dir, path), DERIVATIVE_FORMAT, quality=80, method=0)
+        self.sheets = []  # The thumbnails are not needed any more
+        return paths
+
+
+def write_atlas_index(output_dir, sheets, crops):
+    """Write atlas.json: ``crops`` maps crop names to (position in ``sheets``, x, y, width, height)."""
+    path = os.path.join(output_dir, ATLAS_FILENAME)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as fh:
+        json.dump({'sheets': sheets, 'crops': crops}, fh, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_atlas(workspace, names):
+    """Sheet path (relative to ``workspace``), x, y, width and height of every crop in ``names``.
+
+    Returns a list of dicts in the order of ``names``, None for crops without a thumbnail,
+    or None if the workspace has no atlas.
+    """
+    try:
+        with open(os.path.join(workspace, ATLAS_FILENAME)) as fh:
+            atlas = json.load(fh)
+    except FileNotFoundError:
+        return None
+    entries = []
+    for name in names:
+        entry = atlas['crops'].get(name)
+        if entry is None:
+            entries.append(None)
+            continue
+        sheet, x, y, width, height = entry
+        entries.append({'sheet': atlas['sheets'][sheet], 'x': x, 'y': y, 'width': width, 'height': height})
+    return entries
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import shutil
+import uuid
+import zipfile
+
+import numpy as np
+
+# Clustering results are cached on disk per (image content, clustering parameters): one
+# directory per entry holding the extracted groups as ``groups.npy`` and the crop PNGs of
+# jobs that write their crops, by group label (``<label>.png``). What is drawn from the
+# groups also depends on the rendering parameters (see render_key): per render key, the
+# entry holds the overlay and its previews, the atlas sheets, and ``<render key>.npz`` with
+# the labels, boxes, descriptors and atlas positions of the crops, so a repeated job only
+# links files. The directory mtime is the last use, so eviction is LRU.
+GROUPS_FILENAME = 'groups.npy'
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_key(image_digest, **params):
+    """Cache key of an image digest and the parameters its clustering depends on."""
+    encoded = ','.join(f"{name}={params[name]!r}" for name in sorted(params))
+    return f"{image_digest}-{hashlib.sha256(encoded.encode()).hexdigest()[:16]}"
+
+
+def render_key(**params):
+    """Key of the rendering parameters of an entry's outputs (overlay, atlas, descriptors)."""
+    encoded = ','.join(f"{name}={params[name]!r}" for name in sorted(params))
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key)
+
+
+def load_groups(cache_dir, key):
+    """Return the cached groups array for ``key`` (marking the entry as used) or None."""
+    path = _entry_path(cache_dir, key)
+    try:
+        groups = np.load(os.path.join(path, GROUPS_FILENAME))
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return groups
+
+
+def store_groups(cache_dir, key, groups):
+    path = _entry_path(cache_dir, key)
+    os.makedirs(path, exist_ok=True)
+    # Write then rename so concurrent workers never read a partial file
+    tmp_path = os.path.join(path, f".{uuid.uuid4().hex}.npy")
+    np.save(tmp_path, groups)
+    os.replace(tmp_path, os.path.join(path, GROUPS_FILENAME))
+
+
+def load_arrays(cache_dir, key, name):
+    """Return the arrays cached as ``name`` (an .npz) in entry ``key`` as a dict, or None."""
+    path = _entry_path(cache_dir, key)
+    try:
+        with np.load(os.path.join(path, name)) as archive:
+            arrays = dict(archive)
+        os.utime(path)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+    return arrays
+
+
+def store_arrays(cache_dir, key, name, **arrays):
+    """Cache ``arrays`` as ``name`` in entry ``key``, if the entry still exists."""
+    path = _entry_path(cache_dir, key)
+    if not os.path.isdir(path):
+        return
+    tmp_path = os.path.join(path, f".{uuid.uuid4().hex}.npz")
+    try:
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp_path, os.path.join(path, name))
+    except OSError:
+        pass  # Evicted in the meantime
+
+
+def _link_or_copy(source, destination):
+    try:
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def fetch_file(cache_dir, key, name, destination):
+    """Place the cached file ``name`` of entry ``key`` at ``destination``; False if not cached."""
+    source = os.path.join(_entry_path(cache_dir, key), name)
+    if not os.path.exists(source):
+        return False
+    try:
+        _link_or_copy(source, destination)
+    except OSError:
+        return False  # Evicted in the meantime
+    return True
+
+
+def store_file(cache_dir, key, name, source):
+    path = _entry_path(cache_dir, key)
+    if os.path.isdir(path):
+        try:
+            _link_or_copy(source, os.path.join(path, name))
+        except OSError:
+            pass
+
+
+def evict(cache_dir, max_bytes):
+    """Delete least recently used entries until the cache fits in ``max_bytes``.
+
+    Returns the number of entries deleted.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+        total += size
+
+    deleted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        deleted += 1
+    return deleted
+
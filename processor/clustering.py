@@ -0,0 +1,287 @@
+import logging
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+# Attempt to import cuml's DBSCAN for GPU acceleration; fall back to sklearn if unavailable
+try:
+    from cuml.cluster import DBSCAN
+    use_gpu = True
+    logging.getLogger(__name__).info("Using GPU for DBSCAN")
+except ImportError:
+    from sklearn.cluster import DBSCAN
+    use_gpu = False
+
+CLUSTERING_ENGINES = [
+    ('dbscan', 'DBSCAN'),
+    ('grid', 'Grid DBSCAN'),
+]
+
+# Cell offsets (one per unordered pair of cells) that can hold points within eps of each
+# other when cells have a side of eps / sqrt(2)
+_NEIGHBOUR_OFFSETS = [(dx, dy) for dx in range(0, 3) for dy in range(-2, 3) if dx > 0 or dy > 0]
+
+
+def cluster_dots(dot_coordinates, eps, min_samples=6, engine='dbscan', return_core=False):
+    """Label dot coordinates with the selected engine; -1 marks noise like DBSCAN does.
+
+    With ``return_core`` a boolean mask of the core points is returned alongside the labels.
+    """
+    if len(dot_coordinates) == 0:
+        labels, core = np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    elif engine == 'grid':
+        labels, core = grid_dbscan(dot_coordinates, eps, min_samples, return_core=True)
+    elif engine == 'dbscan':
+        # Pass appropriate parameters based on the backend (cuml or sklearn)
+        if use_gpu:
+            db = DBSCAN(eps=eps, min_samples=min_samples, metric='euclidean', output_type='numpy').fit(dot_coordinates)
+        else:
+            db = DBSCAN(eps=eps, min_samples=min_samples).fit(dot_coordinates)
+        labels = np.asarray(db.labels_)
+        core = np.zeros(len(labels), dtype=bool)
+        core[np.asarray(db.core_sample_indices_)] = True
+    else:
+        raise ValueError(f"Unknown clustering engine: {engine}")
+    return (labels, core) if return_core else labels
+
+
+def grid_dbscan(points, eps, min_samples=6, return_core=False):
+    """DBSCAN for dense point clouds such as the above-threshold pixels of an image.
+
+    Points are binned into square cells of side eps / sqrt(2), so every pair of points in
+    one cell is within eps. A cell holding at least ``min_samples`` points therefore makes
+    all of them core points without any neighbourhood query, and core points of one cell
+    always share a cluster. Only sparse cells are counted exactly, and neighbouring cells
+    are joined by nearest-core lookups from their facing frontiers instead of
+    materialising full eps-neighbourhoods.
+
+    Labels match ``sklearn.cluster.DBSCAN(eps, min_samples)`` exactly: clusters are numbered
+    in order of their first core point and a border point joins the lowest-numbered
+    cluster it touches.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return (labels, np.zeros(0, dtype=bool)) if return_core else labels
+
+    side = eps / np.sqrt(2) * (1 - 1e-9)
+    cells = np.floor(points / side).astype(np.int64)
+    cells -= cells.min(axis=0)
+    cell_keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    _, cell_of_point, cell_counts = np.unique(cell_keys, return_inverse=True, return_counts=True)
+
+    core = cell_counts[cell_of_point] >= min_samples
+    sparse = np.flatnonzero(~core)
+    if sparse.size:
+        core[sparse] = cKDTree(points).query_ball_point(points[sparse], eps, return_length=True) >= min_samples
+
+    core_idx = np.flatnonzero(core)
+    if core_idx.size == 0:
+        return (labels, core) if return_core else labels
+    core_cells = cell_of_point[core_idx]
+
+    # Two neighbouring cells are linked if any pair of their core points is within eps. Only
+    # the points of each cell facing the other cell can form the closest pair, so queries
+    # are limited to those frontiers. Embedding every point with its (scaled) cell means a
+    # query shifted by a cell offset can only be answered, within eps, by that exact cell.
+    core_points = points[core_idx]
+    core_cell_xy = cells[core_idx]
+    spread = 2 * eps + 1
+    embedded = np.column_stack((core_points, core_cell_xy * spread))
+    frontiers, frontier_trees = {}, {}
+    sources, targets = [core_cells], [core_cells]
+    for dx, dy in _NEIGHBOUR_OFFSETS:
+        direction = (int(np.sign(dx)), int(np.sign(dy)))
+        if direction not in frontiers:
+            frontiers[direction] = _cell_frontier(core_cells, core_points, *direction)
+            facing = _cell_frontier(core_cells, core_points, -direction[0], -direction[1])
+            frontier_trees[direction] = (facing, cKDTree(embedded[facing]))
+        queries = frontiers[direction]
+        facing, frontier_tree = frontier_trees[direction]
+        shifted = embedded[queries]
+        shifted[:, 2] += dx * spread
+        shifted[:, 3] += dy * spread
+        dist, hit = frontier_tree.query(shifted, distance_upper_bound=np.nextafter(eps, np.inf))
+        found = dist <= eps
+        sources.append(core_cells[queries[found]])
+        targets.append(core_cells[facing[hit[found]]])
+
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    num_cells = len(cell_counts)
+    graph = coo_matrix((np.ones(sources.size, dtype=np.int8), (sources, targets)), shape=(num_cells, num_cells))
+    _, cell_component = connected_components(graph, directed=False)
+
+    # Number clusters by their first core point, as sklearn's expansion loop does
+    core_component = cell_component[core_cells]
+    components, first_seen = np.unique(core_component, return_index=True)
+    rank = np.empty(cell_component.max() + 1, dtype=np.int64)
+    rank[components[np.argsort(first_seen)]] = np.arange(components.size)
+    labels[core_idx] = rank[core_component]
+
+    border = np.flatnonzero(~core)
+    if border.size:
+        neighbours = cKDTree(points[core_idx]).query_ball_point(points[border], eps)
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=border.size)
+        touching = counts > 0
+        if touching.any():
+            flat = np.concatenate([n for n in neighbours[touching]]).astype(np.int64)
+            starts = np.r_[0, np.cumsum(counts[touching])[:-1]]
+            labels[border[touching]] = np.minimum.reduceat(labels[core_idx[flat]], starts)
+    return (labels, core) if return_core else labels
+
+
+def candidate_dots(mask, eps, min_size, factor):
+    """Coordinates of the dots in ``mask`` that can belong to a group of at least ``min_size``.
+
+    The mask is binned into ``factor`` x ``factor`` blocks and occupied blocks close enough
+    to hold dots within eps of each other are joined into candidate regions. Regions with
+    fewer than ``min_size`` dots in total cannot contain such a group and are skipped; dots
+    of the remaining regions are read at full resolution, so clustering them gives the
+    exact same groups as clustering the whole mask. Coordinates are (x, y) in row-major
+    order like ``np.nonzero(mask)``.
+    """
+    counts = _block_counts(mask, factor)
+    occupied = counts > 0
+
+    # Dots within eps lie at most `reach` blocks apart; growing every block by half of that
+    # makes such blocks touch, so 8-connected components never split a group
+    reach = int(eps // factor) + 1
+    grown = ndimage.maximum_filter(occupied, size=2 * (reach // 2) + 1)
+    regions, num_regions = ndimage.label(grown, structure=np.ones((3, 3), dtype=bool))
+    regions[~occupied] = 0
+    region_sizes = np.bincount(regions.ravel(), weights=counts.ravel(), minlength=num_regions + 1)
+
+    coordinates = []
+    for region, (rows, cols) in enumerate(ndimage.find_objects(regions), start=1):
+        if rows is None or region_sizes[region] < min_size:
+            continue
+        y0, x0 = rows.start * factor, cols.start * factor
+        ys, xs = np.nonzero(mask[y0:rows.stop * factor, x0:cols.stop * factor])
+        # The box may overlap other regions; keep only dots whose block belongs to this one
+        ys, xs = ys + y0, xs + x0
+        own = regions[ys // factor, xs // factor] == region
+        coordinates.append(np.column_stack((xs[own], ys[own])))
+
+    if not coordinates:
+        return np.empty((0, 2), dtype=np.intp)
+    coordinates = np.concatenate(coordinates)
+    return coordinates[np.lexsort((coordinates[:, 0], coordinates[:, 1]))]
+
+
+def cluster_bands(bands, eps, min_samples=6, engine='dbscan'):
+    """Cluster dots delivered in horizontal bands as if the whole image had been clustered.
+
+    ``bands`` yields ``(top, bottom, dot_coordinates)`` for consecutive bands tiling the
+    image, where the coordinates are every dot of rows ``top - 2 * eps`` to
+    ``bottom + 2 * eps`` (clipped to the image) in row-major order. Core status is exact
+    for dots within eps of a band, so each band's clusters are merged with its neighbours'
+    through the core dots they share there, and dots owned by the band (rows ``top`` to
+    ``bottom``) are numbered like DBSCAN numbers them.
+
+    Returns ``(dot_coordinates, labels)`` for all dots in row-major order.
+    """
+    owned_coordinates, owned_clusters = [], []
+    shared_keys, shared_clusters = [], []
+    border_dots, border_clusters = [], []
+    num_clusters = num_owned = 0
+
+    for top, bottom, coordinates in bands:
+        labels, core = cluster_dots(coordinates, eps, min_samples, engine, return_core=True)
+        clusters = np.where(labels >= 0, labels + num_clusters, -1)
+        ys = coordinates[:, 1]
+        trusted = core & (ys >= top - eps) & (ys < bottom + eps)
+        owned = np.flatnonzero((ys >= top) & (ys < bottom))
+
+        shared_keys.append(ys[trusted].astype(np.int64) << 32 | coordinates[trusted, 0].astype(np.int64))
+        shared_clusters.append(clusters[trusted])
+        owned_coordinates.append(coordinates[owned])
+        owned_clusters.append(np.where(core[owned], clusters[owned], -1))
+
+        # A border dot joins the lowest-numbered cluster among its core neighbours, which
+        # is only known once clusters are merged, so remember every candidate
+        border = owned[~core[owned]]
+        if border.size and trusted.any():
+            neighbours = cKDTree(coordinates[trusted]).query_ball_point(coordinates[border], eps)
+            counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=border.size)
+            if counts.any():
+                flat = np.concatenate([n for n in neighbours[counts > 0]]).astype(np.int64)
+                border_dots.append(np.repeat(num_owned + np.searchsorted(owned, border), counts))
+                border_clusters.append(clusters[trusted][flat])
+
+        num_clusters += labels.max() + 1 if labels.size else 0
+        num_owned += owned.size
+
+    coordinates = np.concatenate(owned_coordinates) if owned_coordinates else np.empty((0, 2), dtype=np.intp)
+    labels = np.full(len(coordinates), -1, dtype=np.int64)
+    if num_clusters == 0:
+        return coordinates, labels
+
+    keys, clusters = np.concatenate(shared_keys), np.concatenate(shared_clusters)
+    order = np.argsort(keys, kind='stable')
+    keys, clusters = keys[order], clusters[order]
+    same = np.flatnonzero(keys[1:] == keys[:-1])
+    graph = coo_matrix((np.ones(same.size, dtype=np.int8), (clusters[same], clusters[same + 1])),
+                       shape=(num_clusters, num_clusters))
+    _, component = connected_components(graph, directed=False)
+
+    # Number merged clusters by their first core dot, as sklearn's expansion loop does
+    owned_clusters = np.concatenate(owned_clusters)
+    core_idx = np.flatnonzero(owned_clusters >= 0)
+    core_component = component[owned_clusters[core_idx]]
+    components, first_seen = np.unique(core_component, return_index=True)
+    rank = np.full(component.max() + 1, -1, dtype=np.int64)
+    rank[components[np.argsort(first_seen)]] = np.arange(components.size)
+    labels[core_idx] = rank[core_component]
+
+    if border_dots:
+        dots, candidates = np.concatenate(border_dots), rank[component[np.concatenate(border_clusters)]]
+        order = np.argsort(dots, kind='stable')
+        dots, candidates = dots[order], candidates[order]
+        starts = np.flatnonzero(np.r_[True, dots[1:] != dots[:-1]])
+        labels[dots[starts]] = np.minimum.reduceat(candidates, starts)
+    return coordinates, labels
+
+
+def _block_counts(mask, factor):
+    """Number of set pixels in every ``factor`` x ``factor`` block of ``mask`` (edges included)."""
+    height, width = mask.shape
+    full_rows, full_cols = height // factor, width // factor
+    pixels = mask.view(np.uint8)
+
+    rows = np.empty((-(-height // factor), width), dtype=np.int32)
+    rows[:full_rows] = pixels[:full_rows * factor].reshape(full_rows, factor, width).sum(axis=1, dtype=np.int32)
+    if full_rows < len(rows):
+        rows[-1] = pixels[full_rows * factor:].sum(axis=0, dtype=np.int32)
+
+    counts = np.empty((len(rows), -(-width // factor)), dtype=np.int32)
+    counts[:, :full_cols] = rows[:, :full_cols * factor].reshape(len(rows), full_cols, factor).sum(axis=2)
+    if full_cols < counts.shape[1]:
+        counts[:, -1] = rows[:, full_cols * factor:].sum(axis=1)
+    return counts
+
+
+def _cell_frontier(cell, points, sx, sy):
+    """Indices of the points of each cell that are closest to any cell in direction (sx, sy).
+
+    Along an axis (one of sx, sy is 0) that is the outermost point of every row or column;
+    diagonally it is the staircase of points not dominated in that direction.
+    """
+    if sy == 0 or sx == 0:
+        along = points[:, 0] * sx if sy == 0 else points[:, 1] * sy
+        across = points[:, 1] if sy == 0 else points[:, 0]
+        order = np.lexsort((along, across, cell))
+        last = np.r_[(cell[order][1:] != cell[order][:-1]) | (across[order][1:] != across[order][:-1]), True]
+        return order[last]
+
+    u = points[:, 0] * sx
+    v = points[:, 1] * sy
+    order = np.lexsort((-v, -u, cell))
+    segment = np.cumsum(np.r_[True, cell[order][1:] != cell[order][:-1]])
+    # Offset v by segment so a single running maximum never crosses into the next cell
+    key = segment * (v.max() - v.min() + 1) + (v[order] - v.min())
+    running = np.maximum.accumulate(key)
+    return order[key > np.r_[-1, running[:-1]]]
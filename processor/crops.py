@@ -0,0 +1,158 @@
+import io
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .derivatives import derivative_path, encode_derivative
+from .inputs import open_input
+
+# On-demand crops: a job processed with lazy crops keeps its source images and an index of
+# the bounding box of every crop instead of writing one PNG (and its thumbnails) per group.
+# Crops are cut and encoded when first requested. Encoded crops and opened source images are
+# kept in LRU caches of this process, bounded by PROCESSOR_CROP_CACHE_BYTES and
+# PROCESSOR_CROP_SOURCES; a crop needed as a file (for an archive) is written to the workspace
+# once, where it is found by later requests too.
+CROP_INDEX_FILENAME = 'crop_index.json'
+CROP_CACHE_BYTES = 64 * 1024 ** 2
+CROP_SOURCES = 2
+
+
+class LRUCache:
+    """Thread-safe least recently used cache, bounded by the total ``sizeof`` of its values."""
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self.sizeof(self._items.pop(key))
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+
+_encoded_crops = None
+_sources = None
+_indexes = LRUCache(16, sizeof=lambda index: 1)
+
+
+def _caches():
+    global _encoded_crops, _sources
+    if _encoded_crops is None:
+        _sources = LRUCache(getattr(settings, 'PROCESSOR_CROP_SOURCES', CROP_SOURCES), sizeof=lambda source: 1)
+        _encoded_crops = LRUCache(getattr(settings, 'PROCESSOR_CROP_CACHE_BYTES', CROP_CACHE_BYTES))
+    return _encoded_crops, _sources
+
+
+def write_crop_index(output_dir, sources, crops):
+    """Write the crop index of ``output_dir``.
+
+    ``crops`` maps every crop name to the position of its image in ``sources`` and its
+    (left, top, right, bottom) box. Sources are stored relative to ``output_dir``.
+    """
+    index = {
+        'sources': [os.path.relpath(os.path.abspath(source), os.path.abspath(output_dir)) for source in sources],
+        'crops': crops,
+    }
+    path = os.path.join(output_dir, CROP_INDEX_FILENAME)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_crop_index(workspace):
+    """The crop index of ``workspace``, or None if its crops were written when it was processed."""
+    path = os.path.join(workspace, CROP_INDEX_FILENAME)
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    index = _indexes.get(key)
+    if index is None:
+        with open(path) as fh:
+            index = json.load(fh)
+        _indexes.put(key, index)
+    return index
+
+
+def _indexed_crop(workspace, name):
+    index = load_crop_index(workspace)
+    if index is None or name not in index['crops']:
+        raise KeyError(name)
+    return index, index['crops'][name]
+
+
+def cut_crop(workspace, name):
+    """PIL image of the crop ``name``; KeyError if the workspace has no such crop in its index."""
+    index, (source, *box) = _indexed_crop(workspace, name)
+    _, sources = _caches()
+    path = os.path.normpath(os.path.join(workspace, index['sources'][source]))
+    input_image = sources.get(path)
+    if input_image is None:
+        input_image = open_input(path)
+        sources.put(path, input_image)
+    return input_image.crop(box)
+
+
+def crop_bytes(workspace, name, width=None):
+    """The crop ``name`` as PNG bytes, or its ``width`` pixels wide derivative.
+
+    Served from the cache if cut recently, from the workspace if the file is there, else cut
+    now. Raises KeyError for crops not in the index of the workspace.
+    """
+    encoded_crops, _ = _caches()
+    key = (workspace, name, width)
+    data = encoded_crops.get(key)
+    if data is None:
+        _indexed_crop(workspace, name)
+        path = os.path.join(workspace, name if width is None else derivative_path(name, width))
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        else:
+            image = cut_crop(workspace, name)
+            if width is None:
+                buffer = io.BytesIO()
+                image.save(buffer, 'PNG')
+                data = buffer.getvalue()
+            else:
+                data = encode_derivative(image, width)
+        encoded_crops.put(key, data)
+    return data
+
+
+def crop_file(workspace, name):
+    """Path of the crop file ``name`` in ``workspace``, writing it first if it is only indexed."""
+    path = os.path.join(workspace, name)
+    if not os.path.exists(path):
+        try:
+            data = crop_bytes(workspace, name)
+        except KeyError:
+            return path  # Not an indexed crop; callers handle the missing file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,55 @@
+import io
+import os
+
+from PIL import Image, features
+
+# Downscaled copies of the crops and overlays for the result page; the full-resolution
+# PNGs are only fetched when opened or downloaded. WebP is much smaller than PNG for
+# these images, but PNG is used if Pillow was built without WebP support.
+DERIVATIVES_DIRNAME = 'thumbs'
+THUMBNAIL_WIDTHS = (160, 320)  # Crop grid, 1x and 2x
+PREVIEW_WIDTHS = (1280, 2560)  # Overlay
+DERIVATIVE_FORMAT = 'WEBP' if features.check('webp') else 'PNG'
+DERIVATIVE_EXTENSION = '.webp' if DERIVATIVE_FORMAT == 'WEBP' else '.png'
+
+
+def derivative_path(path, width):
+    """Relative path of the ``width`` pixels wide derivative of the output file ``path``."""
+    stem = os.path.splitext(path)[0]
+    return f"{DERIVATIVES_DIRNAME}/{stem}_{width}w{DERIVATIVE_EXTENSION}"
+
+
+def scale_to_width(image, width):
+    """``image`` in RGB(A), scaled down to at most ``width`` pixels wide."""
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    if image.width > width:
+        # Area averaging is alias-free and several times cheaper than Lanczos for large reductions
+        resample = Image.BOX if image.width >= 2 * width else Image.LANCZOS
+        image = image.resize((width, max(round(image.height * width / image.width), 1)), resample)
+    return image
+
+
+def encode_derivative(image, width):
+    """Bytes of the ``width`` pixels wide derivative of ``image`` in DERIVATIVE_FORMAT."""
+    buffer = io.BytesIO()
+    scale_to_width(image, width).save(buffer, DERIVATIVE_FORMAT, quality=80, method=0)
+    return buffer.getvalue()
+
+
+def save_derivatives(image, path, output_dir, widths):
+    """Save a derivative of ``image`` (the output file ``path``) for each width.
+
+    Images are only ever scaled down, so small crops keep their size and just get the
+    compact format. Returns the relative paths written.
+    """
+    os.makedirs(os.path.join(output_dir, DERIVATIVES_DIRNAME), exist_ok=True)
+
+    # Widest first, each one downscaled from the previous
+    written = []
+    for width in sorted(widths, reverse=True):
+        image = scale_to_width(image, width)
+        relative_path = derivative_path(path, width)
+        image.save(os.path.join(output_dir, relative_path), DERIVATIVE_FORMAT, quality=80, method=0)
+        written.append(relative_path)
+    return written
@@ -2,6 +2,8 @@
 
 from django import forms
 from .models import ImageUpload
+from .clustering import CLUSTERING_ENGINES
+from .origami import DBSCAN_EPS, DBSCAN_MIN_SAMPLES, ORIGAMI_SITES
 
 class ImageProcessingOptionsForm(forms.Form):
     group_radius = forms.IntegerField(min_value=1, initial=50)
@@ -10,6 +12,24 @@ class ImageProcessingOptionsForm(forms.Form):
     circle_color = forms.CharField(initial='green')
     circle_width = forms.IntegerField(min_value=1, initial=8)
     num_categories = forms.IntegerField(label='Number of Categories', min_value=1, initial=1) 
+    clustering_engine = forms.ChoiceField(label='Clustering Engine', choices=CLUSTERING_ENGINES, initial='dbscan')
+    coarse_factor = forms.IntegerField(label='Pre-clustering Downsample', min_value=1, initial=1,
+                                       help_text='Bin the dot mask by this factor to skip regions too small to hold a group (1 = off)')
+    tile_memory_mb = forms.IntegerField(label='Tile Memory Budget (MB)', min_value=1, required=False,
+                                        help_text='Process the image in overlapping row bands within this budget (empty = whole image)')
+    orient_crops = forms.BooleanField(label='Orient Crops', required=False, initial=False,
+                                      help_text='Also rotate every group image so its border edge lies horizontal at the bottom')
+    lazy_crops = forms.BooleanField(label='On-demand Crops', required=False, initial=True,
+                                    help_text='Keep only the bounding box of every group and cut its image when it is viewed (not with Orient Crops)')
+
+class OrigamiAnalysisForm(forms.Form):
+    locs_file = forms.FileField(label='Picked Localizations (HDF5)')
+    sites = forms.IntegerField(label='Binding Sites', min_value=3, initial=ORIGAMI_SITES)
+    eps = forms.FloatField(label='Noise Filter Radius', min_value=0, initial=DBSCAN_EPS,
+                           help_text='DBSCAN eps, in the units of the localizations (pixels)')
+    min_samples = forms.IntegerField(label='Noise Filter Neighbours', min_value=1, initial=DBSCAN_MIN_SAMPLES)
+    flipped = forms.BooleanField(label='Flipped', required=False, initial=False,
+                                 help_text='Mirror the origami left to right before measuring')
 
 class ImageUploadForm(forms.ModelForm):
     class Meta:
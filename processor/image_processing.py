@@ -1,91 +1,435 @@
-from PIL import Image, ImageDraw
 import numpy as np
+import logging
 import os
 from django.conf import settings
 from zipfile import ZipFile
 import glob
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from functools import partial
+from .cache import (entry_key, evict, fetch_file, file_digest, load_arrays, load_groups, render_key, store_arrays,
+                    store_file, store_groups)
+from .clustering import candidate_dots, cluster_bands, cluster_dots, use_gpu
+from .orientation import ROTATED_DIRNAME, orient_images
+from .inputs import INPUT_EXTENSIONS, open_input
+from .atlas import Atlas, atlas_sheet_path, write_atlas_index
+from .derivatives import DERIVATIVE_EXTENSION, DERIVATIVES_DIRNAME, PREVIEW_WIDTHS, derivative_path, save_derivatives
+from .similarity import DESCRIPTOR_SIZE, DESCRIPTORS_FILENAME, crop_descriptor, write_descriptors
+from .metrics import StageTimer
+from .pools import process_pool
+from .crops import write_crop_index
 
-# Attempt to import cuml's DBSCAN for GPU acceleration; fall back to sklearn if unavailable
-try:
-    from cuml.cluster import DBSCAN
-    use_gpu = True
-    print("Using GPU for DBSCAN")
-except ImportError:
-    from sklearn.cluster import DBSCAN
-    use_gpu = False
+logger = logging.getLogger(__name__)
+
+ROTATED_ZIP_FILENAME = "all_rotated_images.zip"
+
+# Threads encoding derivatives while the next crops are cut (Pillow releases the GIL)
+DERIVATIVE_WORKERS = 4
+
+# One record per DBSCAN group: its label, number of dots and inclusive bounding box
+GROUP_DTYPE = np.dtype([
+    ('label', np.int64),
+    ('size', np.int64),
+    ('min_x', np.int64),
+    ('min_y', np.int64),
+    ('max_x', np.int64),
+    ('max_y', np.int64),
+])
+
+
+def extract_groups(dot_coordinates, labels):
+    """Return the size and bounding box of every labelled group as a GROUP_DTYPE array.
+
+    Dots are sorted by label once and reduced per label with ``np.minimum.reduceat`` /
+    ``np.maximum.reduceat``; noise dots (label -1) are ignored. Groups are ordered by label.
+    """
+    keep = labels >= 0
+    labels = labels[keep]
+    if labels.size == 0:
+        return np.empty(0, dtype=GROUP_DTYPE)
+
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    xs = dot_coordinates[keep, 0][order]
+    ys = dot_coordinates[keep, 1][order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+
+    groups = np.empty(len(starts), dtype=GROUP_DTYPE)
+    groups['label'] = labels[starts]
+    groups['size'] = np.diff(np.r_[starts, labels.size])
+    groups['min_x'] = np.minimum.reduceat(xs, starts)
+    groups['min_y'] = np.minimum.reduceat(ys, starts)
+    groups['max_x'] = np.maximum.reduceat(xs, starts)
+    groups['max_y'] = np.maximum.reduceat(ys, starts)
+    return groups
+
+
+def _read_bands(input_image, threshold, group_radius, memory_budget):
+    """Yield ``(top, bottom, dot_coordinates)`` for overlapping row bands of ``input_image``.
+
+    Each band carries a halo of twice the group radius above and below, as expected by
+    ``cluster_bands``. Band height is chosen so a band's pixels plus its threshold
+    temporaries fit in ``memory_budget`` bytes, but never drops below the halo so tiny
+    budgets do not degrade into one band per row.
+    """
+    halo = math.ceil(2 * group_radius)
+    row_bytes = input_image.width * (input_image.channels * input_image.itemsize + 2)
+    band_rows = max(memory_budget // row_bytes - 2 * halo, halo, 1)
+    return input_image.dots(threshold, band_rows, halo)
+
+
+def _timed_bands(bands, timer):
+    # Time spent producing each band is thresholding, the rest of cluster_bands is clustering
+    # (both get the memory peak of the interleaved pass)
+    while True:
+        start = time.perf_counter()
+        band = next(bands, None)
+        timer.add('threshold', time.perf_counter() - start)
+        if band is None:
+            return
+        yield band
+
+
+def _find_groups(input_image, group_radius, min_dots, threshold, engine, coarse_factor, tile_memory_mb, timer):
+    """Threshold and cluster an ``inputs.InputImage``; returns all groups as a GROUP_DTYPE array."""
+    if tile_memory_mb:
+        # Tiled mode: threshold and cluster overlapping row bands so the working set
+        # stays within the budget instead of scaling with the whole image
+        bands = _read_bands(input_image, threshold, group_radius, tile_memory_mb * 1024 * 1024)
+        start = time.perf_counter()
+        dot_coordinates, labels = cluster_bands(_timed_bands(bands, timer), group_radius, engine=engine)
+        timer.add('clustering', time.perf_counter() - start - timer.stages['threshold']['seconds'])
+    else:
+        with timer.stage('threshold'):
+            if coarse_factor > 1:
+                # Multi-resolution mode: only regions of the binned mask that can hold a full
+                # group are read back and clustered at full resolution
+                dot_coordinates = candidate_dots(input_image.mask(threshold), group_radius, min_dots, coarse_factor)
+            else:
+                dot_coordinates = np.concatenate([dots for _, _, dots in input_image.dots(threshold)])
+        with timer.stage('clustering'):
+            labels = cluster_dots(dot_coordinates, group_radius, engine=engine)
+    timer.count('dots', len(dot_coordinates))
+    with timer.stage('extraction'):
+        return extract_groups(dot_coordinates, labels)
+
+
+def _rendered_files(render, name_prefix, full_image_path, images_paths, labels, sheets, thumbnails, lazy_crops):
+    """(name in the cache entry, path in the output directory) of every file a render writes."""
+    files = [(f"{render}_overlay.png", full_image_path)]
+    if thumbnails:
+        files += [(f"{render}_overlay_{width}w{DERIVATIVE_EXTENSION}", derivative_path(full_image_path, width))
+                  for width in PREVIEW_WIDTHS]
+        files += [(f"{render}_atlas_{index}{DERIVATIVE_EXTENSION}", atlas_sheet_path(name_prefix, index))
+                  for index in range(sheets)]
+    if not lazy_crops:
+        files += [(f"{label}.png", path) for label, path in zip(labels, images_paths)]
+    return files
+
+
+def _fetch_rendered(cache_dir, cache_key, render, name_prefix, full_image_path, output_dir, thumbnails, lazy_crops):
+    """Outputs of an image rendered before with the same parameters, linked from the cache.
+
+    Returns (group files, boxes, descriptors, atlas) like _process_image, or None if any
+    of them is not cached.
+    """
+    record = load_arrays(cache_dir, cache_key, f"{render}.npz")
+    if record is None:
+        return None
+    labels = [int(label) for label in record['labels']]
+    images_paths = [f"group_{name_prefix}{label}.png" for label in labels]
+    sheets = int(record['sheets'])
+    if thumbnails:
+        os.makedirs(os.path.join(output_dir, DERIVATIVES_DIRNAME), exist_ok=True)
+    for name, path in _rendered_files(render, name_prefix, full_image_path, images_paths, labels, sheets, thumbnails,
+                                      lazy_crops):
+        if not fetch_file(cache_dir, cache_key, name, os.path.join(output_dir, path)):
+            return None
+    atlas_index = None
+    if thumbnails:
+        atlas_index = ([atlas_sheet_path(name_prefix, index) for index in range(sheets)],
+                       dict(zip(images_paths, record['atlas'].tolist())))
+    return images_paths, record['boxes'].tolist(), list(record['descriptors']), atlas_index
+
+
+def _store_rendered(cache_dir, cache_key, render, name_prefix, full_image_path, output_dir, labels, images_paths,
+                    boxes, descriptors, atlas_index):
+    """Cache what _fetch_rendered needs; the crops are cached as they are written."""
+    sheets = len(atlas_index[0]) if atlas_index else 0
+    for name, path in _rendered_files(render, name_prefix, full_image_path, images_paths, labels, sheets,
+                                      atlas_index is not None, lazy_crops=True):
+        store_file(cache_dir, cache_key, name, os.path.join(output_dir, path))
+    # The record goes last: an entry with a record has every rendered file
+    store_arrays(cache_dir, cache_key, f"{render}.npz",
+                 labels=np.array(labels, dtype=np.int64),
+                 boxes=np.array(boxes, dtype=np.int64).reshape(-1, 4),
+                 descriptors=np.array(descriptors, dtype=np.float32).reshape(-1, DESCRIPTOR_SIZE * DESCRIPTOR_SIZE),
+                 atlas=np.array([atlas_index[1][path] for path in images_paths] if atlas_index else [],
+                                dtype=np.int64).reshape(-1, 5),
+                 sheets=np.array(sheets))
+
+
+def _process_image(image_path, image_name, output_dir, group_radius, min_dots, threshold, circle_color, circle_width,
+                   engine, coarse_factor, tile_memory_mb, cache_dir=None, thumbnails=True, lazy_crops=False,
+                   report_progress=None):
+    """Process one image into ``output_dir``.
+
+    Returns (overlay file, group files, boxes, descriptors, atlas, timer).
+
+    A non-empty ``image_name`` is worked into every output file name. Runs in batch worker
+    processes, so it only depends on its arguments, not on settings. With a ``cache_dir``,
+    an image already processed with the same parameters is not decoded: every output is
+    linked from the cache. One clustered with other rendering parameters reuses the groups
+    and crops, and only draws the overlay, atlas and descriptors again. With ``thumbnails``,
+    previews of the overlay and sprite sheets of crop thumbnails are written to
+    ``derivatives.DERIVATIVES_DIRNAME`` by a thread pool; the atlas returned is the sheet paths and the position of every crop on them (see
+    atlas.py), or None. With ``lazy_crops`` the group files are not written; the crops are
+    cut on demand from their (left, top, right, bottom) boxes, which are returned for every
+    group file either way. The similarity descriptor of each group file is returned in the
+    same order, and the ``metrics.StageTimer`` of the image holds the time spent in each stage.
+    """
+    name_prefix = f"{image_name}_" if image_name else ''
+    full_image_path = f"all_groups_{image_name}.png" if image_name else 'all_groups.png'
+    timer = StageTimer(report=False, image=os.path.basename(image_path))
+
+    # The tile budget never changes the groups; candidate pre-clustering drops groups
+    # smaller than min_dots and so renumbers them
+    cache_key = render = None
+    groups = None
+    if cache_dir:
+        cache_key = entry_key(file_digest(image_path), threshold=threshold, group_radius=group_radius, engine=engine,
+                              coarse_factor=coarse_factor, min_dots=min_dots if coarse_factor > 1 else None)
+        render = render_key(min_dots=min_dots, circle_color=circle_color, circle_width=circle_width,
+                            thumbnails=thumbnails)
+        with timer.stage('cache'):
+            # Everything written before with these parameters is linked, without decoding the image
+            rendered = _fetch_rendered(cache_dir, cache_key, render, name_prefix, full_image_path, output_dir,
+                                       thumbnails, lazy_crops)
+            if rendered is None:
+                groups = load_groups(cache_dir, cache_key)
+        if rendered is not None:
+            images_paths = rendered[0]
+            timer.count('images')
+            timer.count('groups', len(images_paths))
+            timer.count('crops', len(images_paths))
+            timer.stop()
+            return (full_image_path, *rendered, timer)
+
+    with timer.stage('decode'):
+        input_image = open_input(image_path)
+
+    if groups is None:
+        groups = _find_groups(input_image, group_radius, min_dots, threshold, engine, coarse_factor, tile_memory_mb,
+                              timer)
+        if cache_key:
+            store_groups(cache_dir, cache_key, groups)
+    groups = groups[groups['size'] >= min_dots]
+    timer.count('images')
+    timer.count('groups', len(groups))
+    if report_progress:
+        report_progress(0.5)
+
+    derivative_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS) if thumbnails else None
+    pending_derivatives = []
+    atlas = Atlas(name_prefix) if thumbnails else None
+
+    images_paths = []
+    boxes = []
+    descriptors = []
+    # The steps of every group are timed over the whole loop; entering a stage per group
+    # would cost about as much as cutting a small crop
+    with timer.interleaved(calls=len(groups)) as loop_seconds:
+        for group in groups:
+            bounding_box = [max(group['min_x'] - group_radius, 0), max(group['min_y'] - group_radius, 0),
+                            min(group['max_x'] + group_radius, input_image.width), min(group['max_y'] + group_radius, input_image.height)]
+            bounding_box = [int(value) for value in bounding_box]
+            group_image_path = f"group_{name_prefix}{group['label']}.png"
+            images_paths.append(group_image_path)
+            boxes.append(bounding_box)
+
+            cropped_image = None
+            start = time.perf_counter()
+            if not lazy_crops:
+                destination = os.path.join(output_dir, group_image_path)
+                if not (cache_key and fetch_file(cache_dir, cache_key, f"{group['label']}.png", destination)):
+                    cropped_image = input_image.crop(bounding_box)
+                    cropped_image.save(destination)
+                    if cache_key:
+                        store_file(cache_dir, cache_key, f"{group['label']}.png", destination)
+                loop_seconds['crops'] += time.perf_counter() - start
+                start = time.perf_counter()
+            # Cutting the crop again from the open image is cheaper than caching its descriptor
+            if cropped_image is None:
+                cropped_image = input_image.crop(bounding_box)
+            descriptors.append(crop_descriptor(cropped_image))
+            loop_seconds['descriptors'] += time.perf_counter() - start
+
+            if atlas:
+                start = time.perf_counter()
+                atlas.add(group_image_path, cropped_image)
+                loop_seconds['atlas'] += time.perf_counter() - start
+
+    timer.count('crops', len(images_paths))
+    atlas_index = None
+    if atlas:
+        # The sheets are encoded while the overlay is drawn
+        atlas_index = (atlas.sheet_paths(), atlas.entries)
+        pending_derivatives.append(derivative_executor.submit(atlas.save, output_dir))
+
+    with timer.stage('overlay'):
+        image_with_circles = input_image.overlay(groups, group_radius, circle_color, circle_width)
+
+        if thumbnails:
+            # The overlay preview is encoded while the full overlay is saved below
+            pending_derivatives.append(derivative_executor.submit(save_derivatives, image_with_circles,
+                                                                  full_image_path, output_dir, PREVIEW_WIDTHS))
+        image_with_circles.save(os.path.join(output_dir, full_image_path))
+
+    if thumbnails:
+        # Only the time derivatives take beyond the stages above is counted here
+        with timer.stage('derivatives'):
+            for future in pending_derivatives:
+                future.result()
+            derivative_executor.shutdown()
+    if cache_key:
+        with timer.stage('cache'):
+            _store_rendered(cache_dir, cache_key, render, name_prefix, full_image_path, output_dir,
+                            [int(label) for label in groups['label']], images_paths, boxes, descriptors, atlas_index)
+    timer.stop()
+    return full_image_path, images_paths, boxes, descriptors, atlas_index, timer
+
+
+def _image_names(image_paths):
+    """Distinct output names for the images of a directory: their file stems, with the
+    extension added to stems shared by several files (``x.png`` and ``x.npy`` give ``x_png``
+    and ``x_npy``), and a number if that is not enough."""
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in image_paths]
+    stem_counts = Counter(stems)
+    names = []
+    taken = set()
+    for path, stem in zip(image_paths, stems):
+        name = f"{stem}_{os.path.splitext(path)[1][1:].lower()}" if stem_counts[stem] > 1 else stem
+        base, number = name, 1
+        while name in taken:
+            number += 1
+            name = f"{base}_{number}"
+        names.append(name)
+        taken.add(name)
+    return names
+
+
+def process_images(input_path, group_radius=50, min_dots=100, threshold=60, circle_color='green', circle_width=8, engine='dbscan',
+                   coarse_factor=1, tile_memory_mb=None, workers=None, progress_callback=None, output_dir=None,
+                   use_cache=True, thumbnails=True, orient=False, lazy_crops=False, timer=None):
+    # Outputs go to MEDIA_ROOT unless a job gives its own workspace directory;
+    # stage timings of every image are merged into ``timer`` (a metrics.StageTimer).
+    # With lazy_crops only an index of the crops is written (see crops.py), and no group
+    # archive; orienting the crops needs their files, so it turns lazy crops off.
+    lazy_crops = lazy_crops and not orient
+    if timer is None:
+        timer = StageTimer()
+    if output_dir is None:
+        output_dir = settings.MEDIA_ROOT
+    os.makedirs(output_dir, exist_ok=True)
+    cache_dir = getattr(settings, 'PROCESSOR_CACHE_DIR', None) if use_cache else None
 
-def process_images(input_path, group_radius=50, min_dots=100, threshold=60, circle_color='green', circle_width=8):
     if os.path.isdir(input_path):
-        image_paths = glob.glob(os.path.join(input_path, '*.png'))
+        image_paths = sorted(path for path in glob.glob(os.path.join(input_path, '*'))
+                             if os.path.splitext(path)[1].lower() in INPUT_EXTENSIONS)
     else:
         image_paths = [input_path]
-    
+
+    # Batch runs namespace every output with the image name so results do not collide
+    if os.path.isdir(input_path):
+        image_names = _image_names(image_paths)
+    else:
+        image_names = [''] * len(image_paths)
+    process = partial(_process_image, output_dir=output_dir, group_radius=group_radius, min_dots=min_dots,
+                      threshold=threshold, circle_color=circle_color, circle_width=circle_width, engine=engine,
+                      coarse_factor=coarse_factor, tile_memory_mb=tile_memory_mb, cache_dir=cache_dir,
+                      thumbnails=thumbnails, lazy_crops=lazy_crops)
+
+    # A GPU is shared by every worker, so GPU DBSCAN batches stay in this process
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if len(image_paths) > 1 and workers > 1 and not (use_gpu and engine == 'dbscan'):
+        with process_pool(min(workers, len(image_paths))) as executor:
+            futures = [executor.submit(process, path, name) for path, name in zip(image_paths, image_names)]
+            for done, _ in enumerate(as_completed(futures), start=1):
+                if progress_callback:
+                    progress_callback(done / len(futures))
+            results = [future.result() for future in futures]
+    else:
+        results = []
+        for index, (path, name) in enumerate(zip(image_paths, image_names)):
+            # progress_callback receives the overall fraction of work completed
+            report_progress = (lambda fraction, index=index: progress_callback((index + fraction) / len(image_paths))) \
+                if progress_callback else None
+            results.append(process(path, name, report_progress=report_progress))
+            if progress_callback:
+                progress_callback((index + 1) / len(image_paths))
+
     full_images_paths = []
     all_groups_paths = []
+    all_descriptors = []
+    crop_index = {}
+    atlas_sheets = []
+    atlas_crops = {}
+    for source, (full_image_path, images_paths, boxes, descriptors, atlas_index, image_timer) in enumerate(results):
+        logger.info("%s: %d groups in %.2fs", image_timer.labels['image'], len(images_paths), image_timer.seconds)
+        timer.merge(image_timer)
+        full_images_paths.append(full_image_path)
+        all_groups_paths.extend(images_paths)
+        all_descriptors.extend(descriptors)
+        crop_index.update((path, [source, *box]) for path, box in zip(images_paths, boxes))
+        if atlas_index:
+            # Sheet numbers of each image follow those of the images before it
+            sheets, entries = atlas_index
+            atlas_crops.update((path, [len(atlas_sheets) + sheet, *box]) for path, (sheet, *box) in entries.items())
+            atlas_sheets.extend(sheets)
+    full_image_path = full_images_paths[-1] if full_images_paths else None
+
+    with timer.stage('descriptor_matrix'):
+        # Row i describes all_groups_paths[i]
+        write_descriptors(os.path.join(output_dir, DESCRIPTORS_FILENAME), all_descriptors)
+    if thumbnails:
+        write_atlas_index(output_dir, atlas_sheets, atlas_crops)
 
-    for image_path in image_paths:
-        original_image = Image.open(image_path)
-        image_array = np.array(original_image)
+    if cache_dir and getattr(settings, 'PROCESSOR_CACHE_MAX_BYTES', None) is not None:
+        with timer.stage('eviction'):
+            evict(cache_dir, settings.PROCESSOR_CACHE_MAX_BYTES)
 
-        dots = np.where(np.all(image_array > threshold, axis=-1))
-        dot_coordinates = np.array(list(zip(dots[1], dots[0])))
+    with timer.stage('zip'):
+        full_images_zip_filename = "all_full_images.zip"
+        full_images_zip_path = os.path.join(output_dir, full_images_zip_filename)
+        with ZipFile(full_images_zip_path, 'w') as zip_file:
+            for path in full_images_paths:
+                zip_file.write(os.path.join(output_dir, path), os.path.basename(path))
 
-        # Pass appropriate parameters based on the backend (cuml or sklearn)
-        if use_gpu:
-            db = DBSCAN(eps=group_radius, min_samples=6, metric='euclidean', output_type='numpy').fit(dot_coordinates)
+        if lazy_crops:
+            groups_zip_filename = None
+            write_crop_index(output_dir, image_paths, crop_index)
         else:
-            db = DBSCAN(eps=group_radius, min_samples=6).fit(dot_coordinates)
-
-        labels = db.labels_
-        unique_labels = set(labels)
-
-        grouped_dots = {label: [] for label in unique_labels if label != -1}
-
-        for label, dot in zip(labels, dot_coordinates):
-            if label != -1:
-                grouped_dots[label].append(dot)
-
-        images_paths = []
-        for idx, group in enumerate(grouped_dots.values()):
-            if len(group) >= min_dots:
-                xs, ys = zip(*group)
-                min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
-                bounding_box = [max(min_x - group_radius, 0), max(min_y - group_radius, 0),
-                                min(max_x + group_radius, original_image.width), min(max_y + group_radius, original_image.height)]
-                cropped_image = original_image.crop(bounding_box)
-                group_image_path = f"group_{idx}.png"
-                cropped_image.save(os.path.join(settings.MEDIA_ROOT, group_image_path))
-                images_paths.append(group_image_path)
-
-        image_with_circles = original_image.copy()
-        draw = ImageDraw.Draw(image_with_circles)
-        for group in grouped_dots.values():
-            if len(group) >= min_dots:
-                xs, ys = zip(*group)
-                min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
-                draw.ellipse((min_x - group_radius, min_y - group_radius, max_x + group_radius, max_y + group_radius),
-                             outline=circle_color, width=circle_width)
-
-        full_image_path = 'all_groups.png'
-        image_with_circles.save(os.path.join(settings.MEDIA_ROOT, full_image_path))
-        full_images_paths.append(full_image_path)
-        all_groups_paths.extend(images_paths)
+            groups_zip_filename = "all_group_images.zip"
+            groups_zip_path = os.path.join(output_dir, groups_zip_filename)
+            with ZipFile(groups_zip_path, 'w') as zip_file:
+                for path in all_groups_paths:
+                    zip_file.write(os.path.join(output_dir, path), os.path.basename(path))
+
+    logger.info("%d images processed using %s (%s): %d group images", len(image_paths),
+                'GPU' if use_gpu and engine == 'dbscan' else 'CPU', engine, len(all_groups_paths))
 
-    full_images_zip_filename = "all_full_images.zip"
-    full_images_zip_path = os.path.join(settings.MEDIA_ROOT, full_images_zip_filename)
-    with ZipFile(full_images_zip_path, 'w') as zip_file:
-        for path in full_images_paths:
-            zip_file.write(os.path.join(settings.MEDIA_ROOT, path), os.path.basename(path))
-
-    groups_zip_filename = "all_group_images.zip"
-    groups_zip_path = os.path.join(settings.MEDIA_ROOT, groups_zip_filename)
-    with ZipFile(groups_zip_path, 'w') as zip_file:
-        for path in all_groups_paths:
-            zip_file.write(os.path.join(settings.MEDIA_ROOT, path), os.path.basename(path))
-    
-    print(f"{len(image_paths)} images processed using {'GPU' if use_gpu else 'CPU'}")
-    
-    #printing the total number of individual group images
-    print(f"Total number of individual group images: {len(all_groups_paths)}")
+    if orient:
+        # Post-processing stage: normalize the orientation of every crop into rotated/
+        with timer.stage('orient'):
+            rotated_dir = os.path.join(output_dir, ROTATED_DIRNAME)
+            angles = orient_images([os.path.join(output_dir, path) for path in all_groups_paths], rotated_dir, workers)
+            with ZipFile(os.path.join(output_dir, ROTATED_ZIP_FILENAME), 'w') as zip_file:
+                for path in all_groups_paths:
+                    zip_file.write(os.path.join(rotated_dir, path), path)
+        logger.info("Oriented %d of %d group images in %.2fs", sum(angle is not None for angle in angles),
+                    len(angles), timer.stages['orient']['seconds'])
 
     return full_images_zip_filename, groups_zip_filename, full_image_path, all_groups_paths
@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+import yaml
+from PIL import Image, ImageColor, ImageDraw
+
+# Input layer of image processing. Images decoded by PIL stay in their own mode (8-bit or
+# 16-bit grayscale is never expanded to RGB), and .npy files and Picasso-style .raw files
+# (with a .yaml description next to them) are memory-mapped. Pixels are read and thresholded
+# band by band, so no full-size copy or boolean temporary of the whole image is ever made;
+# the crops and overlays written for the pages are 8-bit.
+INPUT_EXTENSIONS = ('.png', '.tif', '.tiff', '.npy', '.raw')
+BAND_BYTES = 8 * 1024 ** 2  # Size of the bands of pixels read at a time
+CIRCLE_INDEX = 255  # Palette entry of the circles on single-channel overlays
+
+# PIL modes processed as they are; others are converted to RGB(A), or L for bilevel images
+_IMAGE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'I', 'F', 'I;16', 'I;16L', 'I;16B')
+
+
+class InputImage:
+    """Pixels of an input image.
+
+    Either ``image``, a PIL image in one of the modes above, or ``array``, a single-channel
+    ``(height, width)`` array (possibly memory-mapped). Single-channel pixels are thresholded
+    as they are, in the units of the data; multi-channel pixels must be above the threshold
+    in every channel.
+    """
+
+    def __init__(self, image=None, array=None):
+        self.image = image
+        self.array = array
+        if array is not None:
+            self.height, self.width = array.shape
+            self.channels, self.dtype = 1, array.dtype
+        else:
+            self.width, self.height = image.size
+            self.channels, self.dtype = len(image.getbands()), np.asarray(image.crop((0, 0, 1, 1))).dtype
+        self._peak = None
+        self._lut = None
+
+    @property
+    def itemsize(self):
+        return self.dtype.itemsize
+
+    def rows(self, top, bottom):
+        """Pixels of rows ``top`` to ``bottom``: a view of an array, a copy of the band of an image."""
+        if self.array is not None:
+            return self.array[top:bottom]
+        return np.asarray(self.image.crop((0, top, self.width, bottom)))
+
+    def bands(self, band_rows=None, halo=0):
+        """Yield ``(top, bottom, upper, pixels)`` for row bands; ``pixels`` start at row ``upper``
+        and extend ``halo`` rows beyond the band on both sides.
+
+        Bands are ``BAND_BYTES`` of pixels unless ``band_rows`` is given.
+        """
+        if band_rows is None:
+            band_rows = max(BAND_BYTES // (self.width * self.channels * self.itemsize), 1)
+        for top in range(0, self.height, band_rows):
+            bottom = min(top + band_rows, self.height)
+            upper = max(top - halo, 0)
+            yield top, bottom, upper, self.rows(upper, min(bottom + halo, self.height))
+
+    def mask(self, threshold, band_rows=None):
+        """Boolean ``(height, width)`` mask of the pixels above ``threshold``."""
+        mask = np.empty((self.height, self.width), dtype=bool)
+        for top, bottom, _, pixels in self.bands(band_rows):
+            _threshold(pixels, threshold, out=mask[top:bottom])
+        return mask
+
+    def dots(self, threshold, band_rows=None, halo=0):
+        """Yield ``(top, bottom, dot_coordinates)`` of the pixels above ``threshold`` per row band.
+
+        Coordinates are x, y of the whole image, in row-major order, and include the dots of
+        the ``halo`` rows around the band.
+        """
+        for top, bottom, upper, pixels in self.bands(band_rows, halo):
+            ys, xs = np.nonzero(_threshold(pixels, threshold))
+            yield top, bottom, np.column_stack((xs, ys + upper))
+
+    def peak(self):
+        """Largest pixel value of a single-channel array, which the 8-bit outputs are scaled to."""
+        if self._peak is None:
+            self._peak = max((pixels.max() for _, _, _, pixels in self.bands()), default=0)
+        return self._peak
+
+    def display(self, pixels):
+        """8-bit ``pixels``: as they are for 8-bit data, else scaled so the image maximum is 255."""
+        if pixels.dtype == np.uint8:
+            return pixels
+        peak = float(self.peak())
+        scale = 255 / peak if peak > 0 else 0
+        if pixels.dtype.kind == 'u' and pixels.dtype.itemsize == 2:
+            # A lookup table turns 16-bit pixels into bytes without a floating-point temporary
+            if self._lut is None:
+                self._lut = np.clip(np.arange(1 << 16) * scale, 0, 255).astype(np.uint8)
+            return self._lut[pixels]
+        scaled = pixels.astype(np.float32)
+        scaled *= scale
+        return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+    def crop(self, box):
+        """8-bit PIL image of ``box`` (left, top, right, bottom)."""
+        if self.array is None and self.dtype == np.uint8:
+            return self.image.crop(box)
+        left, top, right, bottom = (int(value) for value in box)
+        if self.array is None:
+            pixels = np.asarray(self.image.crop((left, top, right, bottom)))
+        else:
+            pixels = self.array[top:bottom, left:right]
+        return Image.fromarray(self.display(pixels))
+
+    def overlay(self, groups, group_radius, circle_color, circle_width):
+        """Copy of the image with a circle around every group, for display.
+
+        Single-channel images get a palette image: gray levels up to 254 and the circle color
+        as entry 255, so the overlay takes one byte per pixel instead of three.
+        """
+        if self.channels > 1:
+            image = self.image.copy() if self.image.mode in ('RGB', 'RGBA') else self.image.convert('RGBA')
+            outline = circle_color
+        else:
+            image = Image.new('P', (self.width, self.height))
+            for top, bottom, _, pixels in self.bands():
+                image.paste(Image.fromarray(np.minimum(self.display(pixels), CIRCLE_INDEX - 1)), (0, top))
+            palette = np.repeat(np.arange(256, dtype=np.uint8), 3)
+            palette[3 * CIRCLE_INDEX:] = ImageColor.getrgb(circle_color)[:3]
+            image.putpalette(palette.tobytes())
+            outline = CIRCLE_INDEX
+
+        draw = ImageDraw.Draw(image)
+        for group in groups:
+            draw.ellipse((group['min_x'] - group_radius, group['min_y'] - group_radius,
+                          group['max_x'] + group_radius, group['max_y'] + group_radius),
+                         outline=outline, width=circle_width)
+        return image
+
+
+def _threshold(pixels, threshold, out=None):
+    if pixels.ndim == 2:
+        return np.greater(pixels, threshold, out=out)
+    mask = np.greater(pixels[..., 0], threshold, out=out)
+    for channel in range(1, pixels.shape[-1]):
+        mask &= pixels[..., channel] > threshold
+    return mask
+
+
+def _single_channel(array, path):
+    if array.ndim == 3 and array.shape[-1] == 1:
+        array = array[..., 0]
+    if array.ndim != 2:
+        raise ValueError(f"{path}: expected a single-channel (height, width) image, got shape {array.shape}")
+    return array
+
+
+def _read_raw(path):
+    # Picasso describes a raw movie in a YAML file of the same name; the first frame is used
+    info_path = os.path.splitext(path)[0] + '.yaml'
+    try:
+        with open(info_path) as fh:
+            info = next(yaml.safe_load_all(fh))
+        dtype = np.dtype(info['Data Type']).newbyteorder(info.get('Byte Order', '<'))
+        shape = (int(info['Height']), int(info['Width']))
+    except (OSError, StopIteration, KeyError, TypeError) as exc:
+        raise ValueError(f"{path}: raw images need {os.path.basename(info_path)} with their Width, Height "
+                         f"and Data Type ({exc})") from exc
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def open_input(path):
+    """Open an image, .npy or .raw file for processing as an :class:`InputImage`."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        return InputImage(array=_single_channel(np.load(path, mmap_mode='r'), path))
+    if extension == '.raw':
+        return InputImage(array=_read_raw(path))
+
+    image = Image.open(path)
+    if image.mode not in _IMAGE_MODES:
+        image = image.convert('L' if image.mode == '1' else 'RGBA' if 'A' in image.getbands() else 'RGB')
+    image.load()
+    return InputImage(image=image)
@@ -0,0 +1,161 @@
+import datetime
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .image_processing import ROTATED_ZIP_FILENAME, process_images
+from .metrics import StageTimer
+from .models import LabeledImage, ProcessingJob
+from .origami import RATIO_TABLE_FILENAME, analyze_origami, ratio_summary, write_ratio_table
+from .workspaces import start_reaper
+
+logger = logging.getLogger(__name__)
+
+# Jobs run in this thread pool when PROCESSOR_JOB_RUNNER is 'thread'; with 'command' they
+# stay queued in the database until `manage.py run_processing_jobs` picks them up
+_executor = None
+
+# Running jobs refresh heartbeat_at every HEARTBEAT_INTERVAL seconds, so a job whose process
+# died is told apart from a long one
+HEARTBEAT_INTERVAL = 30
+STALE_JOB_ERROR = "Interrupted: the process running this job stopped before it finished"
+
+
+def enqueue_job(job):
+    """Schedule a queued job once the transaction that created it commits."""
+    if getattr(settings, 'PROCESSOR_JOB_RUNNER', 'thread') != 'thread':
+        return
+    start_reaper()
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PROCESSOR_JOB_WORKERS', 1),
+                                       thread_name_prefix='processing-job')
+    transaction.on_commit(lambda: _executor.submit(run_job, job.pk))
+
+
+def fail_stale_jobs(job_id=None):
+    """Fail running jobs (all, or the given one) without a heartbeat for PROCESSOR_JOB_STALE_AFTER
+    seconds; returns how many were failed."""
+    stale_after = getattr(settings, 'PROCESSOR_JOB_STALE_AFTER', None)
+    if not stale_after:
+        return 0
+    now = timezone.now()
+    cutoff = now - datetime.timedelta(seconds=stale_after)
+    stale = ProcessingJob.objects.filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff),
+                                         status=ProcessingJob.STATUS_RUNNING)
+    if job_id is not None:
+        stale = stale.filter(pk=job_id)
+    failed = stale.update(status=ProcessingJob.STATUS_FAILED, error=STALE_JOB_ERROR, finished_at=now)
+    if failed:
+        logger.warning("Failed %d processing jobs left running by a stopped process", failed)
+    return failed
+
+
+def claim_job(job_id=None):
+    """Atomically move a queued job (the given one or the oldest) to running and return it."""
+    fail_stale_jobs()
+    queued = ProcessingJob.objects.filter(status=ProcessingJob.STATUS_QUEUED)
+    if job_id is not None:
+        queued = queued.filter(pk=job_id)
+    for job in queued.order_by('created_at')[:5]:
+        # The status filter makes the update a no-op if another worker claimed it first
+        now = timezone.now()
+        claimed = ProcessingJob.objects.filter(pk=job.pk, status=ProcessingJob.STATUS_QUEUED).update(
+            status=ProcessingJob.STATUS_RUNNING, started_at=now, heartbeat_at=now)
+        if claimed:
+            return ProcessingJob.objects.get(pk=job.pk)
+    return None
+
+
+@contextmanager
+def _heartbeat(job):
+    """Refresh the job's heartbeat from a thread while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                try:
+                    ProcessingJob.objects.filter(pk=job.pk, status=ProcessingJob.STATUS_RUNNING).update(
+                        heartbeat_at=timezone.now())
+                except Exception:
+                    logger.exception("Heartbeat of processing job %s failed", job.pk)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'processing-job-{job.pk}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job_id=None):
+    """Claim and process one job; returns the finished job or None if nothing was queued."""
+    close_old_connections()
+    try:
+        job = claim_job(job_id)
+        if job is None:
+            return None
+
+        def report_progress(fraction):
+            ProcessingJob.objects.filter(pk=job.pk).update(progress=round(fraction * 100, 1))
+
+        # Stage timings are kept for failed jobs too, up to the stage that failed
+        timer = StageTimer(job=job.pk, kind=job.kind)
+        try:
+            run = _run_origami_job if job.kind == ProcessingJob.KIND_ORIGAMI else _run_images_job
+            with _heartbeat(job):
+                result = run(job, report_progress, timer)
+        except Exception:
+            job.status = ProcessingJob.STATUS_FAILED
+            job.error = traceback.format_exc()
+            logger.exception("Processing job %s failed", job.pk)
+        else:
+            job.status = ProcessingJob.STATUS_DONE
+            job.progress = 100
+            job.result = result
+        timer.log_summary()
+        job.metrics = timer.as_dict()
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'progress', 'result', 'error', 'metrics', 'finished_at'])
+        return job
+    finally:
+        close_old_connections()
+
+
+def _run_images_job(job, report_progress, timer):
+    full_images_zip_filename, groups_zip_filename, full_image_path, group_images_paths = process_images(
+        job.upload.image.path, progress_callback=report_progress, output_dir=job.workspace_path, timer=timer,
+        **job.options
+    )
+    # Every crop enters the labeling queue
+    with timer.stage('queue'):
+        LabeledImage.create_queue(job, group_images_paths)
+    return {
+        'full_image_path': full_image_path,
+        'group_images_paths': group_images_paths,
+        'full_images_zip': full_images_zip_filename,
+        'groups_zip': groups_zip_filename,
+        'thumbnails': True,  # Derivatives exist for the result page
+        # Crops are cut from crop_index.json on request instead of written (see crops.py)
+        'lazy_crops': groups_zip_filename is None,
+        'rotated_zip': ROTATED_ZIP_FILENAME if job.options.get('orient') else None,
+    }
+
+
+def _run_origami_job(job, report_progress, timer):
+    rows = analyze_origami(job.upload.image.path, progress_callback=report_progress, timer=timer, **job.options)
+    os.makedirs(job.workspace_path, exist_ok=True)
+    write_ratio_table(rows, os.path.join(job.workspace_path, RATIO_TABLE_FILENAME))
+    return dict(ratio_summary(rows), rows=rows, ratios_csv=RATIO_TABLE_FILENAME)
@@ -0,0 +1,107 @@
+import h5py
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+# Ingestion of Picasso-style localization files: an HDF5 compound dataset ``locs`` with one
+# row per localization and a ``group`` column for picked files. Files are read in chunks of
+# rows and only the requested columns are kept, then the rows are partitioned by group with a
+# counting sort, so every group is a contiguous slice (a view) of one array.
+LOCS_DATASET = 'locs'
+CHUNK_ROWS = 1 << 20
+DEFAULT_FIELDS = ('x', 'y')
+
+
+class GroupedLocalizations:
+    """Localizations partitioned by group.
+
+    ``locs`` is a structured array of the requested fields, ordered by group and, within a
+    group, in file order; the rows of ``groups[i]`` are ``locs[offsets[i]:offsets[i + 1]]``.
+    """
+
+    def __init__(self, groups, offsets, locs):
+        self.groups = groups
+        self.offsets = offsets
+        self.locs = locs
+        self._index = {int(group): i for i, group in enumerate(groups)}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        for i, group in enumerate(self.groups):
+            yield int(group), self.locs[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, group):
+        i = self._index[int(group)]
+        return self.locs[self.offsets[i]:self.offsets[i + 1]]
+
+    def points(self, group, fields=DEFAULT_FIELDS):
+        """``(n, len(fields))`` coordinates of a group; a view when the fields share a dtype."""
+        return structured_to_unstructured(self[group][list(fields)], copy=False)
+
+
+def _read_chunks(dataset, fields, chunk_rows):
+    for start in range(0, dataset.shape[0], chunk_rows):
+        yield dataset.fields(fields)[start:start + chunk_rows]
+
+
+def read_locs(path, fields=DEFAULT_FIELDS, dataset=LOCS_DATASET, chunk_rows=CHUNK_ROWS):
+    """Structured array of the ``fields`` columns of a locs file, read ``chunk_rows`` at a time."""
+    with h5py.File(path, 'r') as f:
+        locs = f[dataset]
+        out = np.empty(locs.shape[0], dtype=[(name, locs.dtype[name]) for name in fields])
+        start = 0
+        for chunk in _read_chunks(locs, list(fields), chunk_rows):
+            out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+    return out
+
+
+def group_locs(path, fields=DEFAULT_FIELDS, dataset=LOCS_DATASET, chunk_rows=CHUNK_ROWS):
+    """Read a picked locs file into a :class:`GroupedLocalizations`.
+
+    Two passes over the file: the first counts the rows of each group from the ``group``
+    column alone, the second scatters each chunk straight to its final rows. Apart from the
+    result, memory use is bounded by ``chunk_rows`` and the time is linear in the rows.
+    """
+    fields = [name for name in fields if name != 'group']
+    with h5py.File(path, 'r') as f:
+        locs = f[dataset]
+
+        # Rows per group id, group ids being shifted by the smallest one seen so far
+        base, counts = None, np.zeros(0, dtype=np.int64)
+        for chunk in _read_chunks(locs, 'group', chunk_rows):
+            if not len(chunk):
+                continue
+            chunk_min = int(chunk.min())
+            if base is None:
+                base = chunk_min
+            elif chunk_min < base:
+                counts = np.concatenate((np.zeros(base - chunk_min, dtype=np.int64), counts))
+                base = chunk_min
+            chunk_counts = np.bincount(chunk - base)
+            if len(chunk_counts) > len(counts):
+                counts = np.concatenate((counts, np.zeros(len(chunk_counts) - len(counts), dtype=np.int64)))
+            counts[:len(chunk_counts)] += chunk_counts
+
+        # Next free row of each group id
+        cursor = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=cursor[1:])
+        out = np.empty(locs.shape[0], dtype=[(name, locs.dtype[name]) for name in fields])
+        for chunk in _read_chunks(locs, fields + ['group'], chunk_rows):
+            ids = chunk['group'] - base
+            # A stable sort keeps file order within each group; a chunk of an already grouped
+            # file is sorted, which the sort detects in linear time.
+            order = np.argsort(ids, kind='stable')
+            sorted_ids = ids[order]
+            chunk_counts = np.bincount(sorted_ids, minlength=len(counts))
+            chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+            rows = cursor[sorted_ids] + np.arange(len(order)) - chunk_starts[sorted_ids]
+            for name in fields:
+                out[name][rows] = chunk[name][order]
+            cursor += chunk_counts
+
+    present = np.flatnonzero(counts)
+    offsets = np.concatenate(([0], np.cumsum(counts[present])))
+    groups = present + (base or 0)
+    return GroupedLocalizations(groups, offsets, out)
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from processor.origami import (DBSCAN_EPS, DBSCAN_MIN_SAMPLES, ORIGAMI_SITES, analyze_origami, ratio_summary,
+                               write_ratio_table)
+
+
+class Command(BaseCommand):
+    help = "Measure the robot ratio of every picked origami in a locs HDF5 file and write the ratio table as CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('locs_file', help="Picked localizations (HDF5 with a 'locs' dataset)")
+        parser.add_argument('output', help="CSV file for the ratio table")
+        parser.add_argument('--sites', type=int, default=ORIGAMI_SITES, help="Binding sites (KMeans clusters) per origami")
+        parser.add_argument('--eps', type=float, default=DBSCAN_EPS, help="DBSCAN eps of the noise filter")
+        parser.add_argument('--min-samples', type=int, default=DBSCAN_MIN_SAMPLES)
+        parser.add_argument('--flipped', action='store_true', help="Mirror the origami left to right")
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (defaults to the CPU count)")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        rows = analyze_origami(options['locs_file'], options['sites'], options['flipped'], options['eps'],
+                               options['min_samples'], workers=options['workers'])
+        write_ratio_table(rows, options['output'])
+        summary = ratio_summary(rows)
+        self.stdout.write(self.style.SUCCESS(
+            f"Measured {summary['measured']} of {summary['groups']} origami in {time.perf_counter() - start:.1f}s; "
+            f"ratio table written to {options['output']}"
+        ))
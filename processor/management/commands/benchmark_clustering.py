@@ -0,0 +1,66 @@
+import glob
+import os
+import time
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from processor.clustering import CLUSTERING_ENGINES, cluster_dots
+
+
+class Command(BaseCommand):
+    help = "Time every clustering engine on the dots of sample images and check that their labels agree."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            default=[os.path.join(settings.BASE_DIR, 'Testing code', 'Bordering Test', 'multi_acquisitions')],
+            help="PNG images or directories of PNG images (defaults to the Bordering Test acquisitions)",
+        )
+        parser.add_argument('--group-radius', type=int, default=50)
+        parser.add_argument('--threshold', type=int, default=60)
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per engine; the best time is reported")
+
+    def handle(self, *args, **options):
+        image_paths = []
+        for path in options['paths']:
+            if os.path.isdir(path):
+                image_paths.extend(sorted(glob.glob(os.path.join(path, '*.png'))))
+            else:
+                image_paths.append(path)
+
+        engines = [key for key, _ in CLUSTERING_ENGINES]
+        totals = dict.fromkeys(engines, 0.0)
+        self.stdout.write(f"{'image':<24}{'dots':>10}" + ''.join(f"{engine + ' (s)':>14}" for engine in engines) + f"{'speedup':>10}")
+
+        for image_path in image_paths:
+            image_array = np.array(Image.open(image_path))
+            dots = np.nonzero(np.all(image_array > options['threshold'], axis=-1))
+            dot_coordinates = np.column_stack((dots[1], dots[0]))
+
+            timings, labels = {}, {}
+            for engine in engines:
+                best = float('inf')
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    labels[engine] = cluster_dots(dot_coordinates, options['group_radius'], engine=engine)
+                    best = min(best, time.perf_counter() - start)
+                timings[engine] = best
+                totals[engine] += best
+
+            reference = labels[engines[0]]
+            for engine in engines[1:]:
+                if not np.array_equal(reference, labels[engine]):
+                    self.stderr.write(self.style.ERROR(f"{engine} labels differ from {engines[0]} on {image_path}"))
+
+            speedup = timings[engines[0]] / max(timings[engines[-1]], 1e-9)
+            self.stdout.write(f"{os.path.basename(image_path):<24}{len(dot_coordinates):>10}"
+                              + ''.join(f"{timings[engine]:>14.3f}" for engine in engines) + f"{speedup:>9.1f}x")
+
+        speedup = totals[engines[0]] / max(totals[engines[-1]], 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(image_paths)} images: " + ', '.join(f"{engine} {totals[engine]:.2f}s" for engine in engines)
+            + f" ({speedup:.1f}x)"
+        ))
@@ -0,0 +1,223 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from processor.cache import file_digest
+from processor.clustering import CLUSTERING_ENGINES
+from processor.image_processing import _find_groups, process_images
+from processor.inputs import open_input
+from processor.metrics import StageTimer
+from processor.synthetic import MIN_SEPARATION, synthetic_field
+
+# How the synthetic field is stored: as generated, as 8-bit or 16-bit grayscale, or as a uint16 .npy
+INPUT_FORMATS = ('rgb', 'gray', 'gray16', 'npy')
+# Stages of process_images in the order they run; only those a run records are reported
+STAGES = ('decode', 'cache', 'threshold', 'clustering', 'extraction', 'crops', 'descriptors', 'atlas', 'overlay',
+          'derivatives', 'descriptor_matrix', 'eviction', 'zip')
+# Options that change what is measured; --compare refuses a baseline recorded with other values
+PARAMETERS = ('origami_per_megapixel', 'dots_per_origami', 'noise', 'hot_pixels', 'input_format', 'images', 'engine',
+              'coarse_factor', 'tile_memory_mb', 'workers', 'thumbnails', 'lazy_crops', 'cached', 'group_radius',
+              'min_dots', 'threshold', 'repeat', 'seed')
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def match_groups(groups, centers):
+    """Number of ground-truth centers that fall in exactly one group's bounding box."""
+    inside = ((groups['min_x'][:, None] <= centers[:, 0]) & (centers[:, 0] <= groups['max_x'][:, None])
+              & (groups['min_y'][:, None] <= centers[:, 1]) & (centers[:, 1] <= groups['max_y'][:, None]))
+    return int((inside.sum(axis=0) == 1).sum())
+
+
+class Command(BaseCommand):
+    help = ("Time process_images stage by stage on synthetic DNA-PAINT fields of increasing size, "
+            "check the groups found against the generator, and optionally write or compare JSON results.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4096, 8192, 16384],
+                            help="Square image sides in pixels (16384 needs about 3 GB of memory)")
+        parser.add_argument('--origami-per-megapixel', type=float, default=10.0)
+        parser.add_argument('--dots-per-origami', type=int, default=10)
+        parser.add_argument('--noise', type=int, default=20, help="Maximum background level")
+        parser.add_argument('--hot-pixels', type=float, default=1e-5, help="Fraction of isolated bright pixels")
+        parser.add_argument('--input-format', choices=INPUT_FORMATS, default='rgb')
+        parser.add_argument('--images', type=int, default=1,
+                            help="Fields per size; more than one are processed as a directory batch")
+        parser.add_argument('--engine', choices=[key for key, _ in CLUSTERING_ENGINES], default='grid')
+        parser.add_argument('--coarse-factor', type=int, default=1)
+        parser.add_argument('--tile-memory-mb', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=1, help="Worker processes for batches")
+        parser.add_argument('--no-thumbnails', dest='thumbnails', action='store_false')
+        parser.add_argument('--lazy-crops', action='store_true')
+        parser.add_argument('--cached', action='store_true',
+                            help="Time re-runs served from the result cache (filled by an untimed first run)")
+        parser.add_argument('--group-radius', type=int, default=50)
+        parser.add_argument('--min-dots', type=int, default=100)
+        parser.add_argument('--threshold', type=int, default=60)
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per size; the best time of each stage is kept")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--compare', help="JSON results of an earlier run with the same parameters to compare against")
+
+    def handle(self, *args, **options):
+        parameters = {name: options[name] for name in PARAMETERS}
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as fh:
+                report = json.load(fh)
+            differences = [f"{name}: {report['parameters'].get(name)!r} there, {value!r} here"
+                           for name, value in parameters.items() if report['parameters'].get(name) != value]
+            if differences:
+                raise CommandError(f"{options['compare']} was recorded with other parameters ({'; '.join(differences)})")
+            baseline = {result['size']: result for result in report['results']}
+
+        results = []
+        for size in options['sizes']:
+            result = self.run_size(size, options)
+            results.append(result)
+            base = baseline.get(size) if baseline else None
+            if base and base.get('inputs') != result['inputs']:
+                raise CommandError(f"The {size}² fields differ from those of {options['compare']}")
+            self.write_result(result, base)
+
+        if options['output']:
+            report = {
+                'revision': _git_revision(),
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'parameters': parameters,
+                'results': results,
+            }
+            with open(options['output'], 'w') as fh:
+                json.dump(report, fh, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if not all(result['ok'] for result in results):
+            raise CommandError("Groups found do not match the generated origami")
+        self.stdout.write(self.style.SUCCESS(f"{len(results)} sizes benchmarked"))
+
+    def write_result(self, result, baseline):
+        stages = [stage for stage in STAGES if stage in result['stages']]
+        stages += sorted(set(result['stages']) - set(STAGES))
+        peak = '-' if result['peak_rss'] is None else f"{result['peak_rss'] / 1024 ** 2:.0f} MB"
+        self.stdout.write(f"{result['size']}² x {result['images']}: {result['total']:.3f}s, peak RSS {peak}, "
+                          f"{result['groups_found']}/{result['groups_expected']} groups")
+        for stage in stages:
+            line = f"  {stage:<18}{result['stages'][stage]:>10.3f}s"
+            if baseline and stage in baseline['stages']:
+                line += f"{result['stages'][stage] / max(baseline['stages'][stage], 1e-9):>9.2f}x"
+            self.stdout.write(line)
+        if baseline:
+            self.stdout.write(f"  {'total':<18}{result['total']:>10.3f}s{result['total'] / baseline['total']:>9.2f}x")
+        if not result['ok']:
+            self.stderr.write(self.style.ERROR(
+                f"{result['size']}: found {result['groups_found']} groups, {result['groups_matched']} matching "
+                f"the {result['groups_expected']} generated origami"))
+
+    def run_size(self, size, options):
+        # At least one origami, and no more than the grid can hold
+        capacity = (size // MIN_SEPARATION) ** 2
+        origami = min(max(round(options['origami_per_megapixel'] * size * size / 1e6), 1), capacity)
+        # 16-bit fields are the 8-bit values times 257, and so is the threshold
+        threshold = options['threshold'] * (257 if options['input_format'] in ('gray16', 'npy') else 1)
+
+        with tempfile.TemporaryDirectory(prefix='benchmark_') as workdir:
+            input_dir = os.path.join(workdir, 'input')
+            os.makedirs(input_dir)
+            start = time.perf_counter()
+            image_paths, all_centers = [], []
+            for index in range(options['images']):
+                image, centers = synthetic_field(size, size, origami, options['dots_per_origami'], options['noise'],
+                                                 options['hot_pixels'], seed=options['seed'] + index)
+                image_paths.append(self.save_field(image, os.path.join(input_dir, f"synthetic_{size}_{index}"),
+                                                   options['input_format']))
+                all_centers.append(centers)
+                del image
+            generate_seconds = time.perf_counter() - start
+            input_path = image_paths[0] if len(image_paths) == 1 else input_dir
+
+            def run():
+                timer = StageTimer(report=False, size=size)
+                start = time.perf_counter()
+                process_images(input_path, options['group_radius'], options['min_dots'], threshold,
+                               engine=options['engine'], coarse_factor=options['coarse_factor'],
+                               tile_memory_mb=options['tile_memory_mb'], workers=options['workers'],
+                               output_dir=tempfile.mkdtemp(dir=workdir), use_cache=options['cached'],
+                               thumbnails=options['thumbnails'], lazy_crops=options['lazy_crops'], timer=timer)
+                return time.perf_counter() - start, timer
+
+            with override_settings(PROCESSOR_CACHE_DIR=os.path.join(workdir, 'cache')):
+                if options['cached']:
+                    run()
+                best = None
+                for _ in range(options['repeat']):
+                    seconds, timer = run()
+                    stages = {name: record['seconds'] for name, record in timer.stages.items()}
+                    if best is None:
+                        best = {'total': seconds, 'stages': stages, 'peak_rss': timer.as_dict()['peak_rss'],
+                                'groups': timer.counts.get('groups', 0)}
+                    else:
+                        best['total'] = min(best['total'], seconds)
+                        best['stages'] = {name: min(best['stages'].get(name, value), value)
+                                          for name, value in stages.items()}
+
+            # The groups are checked with the pipeline's own clustering (not timed)
+            matched = 0
+            for image_path, centers in zip(image_paths, all_centers):
+                groups = _find_groups(open_input(image_path), options['group_radius'], options['min_dots'], threshold,
+                                      options['engine'], options['coarse_factor'], options['tile_memory_mb'],
+                                      StageTimer(report=False))
+                matched += match_groups(groups[groups['size'] >= options['min_dots']], centers)
+            inputs = [file_digest(path) for path in image_paths]
+
+        expected = origami * options['images']
+        return {
+            'size': size,
+            'images': options['images'],
+            'origami': origami,
+            'inputs': inputs,
+            'generate': generate_seconds,
+            'stages': best['stages'],
+            'total': best['total'],
+            'peak_rss': best['peak_rss'],
+            'groups_expected': expected,
+            'groups_found': best['groups'],
+            'groups_matched': matched,
+            'ok': best['groups'] == expected and matched == expected,
+        }
+
+    @staticmethod
+    def save_field(image, stem, input_format):
+        """Write a generated field in ``input_format``; returns its path."""
+        if input_format == 'rgb':
+            Image.fromarray(image).save(stem + '.png', compress_level=1)
+            return stem + '.png'
+        gray = image[..., 0]  # The generator writes the same value to every channel
+        if input_format == 'gray':
+            Image.fromarray(gray).save(stem + '.png', compress_level=1)
+            return stem + '.png'
+        gray16 = gray.astype(np.uint16) * 257
+        if input_format == 'gray16':
+            Image.fromarray(gray16).save(stem + '.png', compress_level=1)
+            return stem + '.png'
+        np.save(stem + '.npy', gray16)
+        return stem + '.npy'
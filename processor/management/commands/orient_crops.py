@@ -0,0 +1,29 @@
+import glob
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from processor.orientation import EDGE_TOLERANCE, SPOT_THRESHOLD, orient_images
+
+
+class Command(BaseCommand):
+    help = "Rotate every PNG crop in a directory so its border edge lies horizontal at the bottom."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_dir', help="Directory of group images")
+        parser.add_argument('output_dir', help="Directory for the oriented images (same file names)")
+        parser.add_argument('--threshold', type=int, default=SPOT_THRESHOLD, help="Grayscale spot threshold")
+        parser.add_argument('--tolerance', type=float, default=EDGE_TOLERANCE,
+                            help="Distance (px) of a spot from a hull edge that disqualifies the edge")
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (defaults to the CPU count)")
+
+    def handle(self, *args, **options):
+        image_paths = sorted(glob.glob(os.path.join(options['input_dir'], '*.png')))
+        start = time.perf_counter()
+        angles = orient_images(image_paths, options['output_dir'], options['workers'], options['threshold'],
+                               options['tolerance'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Oriented {sum(angle is not None for angle in angles)} of {len(angles)} images "
+            f"in {time.perf_counter() - start:.2f}s into {options['output_dir']}"
+        ))
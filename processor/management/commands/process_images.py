@@ -0,0 +1,54 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from processor.clustering import CLUSTERING_ENGINES
+from processor.crops import CROP_INDEX_FILENAME
+from processor.image_processing import process_images
+from processor.metrics import StageTimer
+
+
+class Command(BaseCommand):
+    help = "Process an image, or every image in a directory, into MEDIA_ROOT (or --output-dir) using a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_path', help="Image (PNG, TIFF, .npy or .raw) or directory of images")
+        parser.add_argument('--group-radius', type=int, default=50)
+        parser.add_argument('--min-dots', type=int, default=100)
+        parser.add_argument('--threshold', type=int, default=60)
+        parser.add_argument('--circle-color', default='green')
+        parser.add_argument('--circle-width', type=int, default=8)
+        parser.add_argument('--engine', choices=[key for key, _ in CLUSTERING_ENGINES], default='dbscan')
+        parser.add_argument('--coarse-factor', type=int, default=1)
+        parser.add_argument('--tile-memory-mb', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (defaults to the CPU count)")
+        parser.add_argument('--no-thumbnails', action='store_true', help="Skip the thumbnails used by the web pages")
+        parser.add_argument('--orient', action='store_true', help="Also orient the group images into rotated/")
+        parser.add_argument('--lazy-crops', action='store_true',
+                            help="Write only crop_index.json, the boxes the web pages cut crops from, not the crops")
+        parser.add_argument('--no-cache', action='store_true', help="Ignore and do not fill the result cache")
+        parser.add_argument('--output-dir', default=None, help="Output directory (defaults to MEDIA_ROOT)")
+        parser.add_argument('--metrics', help="Write the per-stage timings and memory peaks to this JSON file")
+
+    def handle(self, *args, **options):
+        output_dir = options['output_dir'] or settings.MEDIA_ROOT
+        start = time.perf_counter()
+        timer = StageTimer(command='process_images')
+        full_images_zip, groups_zip, _, group_images_paths = process_images(
+            options['input_path'], options['group_radius'], options['min_dots'], options['threshold'],
+            options['circle_color'], options['circle_width'], engine=options['engine'],
+            coarse_factor=options['coarse_factor'], tile_memory_mb=options['tile_memory_mb'], workers=options['workers'],
+            output_dir=output_dir, use_cache=not options['no_cache'],
+            thumbnails=not options['no_thumbnails'], orient=options['orient'],
+            lazy_crops=options['lazy_crops'], timer=timer,
+        )
+        timer.log_summary()
+        if options['metrics']:
+            with open(options['metrics'], 'w') as fh:
+                json.dump(timer.as_dict(), fh, indent=2)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(group_images_paths)} group images in {time.perf_counter() - start:.1f}s; "
+            f"{full_images_zip} and {groups_zip or CROP_INDEX_FILENAME} written to {output_dir}"
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from processor.workspaces import reap_workspaces
+
+
+class Command(BaseCommand):
+    help = "Delete old processing job workspaces by age and total size (defaults from settings)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float, default=None, help="Seconds a finished job is kept")
+        parser.add_argument('--max-bytes', type=int, default=None, help="Total size allowed for all workspaces")
+
+    def handle(self, *args, **options):
+        deleted = reap_workspaces(options['max_age'], options['max_bytes'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} job workspaces"))
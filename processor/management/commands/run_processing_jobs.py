@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from processor.jobs import run_job
+from processor.workspaces import start_reaper
+
+
+class Command(BaseCommand):
+    help = "Process queued image processing jobs (use with PROCESSOR_JOB_RUNNER = 'command')."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        if not options['once']:
+            # With this runner no web process runs jobs, so the workers reap old workspaces
+            start_reaper()
+        while True:
+            job = run_job()
+            if job is not None:
+                style = self.style.SUCCESS if job.status == job.STATUS_DONE else self.style.ERROR
+                self.stdout.write(style(f"Job {job.pk}: {job.status}"))
+                continue
+            if options['once']:
+                return
+            time.sleep(options['poll_interval'])
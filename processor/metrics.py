@@ -0,0 +1,215 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Per-stage instrumentation of processing: code wraps each stage in ``timer.stage(name)`` and
+# the timer adds up its seconds and calls and keeps the memory high-water mark of the process
+# during the stage. Stages are coarse (per image, not per group): entering one costs a write
+# and a read of /proc, so steps repeated per item are timed over the whole loop with
+# ``timer.interleaved``. On Linux the peak resident set size is reset when a stage starts
+# while no other stage runs in the process, so it is the stage's own peak (including what the
+# process held before); stages overlapping in other threads (job workers > 1) never reset each
+# other and report the peak since the first of them started. Elsewhere peaks are not reported.
+# Worker processes fill their own timers, which are returned and merged into the job's.
+# Hooks added with ``add_hook`` see every stage as it is recorded in this process.
+_hooks = []
+
+
+def add_hook(hook):
+    """Call ``hook(stage, seconds, peak_rss, labels)`` for every stage recorded from now on."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+_CLEAR_REFS = '/proc/self/clear_refs'
+_STATUS = '/proc/self/status'
+_can_reset_peak = None
+_active_stages = 0  # Stages running in this process, in any thread
+_active_lock = threading.Lock()
+
+
+def reset_peak_rss():
+    """Start a new memory high-water mark for this process; False where that is not possible."""
+    global _can_reset_peak
+    if _can_reset_peak is False:
+        return False
+    try:
+        with open(_CLEAR_REFS, 'w') as fh:
+            fh.write('5')  # Resets VmHWM to the current resident set size (Linux 4.0+)
+        _can_reset_peak = True
+    except OSError:
+        _can_reset_peak = False
+    return _can_reset_peak
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes since the last ``reset_peak_rss``, or
+    None where peaks cannot be reset (and would be the peak of the whole process lifetime)."""
+    if not _can_reset_peak:
+        return None
+    with open(_STATUS) as fh:
+        for line in fh:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+@contextmanager
+def _peak_window():
+    # The peak is reset unless another stage is running in this process, in any thread
+    global _active_stages
+    with _active_lock:
+        if not _active_stages:
+            reset_peak_rss()
+        _active_stages += 1
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_stages -= 1
+
+
+def _log_stage(stage, seconds, peak, labels):
+    context = ' '.join(f"{key}={value}" for key, value in labels.items())
+    peak_mb = f"{peak / 1024 ** 2:.0f} MB" if peak is not None else 'n/a'
+    logger.debug("%s %s: %.3fs, peak RSS %s", context, stage, seconds, peak_mb)
+
+
+add_hook(_log_stage)
+
+
+class StageTimer:
+    """Seconds, calls and memory high-water mark of named stages, and counters.
+
+    ``labels`` (e.g. the job or image) are passed to the hooks. A timer created with
+    ``report=False`` does not call hooks itself; its stages reach them when it is merged.
+    Timers are picklable so worker processes can return theirs.
+    """
+
+    def __init__(self, report=True, **labels):
+        self.report = report
+        self.labels = labels
+        self.stages = {}
+        self.counts = {}
+        self.items = []  # Merged timers, e.g. one per image
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    @contextmanager
+    def stage(self, name):
+        with _peak_window():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add(name, time.perf_counter() - start)
+
+    @contextmanager
+    def interleaved(self, calls=1):
+        """Time stages that alternate within one block, such as the steps of a loop over items.
+
+        The block adds seconds to the yielded ``Counter`` by stage name; each stage is recorded
+        once when the block ends, with ``calls`` calls and the memory peak of the whole block.
+        """
+        seconds = Counter()
+        with _peak_window():
+            try:
+                yield seconds
+            finally:
+                for name, value in seconds.items():
+                    self.add(name, value, calls)
+
+    def add(self, name, seconds, calls=1, peak=None, labels=None):
+        """Record ``seconds`` spent in stage ``name``; the peak defaults to the one since the last reset."""
+        if peak is None:
+            peak = peak_rss()
+        record = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss': None})
+        record['seconds'] += seconds
+        record['calls'] += calls
+        if peak is not None:
+            record['peak_rss'] = max(record['peak_rss'] or 0, peak)
+        if self.report:
+            for hook in _hooks:
+                hook(name, seconds, peak, dict(self.labels, **(labels or {})))
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def merge(self, other):
+        """Add the stages and counts of ``other`` to this timer and keep it as one of its items."""
+        for name, record in other.stages.items():
+            self.add(name, record['seconds'], record['calls'], record['peak_rss'], other.labels)
+        for name, n in other.counts.items():
+            self.count(name, n)
+        self.items.append(other.as_dict())
+
+    def stop(self):
+        if self.seconds is None:
+            self.seconds = time.perf_counter() - self.started
+        return self.seconds
+
+    def as_dict(self):
+        """JSON-serializable record of the timer, as stored on a job."""
+        peaks = [record['peak_rss'] for record in self.stages.values() if record['peak_rss'] is not None]
+        return {
+            'labels': self.labels,
+            'seconds': self.stop(),
+            'peak_rss': max(peaks) if peaks else None,
+            'stages': self.stages,
+            'counts': self.counts,
+            'items': self.items,
+        }
+
+    def log_summary(self, level=logging.INFO):
+        context = ' '.join(f"{key}={value}" for key, value in self.labels.items())
+        stages = ', '.join(f"{name} {record['seconds']:.2f}s" for name, record in
+                           sorted(self.stages.items(), key=lambda item: -item[1]['seconds']))
+        logger.log(level, "%s finished in %.2fs (%s)", context, self.stop(), stages or 'no stages')
+
+
+def summarize(records):
+    """Percentiles of stage times and throughput over a list of ``StageTimer.as_dict()`` records.
+
+    Stages measured per item (image) are sampled per item, the others once per record.
+    Throughput is every counter (images, dots, groups...) per second of wall time.
+    """
+    samples = {}
+    totals = {}
+    wall = 0.0
+    peaks = []
+    for record in records:
+        item_stages = set()
+        for item in record.get('items', []):
+            for name, stage in item['stages'].items():
+                samples.setdefault(name, []).append(stage['seconds'])
+                item_stages.add(name)
+        for name, stage in record['stages'].items():
+            if name not in item_stages:
+                samples.setdefault(name, []).append(stage['seconds'])
+        for name, n in record['counts'].items():
+            totals[name] = totals.get(name, 0) + n
+        wall += record['seconds']
+        if record.get('peak_rss') is not None:
+            peaks.append(record['peak_rss'])
+
+    stages = {}
+    for name, values in samples.items():
+        p50, p95 = np.percentile(values, [50, 95])
+        stages[name] = {'samples': len(values), 'p50': float(p50), 'p95': float(p95), 'total': float(sum(values))}
+    return {
+        'records': len(records),
+        'seconds': wall,
+        'peak_rss': max(peaks) if peaks else None,
+        'stages': stages,
+        'counts': totals,
+        'throughput': {f"{name}_per_second": n / wall for name, n in totals.items()} if wall else {},
+    }
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+
+import processor.workspaces
+from django.db import migrations, models
+
+
+def assign_workspaces(apps, schema_editor):
+    ProcessingJob = apps.get_model("processor", "ProcessingJob")
+    for job in ProcessingJob.objects.all():
+        job.workspace = processor.workspaces.new_workspace_id()
+        job.save(update_fields=["workspace"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0006_processingjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processingjob",
+            name="workspace",
+            field=models.CharField(
+                default=processor.workspaces.new_workspace_id,
+                editable=False,
+                max_length=32,
+                null=True,
+            ),
+        ),
+        migrations.RunPython(assign_workspaces, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="processingjob",
+            name="workspace",
+            field=models.CharField(
+                default=processor.workspaces.new_workspace_id,
+                editable=False,
+                max_length=32,
+                unique=True,
+            ),
+        ),
+    ]
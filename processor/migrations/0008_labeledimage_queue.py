@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0007_processingjob_workspace"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="labeledimage",
+            name="job",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="labeled_images",
+                to="processor.processingjob",
+            ),
+        ),
+        migrations.AddField(
+            model_name="labeledimage",
+            name="labeled_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="labeledimage",
+            name="position",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="labeledimage",
+            name="label",
+            field=models.CharField(blank=True, default="", max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name="labeledimage",
+            index=models.Index(
+                fields=["job", "label", "position"], name="labeledimage_queue_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="labeledimage",
+            constraint=models.UniqueConstraint(
+                fields=("job", "image_path"), name="unique_labeled_image_per_job"
+            ),
+        ),
+    ]
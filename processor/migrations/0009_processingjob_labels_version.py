@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0008_labeledimage_queue"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processingjob",
+            name="labels_version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
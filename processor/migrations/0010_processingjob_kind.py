@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0009_processingjob_labels_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processingjob",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("images", "Image processing"),
+                    ("origami", "Origami ratio analysis"),
+                ],
+                default="images",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0010_processingjob_kind"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processingjob",
+            name="metrics",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
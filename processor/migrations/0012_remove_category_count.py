@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:54
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0011_processingjob_metrics"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="category",
+            name="count",
+        ),
+    ]
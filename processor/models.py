@@ -1,27 +1,133 @@
-from django.db import models
+import logging
+
+from django.db import models, transaction
+from django.utils import timezone
+from .workspaces import new_workspace_id, workspace_path, workspace_url
+
+logger = logging.getLogger(__name__)
 
 class ImageUpload(models.Model):
     image = models.ImageField(upload_to='uploads/')
 
+class ProcessingJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    KIND_IMAGES = 'images'
+    KIND_ORIGAMI = 'origami'
+    KIND_CHOICES = [
+        (KIND_IMAGES, 'Image processing'),
+        (KIND_ORIGAMI, 'Origami ratio analysis'),
+    ]
+
+    upload = models.ForeignKey(ImageUpload, on_delete=models.CASCADE)
+    workspace = models.CharField(max_length=32, unique=True, default=new_workspace_id, editable=False)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=KIND_IMAGES)
+    options = models.JSONField(default=dict)  # Keyword arguments for process_images or analyze_origami
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    progress = models.FloatField(default=0)  # Percent complete
+    result = models.JSONField(null=True, blank=True)  # Context for image_result.html
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Refreshed by the process running the job
+    labels_version = models.IntegerField(default=0)  # Bumped on every label write, keys cached charts
+    metrics = models.JSONField(null=True, blank=True)  # metrics.StageTimer record of the run
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def error_summary(self):
+        """Last line of the traceback (the exception), for pages; the traceback is for the logs and admin."""
+        return self.error.strip().splitlines()[-1] if self.error.strip() else ''
+
+    def bump_labels_version(self):
+        ProcessingJob.objects.filter(pk=self.pk).update(labels_version=models.F('labels_version') + 1)
+
+    @property
+    def workspace_path(self):
+        return workspace_path(self.workspace)
+
+    @property
+    def workspace_url(self):
+        return workspace_url(self.workspace)
+
 class LabeledImage(models.Model):
+    # One row per group crop of a job, created when the job finishes; an empty label
+    # means the crop is still waiting in the labeling queue, ordered by position
+    job = models.ForeignKey(ProcessingJob, on_delete=models.CASCADE, null=True, related_name='labeled_images')
     image_path = models.CharField(max_length=255)
-    label = models.CharField(max_length=50)  # Allow for different categories
+    label = models.CharField(max_length=50, blank=True, default='')  # Allow for different categories
+    position = models.IntegerField(default=0)
+    labeled_at = models.DateTimeField(null=True, blank=True)
 
-class Category(models.Model):
-    key = models.CharField(max_length=50, unique=True, db_index=True)  # The key (e.g., "1", "2", etc.)
-    name = models.CharField(max_length=100, default='Category')  # The default name
-    count = models.IntegerField(default=0)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'image_path'], name='unique_labeled_image_per_job'),
+        ]
+        indexes = [
+            models.Index(fields=['job', 'label', 'position'], name='labeledimage_queue_idx'),
+        ]
+
+    @classmethod
+    def create_queue(cls, job, image_paths):
+        """Queue every crop of ``job`` for labeling in file name order."""
+        cls.objects.bulk_create(
+            [cls(job=job, image_path=path, position=position) for position, path in enumerate(sorted(image_paths))],
+            batch_size=500, ignore_conflicts=True,
+        )
 
     @classmethod
-    def update_category_count(cls, key, increment_by):
-        # Fetch the category object or create it if it doesn't exist
-        category, created = cls.objects.get_or_create(key=key)
-        # Increment the existing count
-        if not created:
-            category.count += increment_by
-        else:
-            category.count = increment_by  # Initialize count if created
-        # Save the updated category
-        category.save()
-        print(f"Category {key} Updated: Count - {category.count}, Name - {category.name}")
+    def reorder_queue(cls, job, image_paths):
+        """Renumber the crops of ``job`` so the queue follows ``image_paths``; others go last."""
+        rank = {path: position for position, path in enumerate(image_paths)}
+        rows = list(cls.objects.filter(job=job).only('id', 'image_path', 'position').order_by('position'))
+        for row in rows:
+            row.position = rank.get(row.image_path, len(rank) + row.position)
+        cls.objects.bulk_update(rows, ['position'], batch_size=500)
 
+    @classmethod
+    def label_counts(cls, job):
+        """Number of crops of ``job`` per label; unlabeled crops are counted under ''."""
+        return dict(cls.objects.filter(job=job).values_list('label').annotate(count=models.Count('id')).order_by())
+
+    @classmethod
+    def apply_labels(cls, job, labels):
+        """Set ``{image_path: label}`` on crops of ``job`` with one UPDATE per label change.
+
+        Each UPDATE only matches crops that still have the label read before it, so crops
+        relabeled concurrently by another request are left to that request and not counted
+        twice. Unknown images and unchanged labels are skipped. Returns ``(previous label,
+        label, image paths, crops updated)`` for every change; the previous label is '' for
+        crops that were unlabeled.
+        """
+        now = timezone.now()
+        changes = []
+        with transaction.atomic():
+            current = cls.objects.filter(job=job, image_path__in=list(labels)).values_list('image_path', 'label')
+            paths_by_change = {}
+            for path, previous in current:
+                if previous != labels[path]:
+                    paths_by_change.setdefault((previous, labels[path]), []).append(path)
+            for (previous, label), paths in paths_by_change.items():
+                updated = cls.objects.filter(job=job, image_path__in=paths, label=previous).update(
+                    label=label, labeled_at=now)
+                changes.append((previous, label, paths, updated))
+            if any(updated for *_, updated in changes):
+                job.bump_labels_version()
+        return changes
+
+class Category(models.Model):
+    # Label counts are not stored here: they are per job, from LabeledImage.label_counts
+    key = models.CharField(max_length=50, unique=True, db_index=True)  # The key (e.g., "1", "2", etc.)
+    name = models.CharField(max_length=100, default='Category')  # The default name
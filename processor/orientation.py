@@ -0,0 +1,131 @@
+import os
+
+import cv2
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+
+from .pools import process_pool
+
+# Orientation normalization of group crops, from Testing code/Bordering Test/bordering.py:
+# the spots of a crop are reduced to their centers, the longest convex hull edge with no
+# other spot near its line is taken as the structure's border, and the crop is rotated
+# so that this border is horizontal at the bottom.
+ROTATED_DIRNAME = 'rotated'
+SPOT_THRESHOLD = 200  # Grayscale level above which a pixel belongs to a spot
+EDGE_TOLERANCE = 5  # Spots closer than this (px) to a hull edge's line disqualify the edge
+
+
+def spot_centers(image, threshold=SPOT_THRESHOLD):
+    """Integer centroids of the external contours of the bright spots of a BGR image."""
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, thresholded_image = cv2.threshold(gray_image, threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(thresholded_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    moments = [cv2.moments(contour) for contour in contours]
+    centers = [[int(m['m10'] / m['m00']), int(m['m01'] / m['m00'])] for m in moments if m['m00'] != 0]
+    return np.array(centers, dtype=np.int64).reshape(-1, 2)
+
+
+def border_edge(centers, tolerance=EDGE_TOLERANCE):
+    """Indices of the longest hull edge with no other center within ``tolerance`` of its line.
+
+    Distances of every center to every edge line are computed in one broadcast. Returns
+    None when the centers have no 2D hull or no edge qualifies.
+    """
+    try:
+        hull = ConvexHull(centers)
+    except (QhullError, ValueError):
+        return None
+
+    edges = hull.simplices
+    starts = centers[edges[:, 0]]
+    directions = centers[edges[:, 1]] - starts
+    lengths = np.linalg.norm(directions, axis=1)
+
+    # |cross(end - start, start - point)| / |end - start| for every (edge, point) pair
+    offsets = starts[:, None, :] - centers[None, :, :]
+    cross = directions[:, None, 0] * offsets[:, :, 1] - directions[:, None, 1] * offsets[:, :, 0]
+    close = np.abs(cross) / lengths[:, None] < tolerance
+    rows = np.arange(len(edges))
+    close[rows, edges[:, 0]] = False
+    close[rows, edges[:, 1]] = False
+
+    valid = ~close.any(axis=1)
+    if not valid.any():
+        return None
+    return edges[valid][np.argmax(lengths[valid])]
+
+
+def orientation_matrix(centers, edge):
+    """Affine matrix rotating ``edge`` horizontal with every other center above it.
+
+    Returns ``(matrix, rotation_angle)``; the angle is counter-clockwise in degrees.
+    """
+    point1, point2 = centers[edge[0]], centers[edge[1]]
+    angle_to_horizontal = np.degrees(np.arctan2(point1[1] - point2[1], point2[0] - point1[0]))
+    rotation_angle = 180 - angle_to_horizontal if angle_to_horizontal < 0 else 360 - angle_to_horizontal
+
+    # Rotate about the midpoint of the edge
+    rotation_center = ((point1[0] + point2[0]) / 2, (point1[1] + point2[1]) / 2)
+    rotation_matrix = cv2.getRotationMatrix2D(rotation_center, rotation_angle, 1.0)
+
+    # Transform all centers at once and check which side of the rotated edge they fall on
+    rotated_centers = np.column_stack((centers, np.ones(len(centers)))) @ rotation_matrix.T
+    line_start, line_end = rotated_centers[edge[0]], rotated_centers[edge[1]]
+    a = line_end[1] - line_start[1]
+    b = line_start[0] - line_end[0]
+    c = line_end[0] * line_start[1] - line_start[0] * line_end[1]
+    below = a * rotated_centers[:, 0] + b * rotated_centers[:, 1] + c > 0
+    below[list(edge)] = False
+
+    if below.any():
+        # Flip the structure over: a single rotation by 180 degrees more, not a second warp
+        rotation_angle += 180
+        rotation_matrix = cv2.getRotationMatrix2D(rotation_center, rotation_angle, 1.0)
+    return rotation_matrix, rotation_angle
+
+
+def orient_image(image_path, output_path, threshold=SPOT_THRESHOLD, tolerance=EDGE_TOLERANCE):
+    """Write the oriented crop to ``output_path``; returns the rotation angle.
+
+    Crops whose orientation cannot be determined are written unchanged and return None.
+    """
+    image = cv2.imread(image_path)
+    centers = spot_centers(image, threshold)
+    edge = border_edge(centers, tolerance)
+    if edge is None:
+        cv2.imwrite(output_path, image)
+        return None
+
+    rotation_matrix, rotation_angle = orientation_matrix(centers, edge)
+    (h, w) = image.shape[:2]
+    rotated_image = cv2.warpAffine(image, rotation_matrix, (w, h), flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+    cv2.imwrite(output_path, rotated_image)
+    return float(rotation_angle)
+
+
+def _orient_chunk(paths, output_dir, threshold, tolerance):
+    return [orient_image(path, os.path.join(output_dir, os.path.basename(path)), threshold, tolerance)
+            for path in paths]
+
+
+def orient_images(image_paths, output_dir, workers=None, threshold=SPOT_THRESHOLD, tolerance=EDGE_TOLERANCE):
+    """Orient every crop into ``output_dir`` (same file names) over a pool of worker processes.
+
+    Crops are sent to the workers in chunks, since each one only takes milliseconds.
+    Returns the rotation angle of each crop, None where it could not be determined.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    image_paths = list(image_paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(workers, len(image_paths) // 16), 1)
+    if workers == 1:
+        return _orient_chunk(image_paths, output_dir, threshold, tolerance)
+
+    chunk_size = -(-len(image_paths) // (workers * 4))
+    chunks = [image_paths[i:i + chunk_size] for i in range(0, len(image_paths), chunk_size)]
+    with process_pool(workers) as executor:
+        results = executor.map(_orient_chunk, chunks, [output_dir] * len(chunks), [threshold] * len(chunks),
+                               [tolerance] * len(chunks))
+        return [angle for chunk in results for angle in chunk]
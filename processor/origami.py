@@ -0,0 +1,248 @@
+import csv
+import os
+from concurrent.futures import as_completed
+
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+from sklearn.cluster import DBSCAN, KMeans
+from threadpoolctl import threadpool_limits
+
+from .localizations import group_locs
+from .metrics import StageTimer
+from .pools import process_pool
+
+# Ratio analysis of picked DNA origami, from Testing code/Origami Analysis: for every group of
+# localizations, noise is dropped with DBSCAN, the k binding sites are found with KMeans, the
+# structure is rotated so the side of its minimum bounding rectangle holding the row of four
+# sites lies horizontal at the top, and the ratio is the distance of the robot from the line
+# through the two rightmost sites over that of the middle left site.
+ORIGAMI_SITES = 10
+DBSCAN_EPS = 0.25
+DBSCAN_MIN_SAMPLES = 2
+KMEANS_N_INIT = 8
+RATIO_TABLE_FILENAME = 'origami_ratios.csv'
+RATIO_FIELDS = ('group', 'localizations', 'filtered', 'ratio', 'robot_distance', 'reference_distance')
+
+
+def dbscan_filter(points, eps=DBSCAN_EPS, min_samples=DBSCAN_MIN_SAMPLES):
+    """The core points of ``points``."""
+    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
+    return points[clustering.core_sample_indices_]
+
+
+def find_clusters(points, k, init=None, n_init=KMEANS_N_INIT, random_state=0):
+    """KMeans labels of ``points`` into ``k`` sites.
+
+    ``init`` centers (e.g. the sites of the previous origami, moved onto these points) are
+    tried as one more run next to the k-means++ restarts; the run with the lowest inertia wins.
+    """
+    params = dict(n_clusters=k, tol=1e-8, max_iter=1000, random_state=random_state)
+    best = None
+    if init is not None:
+        best = KMeans(init=init, n_init=1, **params).fit(points)
+    if n_init:
+        model = KMeans(init='k-means++', n_init=n_init, **params).fit(points)
+        if best is None or model.inertia_ < best.inertia_:
+            best = model
+    return best.labels_
+
+
+def find_com(points, labels, k):
+    """Center of mass of each of the ``k`` clusters, as a ``(k, 2)`` array."""
+    counts = np.bincount(labels, minlength=k)
+    sums = np.column_stack([np.bincount(labels, weights=points[:, i], minlength=k) for i in range(2)])
+    return sums / counts[:, None]
+
+
+def minimum_bounding_rectangle(points):
+    """Corners of the minimum area rectangle around ``points``, in order."""
+    pi2 = np.pi / 2
+    hull_points = points[ConvexHull(points).vertices]
+    edges = hull_points[1:] - hull_points[:-1]
+    angles = np.arctan2(edges[:, 1], edges[:, 0])
+    angles = np.unique(np.abs(np.mod(angles, pi2)))
+
+    rotations = np.vstack([
+        np.cos(angles), np.cos(angles - pi2),
+        np.cos(angles + pi2), np.cos(angles)
+    ]).T.reshape((-1, 2, 2))
+
+    rot_points = np.dot(rotations, hull_points.T)
+    min_x = np.nanmin(rot_points[:, 0], axis=1)
+    max_x = np.nanmax(rot_points[:, 0], axis=1)
+    min_y = np.nanmin(rot_points[:, 1], axis=1)
+    max_y = np.nanmax(rot_points[:, 1], axis=1)
+
+    best_idx = np.argmin((max_x - min_x) * (max_y - min_y))
+    x1, x2 = max_x[best_idx], min_x[best_idx]
+    y1, y2 = max_y[best_idx], min_y[best_idx]
+    r = rotations[best_idx]
+    return np.array([[x1, y2], [x2, y2], [x2, y1], [x1, y1]]) @ r
+
+
+def distance_to_line(points, line_start, line_end):
+    """Distance of each of ``points`` from the line through ``line_start`` and ``line_end``."""
+    direction = line_end - line_start
+    offsets = points - line_start
+    length = np.linalg.norm(direction)
+    if length == 0:
+        return np.linalg.norm(offsets, axis=-1)
+    return np.abs(direction[0] * offsets[..., 1] - direction[1] * offsets[..., 0]) / length
+
+
+def find_closest_side(points, rectangle):
+    """Index of the rectangle side (corner ``i`` to ``i + 1``) nearest to its four closest points."""
+    distances = np.array([distance_to_line(points, rectangle[i], rectangle[(i + 1) % 4]) for i in range(4)])
+    nearest = np.sort(distances, axis=1)[:, :4]
+    return int(np.argmin(nearest.sum(axis=1)))
+
+
+def find_rotation_angle(rectangle, side):
+    """Angle (radians, counter-clockwise) that makes the given side horizontal."""
+    dx, dy = rectangle[(side + 1) % 4] - rectangle[side]
+    return -np.arctan2(dy, dx)
+
+
+def rotate_points(points, angle, pivot):
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    return (points - pivot) @ rotation.T + pivot
+
+
+def orient_sites(com, rectangle):
+    """Rotate the sites so the closest rectangle side is horizontal and above the others."""
+    side = find_closest_side(com, rectangle)
+    pivot = rectangle[side]
+    angle = find_rotation_angle(rectangle, side)
+    rotated_rect = rotate_points(rectangle, angle, pivot)
+    if rotated_rect[side, 1] < rotated_rect[:, 1].mean():
+        angle += np.pi
+    return rotate_points(com, angle, pivot)
+
+
+def find_middle_left_most_com(com):
+    """Of the three leftmost sites, the middle one vertically; None with fewer than three."""
+    if len(com) < 3:
+        return None
+    left = com[np.argsort(com[:, 0], kind='stable')[:3]]
+    return left[np.argsort(left[:, 1], kind='stable')[1]]
+
+
+def find_right_most_coms(com):
+    right = np.argsort(com[:, 0], kind='stable')[::-1][:2]
+    return com[right[0]], com[right[1]]
+
+
+def find_robot(com):
+    """The site left after removing the 3 leftmost, 2 rightmost and 4 top ones closest to the hull center."""
+    by_x = np.argsort(com[:, 0], kind='stable')
+    removed = set(by_x[:3]) | set(by_x[-2:]) | set(np.argsort(com[:, 1], kind='stable')[-4:])
+    remaining = [i for i in range(len(com)) if i not in removed]
+    if not remaining:
+        return None
+    hull_center = com[ConvexHull(com).vertices].mean(axis=0)
+    candidates = com[remaining]
+    return candidates[np.argmin(np.linalg.norm(candidates - hull_center, axis=1))]
+
+
+def origami_ratio(points, k=ORIGAMI_SITES, flipped=False, eps=DBSCAN_EPS, min_samples=DBSCAN_MIN_SAMPLES, init=None):
+    """Analyze the localizations of one origami.
+
+    Returns the row of the ratio table (without the group) and the sites centered on their
+    mean, to warm-start the next origami. The ratio is None when it cannot be measured.
+    """
+    row = dict(localizations=len(points), filtered=0, ratio=None, robot_distance=None, reference_distance=None)
+    filtered = dbscan_filter(points, eps, min_samples) if len(points) else points
+    row['filtered'] = len(filtered)
+    if len(filtered) < k:
+        return row, None
+
+    center = filtered.mean(axis=0)
+    labels = find_clusters(filtered, k, init=None if init is None else init + center)
+    com = find_com(filtered, labels, k)
+    try:
+        rotated_com = orient_sites(com, minimum_bounding_rectangle(com))
+    except (QhullError, ValueError):
+        return row, com - center
+    if flipped:
+        rotated_com = rotated_com * [-1, 1]
+
+    reference = find_middle_left_most_com(rotated_com)
+    robot = find_robot(rotated_com)
+    if reference is None or robot is None:
+        return row, com - center
+    right_most, second_right_most = find_right_most_coms(rotated_com)
+    robot_distance, reference_distance = distance_to_line(np.array([robot, reference]), right_most, second_right_most)
+    if reference_distance > 0:
+        row.update(ratio=float(robot_distance / reference_distance), robot_distance=float(robot_distance),
+                   reference_distance=float(reference_distance))
+    return row, com - center
+
+
+def _analyze_chunk(groups, k, flipped, eps, min_samples):
+    # Each worker process runs single-threaded BLAS/OpenMP so workers do not oversubscribe the CPUs
+    rows = []
+    init = None
+    with threadpool_limits(1):
+        for group, points in groups:
+            row, sites = origami_ratio(points, k, flipped, eps, min_samples, init=init)
+            if row['ratio'] is not None:
+                init = sites
+            rows.append(dict(row, group=group))
+    return rows
+
+
+def analyze_origami(path, k=ORIGAMI_SITES, flipped=False, eps=DBSCAN_EPS, min_samples=DBSCAN_MIN_SAMPLES,
+                    workers=None, progress_callback=None, timer=None):
+    """Ratio table (one dict per group, in group order) of a picked locs file.
+
+    Groups are analyzed in chunks over a pool of worker processes; within a chunk each
+    origami's KMeans is warm-started from the sites of the previous one. Reading and
+    analysis times are recorded in ``timer`` (a metrics.StageTimer) if given.
+    """
+    if timer is None:
+        timer = StageTimer()
+    with timer.stage('ingest'):
+        grouped = group_locs(path)
+        groups = [(int(group), grouped.points(group).astype(np.float64)) for group in grouped.groups]
+    timer.count('groups', len(groups))
+    timer.count('localizations', len(grouped.locs))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(workers, len(groups) // 8), 1)
+
+    chunk_size = max(-(-len(groups) // (workers * 4)), 1)
+    chunks = [groups[i:i + chunk_size] for i in range(0, len(groups), chunk_size)]
+    rows = []
+    with timer.stage('analysis'):
+        if workers == 1:
+            for i, chunk in enumerate(chunks, start=1):
+                rows.extend(_analyze_chunk(chunk, k, flipped, eps, min_samples))
+                if progress_callback:
+                    progress_callback(i / len(chunks))
+        else:
+            with process_pool(workers) as executor:
+                futures = [executor.submit(_analyze_chunk, chunk, k, flipped, eps, min_samples) for chunk in chunks]
+                for i, future in enumerate(as_completed(futures), start=1):
+                    rows.extend(future.result())
+                    if progress_callback:
+                        progress_callback(i / len(chunks))
+    rows.sort(key=lambda row: row['group'])
+    return rows
+
+
+def ratio_summary(rows):
+    """Count, mean and standard deviation of the measured ratios."""
+    ratios = np.array([row['ratio'] for row in rows if row['ratio'] is not None])
+    return {
+        'groups': len(rows),
+        'measured': len(ratios),
+        'mean': float(ratios.mean()) if len(ratios) else None,
+        'std': float(ratios.std()) if len(ratios) else None,
+    }
+
+
+def write_ratio_table(rows, path):
+    with open(path, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=RATIO_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,18 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(max_workers):
+    """A ProcessPoolExecutor that can be started from any thread.
+
+    Forking copies only the calling thread, so workers forked while other threads run (job
+    threads of the web server, heartbeats, the workspace reaper) can inherit locks those
+    threads held and hang. Pools are forked only from a single-threaded process; otherwise
+    workers start from a fork server ('spawn' where there is none).
+    """
+    if threading.active_count() == 1:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
@@ -0,0 +1,79 @@
+import numpy as np
+from PIL import Image
+
+# Crop similarity, from Testing code/Matching Test: instead of loading and comparing every crop
+# with SSIM on demand, each crop gets a compact descriptor when it is cut (a small grayscale
+# thumbnail, zero-mean and unit-norm), stored as one row of a matrix in the job workspace. The
+# dot product of two descriptors is their normalized cross-correlation, so ranking all crops
+# against a reference is a single matrix-vector product over the memory-mapped matrix.
+DESCRIPTOR_SIZE = 32
+DESCRIPTORS_FILENAME = 'descriptors.npy'
+
+
+def crop_descriptor(image, size=DESCRIPTOR_SIZE):
+    """Descriptor of a PIL image as a flat float32 vector of ``size * size`` values."""
+    # Like the notebook, crops are squashed to a square; area averaging keeps it anti-aliased
+    thumbnail = image.convert('L').resize((size, size), Image.BOX)
+    descriptor = np.asarray(thumbnail, dtype=np.float32).ravel()
+    descriptor -= descriptor.mean()
+    norm = np.linalg.norm(descriptor)
+    return descriptor / norm if norm else descriptor
+
+
+def write_descriptors(path, descriptors):
+    """Write a sequence of descriptors as the rows of a ``.npy`` matrix at ``path``."""
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                       shape=(len(descriptors), DESCRIPTOR_SIZE * DESCRIPTOR_SIZE))
+    for row, descriptor in enumerate(descriptors):
+        matrix[row] = descriptor
+    matrix.flush()
+    del matrix
+
+
+def load_descriptors(path):
+    """The descriptor matrix at ``path``, memory-mapped read-only."""
+    return np.load(path, mmap_mode='r')
+
+
+def rank_by_similarity(descriptors, reference):
+    """Row indices of ``descriptors`` from most to least similar to ``reference``, and all scores.
+
+    Scores are correlations in [-1, 1].
+    """
+    scores = descriptors @ reference
+    return np.argsort(-scores, kind='stable'), scores
+
+
+def category_centroids(descriptors, labels, min_examples=1):
+    """Unit-norm mean descriptor of every label with at least ``min_examples`` rows.
+
+    ``labels`` has one entry per descriptor row, '' for unlabeled rows. Returns the label
+    names, their number of rows and the ``(categories, features)`` centroid matrix.
+    """
+    labels = np.asarray(labels)
+    labeled = np.flatnonzero(labels != '')
+    names, inverse, counts = np.unique(labels[labeled], return_inverse=True, return_counts=True)
+    keep = counts >= min_examples
+    if not keep.any():
+        return [], [], np.empty((0, descriptors.shape[1]), dtype=np.float32)
+
+    # Rows sorted by label are summed per label with one reduceat
+    order = np.argsort(inverse, kind='stable')
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    sums = np.add.reduceat(np.asarray(descriptors[labeled[order]], dtype=np.float64), starts, axis=0)[keep]
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    centroids = (sums / np.where(norms > 0, norms, 1)).astype(np.float32)
+    return [str(name) for name in names[keep]], counts[keep].tolist(), centroids
+
+
+def nearest_centroid(descriptors, centroids):
+    """Index of the closest centroid for every descriptor row, and the confidence of each.
+
+    The confidence is the margin between the best and the second best correlation (the best
+    one alone when there is a single centroid), so it is high only for unambiguous rows.
+    """
+    scores = descriptors @ centroids.T
+    if centroids.shape[0] == 1:
+        return np.zeros(len(scores), dtype=np.int64), scores[:, 0]
+    top_two = np.partition(scores, -2, axis=1)[:, -2:]
+    return np.argmax(scores, axis=1), top_two[:, 1] - top_two[:, 0]
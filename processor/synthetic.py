@@ -0,0 +1,60 @@
+import numpy as np
+
+# Synthetic DNA-PAINT fields for benchmarks: origami are clusters of bright round spots placed
+# one per cell of a jittered grid, so neighbouring origami never merge and the number of
+# groups processing must find is known. The background is dim uniform noise plus isolated
+# hot pixels, both of which clustering has to reject.
+SPOT_RADIUS = 3
+ORIGAMI_EXTENT = (60, 30)  # Width and height (px) of the box the spots of one origami fall in
+MIN_SEPARATION = 250  # Grid cell side (px); keeps origami well beyond the default group radius
+BAND_ROWS = 1024  # Rows of background noise generated at a time
+
+
+def _disk_offsets(radius):
+    ys, xs = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    inside = xs ** 2 + ys ** 2 <= radius ** 2
+    return xs[inside], ys[inside]
+
+
+def synthetic_field(width, height, origami, dots_per_origami=10, noise=20, hot_pixels=1e-5,
+                    spot_radius=SPOT_RADIUS, separation=MIN_SEPARATION, seed=0):
+    """Generate an RGB field of ``origami`` structures.
+
+    Returns the ``(height, width, 3)`` uint8 image and the ``(origami, 2)`` integer x, y
+    centers of the structures. ``noise`` is the maximum background level and ``hot_pixels``
+    the fraction of pixels set to full brightness at random. Raises ValueError if the
+    structures do not fit at the given separation.
+    """
+    rng = np.random.default_rng(seed)
+    columns, rows = width // separation, height // separation
+    if origami > columns * rows:
+        raise ValueError(f"{origami} origami do not fit in {width}x{height} at {separation} px separation "
+                         f"(at most {columns * rows})")
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    for top in range(0, height, BAND_ROWS):
+        bottom = min(top + BAND_ROWS, height)
+        image[top:bottom] = rng.integers(0, noise + 1, size=(bottom - top, width, 1), dtype=np.uint8)
+
+    hot = rng.integers(0, width * height, size=int(width * height * hot_pixels))
+    image.reshape(-1, 3)[hot] = 255
+
+    # One origami per chosen cell, jittered so structures do not sit on a lattice
+    cells = rng.choice(columns * rows, size=origami, replace=False)
+    extent_x, extent_y = ORIGAMI_EXTENT
+    slack = (separation - 2 * max(extent_x, extent_y)) // 4
+    jitter = rng.integers(-slack, slack + 1, size=(origami, 2)) if slack > 0 else np.zeros((origami, 2), dtype=int)
+    centers = np.column_stack(((cells % columns) * separation + separation // 2,
+                               (cells // columns) * separation + separation // 2)) + jitter
+
+    # Spots of every origami stamped at once
+    spots = centers.repeat(dots_per_origami, axis=0) + np.column_stack((
+        rng.integers(-extent_x // 2, extent_x // 2 + 1, size=origami * dots_per_origami),
+        rng.integers(-extent_y // 2, extent_y // 2 + 1, size=origami * dots_per_origami),
+    ))
+    offset_x, offset_y = _disk_offsets(spot_radius)
+    xs = np.clip(spots[:, :1] + offset_x, 0, width - 1).ravel()
+    ys = np.clip(spots[:, 1:] + offset_y, 0, height - 1).ravel()
+    brightness = rng.integers(200, 256, size=len(spots), dtype=np.uint8).repeat(len(offset_x))
+    image[ys, xs] = brightness[:, None]
+    return image, centers
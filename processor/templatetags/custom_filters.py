@@ -11,9 +11,16 @@ def replace_media_path(value):
     return value
 
 from django import template
+from processor.derivatives import derivative_path
 
 register = template.Library()
 
 @register.filter(name='get_item')
 def get_item(dictionary, key):
     return dictionary.get(str(key), 0)
+
+
+@register.filter(name='derivative')
+def derivative(path, width):
+    """Path of the ``width`` pixels wide thumbnail of an output image."""
+    return derivative_path(path, int(width))
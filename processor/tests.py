@@ -1,3 +1,914 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from unittest import mock, skipIf
+from zipfile import ZipFile
 
-# Create your tests here.
+import cv2
+import h5py
+import numpy as np
+from django.core.management import call_command
+from django.db.models.query import QuerySet
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from sklearn.cluster import DBSCAN
+
+from . import archives
+from .archives import append_to_archive, build_archive, category_archive_path, stream_zip
+from .clustering import candidate_dots, cluster_bands, cluster_dots, grid_dbscan
+from .crops import LRUCache, crop_bytes, crop_file, load_crop_index
+from .derivatives import derivative_path
+from .image_processing import _read_bands, extract_groups, process_images
+from .inputs import InputImage, open_input
+from .jobs import STALE_JOB_ERROR, claim_job, fail_stale_jobs
+from .localizations import group_locs, read_locs
+from .metrics import StageTimer
+from .models import Category, ImageUpload, LabeledImage, ProcessingJob
+from .orientation import border_edge, orient_image, orient_images, orientation_matrix, spot_centers
+from .pools import process_pool
+from .similarity import (DESCRIPTOR_SIZE, DESCRIPTORS_FILENAME, category_centroids, crop_descriptor, load_descriptors,
+                         nearest_centroid, rank_by_similarity, write_descriptors)
+from .synthetic import synthetic_field
+from .views import _save_labels
+from .workspaces import reap_workspaces
+
+# Small deterministic fields and files guarding what the fast paths promise to keep exact.
+GROUP_RADIUS = 50
+MIN_DOTS = 100
+THRESHOLD = 60
+
+
+def _field(seed=0):
+    image, _ = synthetic_field(1024, 1024, 10, seed=seed)
+    return InputImage(image=Image.fromarray(image))
+
+
+def _sizeable_groups(dot_coordinates, labels):
+    """Size and bounding box of the groups of at least MIN_DOTS dots, as sorted tuples."""
+    groups = extract_groups(dot_coordinates, labels)
+    groups = groups[groups['size'] >= MIN_DOTS]
+    return sorted(tuple(row)[1:] for row in groups.tolist())
+
+
+class ClusteringTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.input_image = _field()
+        cls.dots = np.concatenate([dots for _, _, dots in cls.input_image.dots(THRESHOLD)])
+        cls.reference = cluster_dots(cls.dots, GROUP_RADIUS, engine='dbscan')
+
+    def test_field_has_groups_and_noise(self):
+        self.assertEqual(len(_sizeable_groups(self.dots, self.reference)), 10)
+        self.assertTrue((self.reference == -1).any())
+
+    def test_grid_matches_dbscan(self):
+        labels = cluster_dots(self.dots, GROUP_RADIUS, engine='grid')
+        np.testing.assert_array_equal(labels, self.reference)
+
+    def test_grid_core_points_match_dbscan(self):
+        rng = np.random.default_rng(0)
+        # Sparse and dense cells, integer and fractional coordinates
+        for points, eps, min_samples in ((rng.integers(0, 200, size=(3000, 2)), 5, 6),
+                                         (rng.random((2000, 2)) * 100, 3.5, 4),
+                                         (rng.integers(0, 50, size=(500, 2)), 1, 1)):
+            with self.subTest(eps=eps, min_samples=min_samples):
+                db = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
+                labels, core = grid_dbscan(points, eps, min_samples, return_core=True)
+                np.testing.assert_array_equal(labels, db.labels_)
+                np.testing.assert_array_equal(np.flatnonzero(core), db.core_sample_indices_)
+
+    def test_no_dots(self):
+        labels, core = cluster_dots(np.empty((0, 2), dtype=np.intp), GROUP_RADIUS, engine='grid', return_core=True)
+        self.assertEqual((labels.size, core.size), (0, 0))
+
+    def test_coarse_candidates_keep_every_group(self):
+        # Candidates drop the groups smaller than min_dots, so labels are renumbered
+        for factor in (2, 4, 16):
+            with self.subTest(factor=factor):
+                dots = candidate_dots(self.input_image.mask(THRESHOLD), GROUP_RADIUS, MIN_DOTS, factor)
+                self.assertLess(len(dots), len(self.dots))
+                np.testing.assert_array_equal(np.lexsort((dots[:, 0], dots[:, 1])), np.arange(len(dots)))
+                labels = cluster_dots(dots, GROUP_RADIUS, engine='dbscan')
+                self.assertEqual(_sizeable_groups(dots, labels), _sizeable_groups(self.dots, self.reference))
+
+    def test_tiled_matches_dbscan(self):
+        for engine in ('dbscan', 'grid'):
+            with self.subTest(engine=engine):
+                # About a hundred rows per band, so groups straddle band edges
+                bands = _read_bands(self.input_image, THRESHOLD, GROUP_RADIUS, 1024 * 1024)
+                dots, labels = cluster_bands(bands, GROUP_RADIUS, engine=engine)
+                np.testing.assert_array_equal(dots, self.dots)
+                np.testing.assert_array_equal(labels, self.reference)
+
+    def test_tiled_without_dots(self):
+        bands = [(0, 100, np.empty((0, 2), dtype=np.intp)), (100, 200, np.empty((0, 2), dtype=np.intp))]
+        dots, labels = cluster_bands(bands, GROUP_RADIUS)
+        self.assertEqual((len(dots), len(labels)), (0, 0))
+
+
+class LabelTestCase(TestCase):
+    """Jobs with queued crops, their workspaces in a temporary MEDIA_ROOT."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.paths = [f"group_{index}.png" for index in range(6)]
+        self.job = self.create_job()
+
+    def create_job(self):
+        job = ProcessingJob.objects.create(upload=ImageUpload.objects.create(image='uploads/field.png'))
+        os.makedirs(job.workspace_path)
+        LabeledImage.create_queue(job, self.paths)
+        return job
+
+
+class JobTests(TestCase):
+    def create_job(self, status=ProcessingJob.STATUS_RUNNING, age=0, heartbeat_age=None):
+        job = ProcessingJob.objects.create(upload=ImageUpload.objects.create(image='uploads/field.png'))
+        now = timezone.now()
+        ProcessingJob.objects.filter(pk=job.pk).update(
+            status=status, started_at=now - datetime.timedelta(seconds=age),
+            heartbeat_at=None if heartbeat_age is None else now - datetime.timedelta(seconds=heartbeat_age))
+        return job
+
+    def status(self, job):
+        return ProcessingJob.objects.get(pk=job.pk).status
+
+    @override_settings(PROCESSOR_JOB_STALE_AFTER=60)
+    def test_jobs_without_a_recent_heartbeat_are_failed(self):
+        stale = self.create_job(age=3600, heartbeat_age=120)
+        never_beat = self.create_job(age=120)
+        alive = self.create_job(age=3600, heartbeat_age=10)
+        queued = self.create_job(status=ProcessingJob.STATUS_QUEUED, age=3600)
+
+        self.assertEqual(fail_stale_jobs(), 2)
+        self.assertEqual(self.status(stale), ProcessingJob.STATUS_FAILED)
+        self.assertEqual(ProcessingJob.objects.get(pk=stale.pk).error, STALE_JOB_ERROR)
+        self.assertEqual(self.status(never_beat), ProcessingJob.STATUS_FAILED)
+        self.assertEqual(self.status(alive), ProcessingJob.STATUS_RUNNING)
+        self.assertEqual(self.status(queued), ProcessingJob.STATUS_QUEUED)
+
+    @override_settings(PROCESSOR_JOB_STALE_AFTER=60)
+    def test_status_view_reports_a_stale_job_as_failed(self):
+        job = self.create_job(age=3600, heartbeat_age=120)
+        response = self.client.get(reverse('job-status', args=[job.pk])).json()
+        self.assertEqual(response['status'], ProcessingJob.STATUS_FAILED)
+        self.assertTrue(response['finished'])
+        self.assertEqual(response['error'], STALE_JOB_ERROR)
+
+    def test_claim_sets_the_heartbeat(self):
+        job = self.create_job(status=ProcessingJob.STATUS_QUEUED)
+        claimed = claim_job(job.pk)
+        self.assertEqual(claimed.status, ProcessingJob.STATUS_RUNNING)
+        self.assertIsNotNone(claimed.heartbeat_at)
+
+    def test_process_pool_does_not_fork_beside_other_threads(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+        with process_pool(1) as executor:
+            self.assertNotEqual(executor._mp_context.get_start_method(), 'fork')
+            self.assertNotEqual(executor.submit(os.getpid).result(), os.getpid())
+
+
+class WorkspaceReaperTests(LabelTestCase):
+    def create_job(self, status=ProcessingJob.STATUS_DONE, age=0, size=0):
+        job = super().create_job()
+        ProcessingJob.objects.filter(pk=job.pk).update(
+            status=status, created_at=timezone.now() - datetime.timedelta(seconds=age))
+        with open(os.path.join(job.workspace_path, 'all_groups.png'), 'wb') as fh:
+            fh.write(b'\0' * size)
+        return job
+
+    def remaining(self):
+        return set(ProcessingJob.objects.values_list('pk', flat=True))
+
+    def test_old_finished_jobs_are_deleted(self):
+        old = self.create_job(age=100)
+        failed = self.create_job(ProcessingJob.STATUS_FAILED, age=100)
+        running = self.create_job(ProcessingJob.STATUS_RUNNING, age=100)
+        queued = self.create_job(ProcessingJob.STATUS_QUEUED, age=100)
+        self.assertEqual(reap_workspaces(max_age=50), 2)
+        self.assertEqual(self.remaining(), {self.job.pk, running.pk, queued.pk})
+        self.assertFalse(os.path.exists(old.workspace_path))
+        self.assertFalse(os.path.exists(failed.workspace_path))
+        self.assertTrue(os.path.exists(running.workspace_path))
+        self.assertFalse(ImageUpload.objects.filter(pk=old.upload_id).exists())
+
+    def test_oldest_jobs_go_first_beyond_the_size_limit(self):
+        oldest = self.create_job(age=30, size=1000)
+        older = self.create_job(age=20, size=1000)
+        newer = self.create_job(age=10, size=1000)
+        self.assertEqual(reap_workspaces(max_bytes=2500), 1)
+        self.assertEqual(self.remaining(), {self.job.pk, older.pk, newer.pk})
+        self.assertEqual(reap_workspaces(max_bytes=1500), 1)
+        self.assertEqual(self.remaining(), {self.job.pk, newer.pk})
+        self.assertFalse(os.path.exists(oldest.workspace_path))
+
+    def test_orphaned_workspaces_are_deleted_by_age(self):
+        root = os.path.dirname(self.job.workspace_path)
+        old, recent = os.path.join(root, 'old'), os.path.join(root, 'recent')
+        os.makedirs(old)
+        os.makedirs(recent)
+        os.utime(old, (time.time() - 100, time.time() - 100))
+        reap_workspaces(max_age=50)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(self.job.workspace_path))
+
+    def test_job_workers_run_the_reaper(self):
+        class Stop(Exception):
+            pass
+
+        with mock.patch('processor.management.commands.run_processing_jobs.start_reaper') as start_reaper, \
+                mock.patch('processor.management.commands.run_processing_jobs.time.sleep', side_effect=Stop):
+            call_command('run_processing_jobs', '--once', stdout=io.StringIO())
+            start_reaper.assert_not_called()
+            with self.assertRaises(Stop):
+                call_command('run_processing_jobs', stdout=io.StringIO())
+            start_reaper.assert_called_once()
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.makedirs(os.path.join(self.tmp, 'input'))
+        for seed in (1, 2):
+            image, _ = synthetic_field(1024, 1024, 10, seed=seed)
+            Image.fromarray(image).save(os.path.join(self.tmp, 'input', f'field_{seed}.png'))
+        self.image_path = os.path.join(self.tmp, 'input', 'field_1.png')
+        settings_override = override_settings(PROCESSOR_CACHE_DIR=os.path.join(self.tmp, 'cache'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def run_images(self, name, input_path=None, **options):
+        output_dir = os.path.join(self.tmp, name)
+        process_images(input_path or self.image_path, GROUP_RADIUS, MIN_DOTS, THRESHOLD, output_dir=output_dir,
+                       workers=1, **options)
+        return output_dir
+
+    def assertSameOutputs(self, first, second):
+        files = {}
+        for output_dir in (first, second):
+            contents = {}
+            for root, _, names in os.walk(output_dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    relative = os.path.relpath(path, output_dir)
+                    if name.endswith('.zip'):
+                        # Archive headers carry file times, so the members are compared
+                        with ZipFile(path) as zip_file:
+                            contents[relative] = {member: zip_file.read(member) for member in zip_file.namelist()}
+                    else:
+                        with open(path, 'rb') as fh:
+                            contents[relative] = fh.read()
+            files[output_dir] = contents
+        self.assertTrue(files[first])
+        self.assertEqual(sorted(files[first]), sorted(files[second]))
+        for relative, content in files[first].items():
+            self.assertEqual(content, files[second][relative], relative)
+
+    def test_repeated_run_is_linked_without_decoding(self):
+        uncached = self.run_images('uncached', use_cache=False)
+        self.run_images('first')
+        with mock.patch('processor.image_processing.open_input') as open_input, \
+                mock.patch('processor.image_processing._find_groups') as find_groups:
+            cached = self.run_images('cached')
+        open_input.assert_not_called()
+        find_groups.assert_not_called()
+        self.assertSameOutputs(uncached, cached)
+
+    def test_repeated_batch_matches_uncached(self):
+        input_dir = os.path.join(self.tmp, 'input')
+        uncached = self.run_images('uncached', input_dir, use_cache=False)
+        self.run_images('first', input_dir)
+        with mock.patch('processor.image_processing.open_input') as open_input:
+            cached = self.run_images('cached', input_dir)
+        open_input.assert_not_called()
+        self.assertSameOutputs(uncached, cached)
+
+    def test_repeated_lazy_run_matches_uncached(self):
+        uncached = self.run_images('uncached', use_cache=False, lazy_crops=True)
+        self.run_images('first', lazy_crops=True)
+        cached = self.run_images('cached', lazy_crops=True)
+        self.assertSameOutputs(uncached, cached)
+
+    def test_other_rendering_reuses_the_groups(self):
+        self.run_images('first')
+        uncached = self.run_images('uncached', use_cache=False, circle_color='red')
+        with mock.patch('processor.image_processing._find_groups') as find_groups:
+            cached = self.run_images('cached', circle_color='red')
+        find_groups.assert_not_called()
+        self.assertSameOutputs(uncached, cached)
+
+    def test_missing_files_fall_back_to_processing(self):
+        uncached = self.run_images('uncached', use_cache=False)
+        self.run_images('first')
+        (entry,) = os.listdir(os.path.join(self.tmp, 'cache'))
+        os.remove(os.path.join(self.tmp, 'cache', entry, '0.png'))
+        cached = self.run_images('cached')
+        self.assertSameOutputs(uncached, cached)
+
+
+class StreamZipTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        rng = np.random.default_rng(0)
+        self.contents = {'small.png': b'small', 'large.png': rng.bytes(1024 * 1024), 'empty.png': b''}
+        for name, content in self.contents.items():
+            with open(os.path.join(self.tmp, name), 'wb') as fh:
+                fh.write(content)
+
+    def members(self, names):
+        return [(os.path.join(self.tmp, name), f"crops/{name}") for name in names]
+
+    def test_archive_holds_every_member(self):
+        data = b''.join(stream_zip(self.members(self.contents)))
+        with ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual({name: zip_file.read(f"crops/{name}") for name in self.contents}, self.contents)
+
+    def test_missing_files_are_skipped(self):
+        data = b''.join(stream_zip(self.members(['small.png', 'missing.png'])))
+        with ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['crops/small.png'])
+
+    def test_chunks_are_bounded(self):
+        chunk_size = 16 * 1024
+        chunks = list(stream_zip(self.members(['large.png']), chunk_size=chunk_size))
+        self.assertGreater(len(chunks), len(self.contents['large.png']) // chunk_size)
+        # A chunk of the file, plus at most the member's headers
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), chunk_size + 512)
+
+
+def _append_members(archive_path, directory, names):
+    return append_to_archive(archive_path, [(os.path.join(directory, name), name) for name in names])
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.archive_path = os.path.join(self.tmp, 'category_1_images.zip')
+        for index in range(40):
+            with open(os.path.join(self.tmp, f"crop_{index}.png"), 'wb') as fh:
+                fh.write(bytes([index]) * (index + 1))
+
+    def member(self, index):
+        return os.path.join(self.tmp, f"crop_{index}.png"), f"crop_{index}.png"
+
+    def contents(self):
+        with ZipFile(self.archive_path) as zip_file:
+            return {name: zip_file.read(name) for name in zip_file.namelist()}
+
+    def test_append_needs_an_archive(self):
+        self.assertFalse(append_to_archive(self.archive_path, [self.member(0)]))
+        self.assertFalse(os.path.exists(self.archive_path))
+
+    def test_append_adds_missing_members_in_one_pass(self):
+        build_archive(self.archive_path, [self.member(0), (os.path.join(self.tmp, 'missing.png'), 'missing.png')])
+        written = []
+
+        def lazy(index):
+            written.append(index)
+            return self.member(index)[0]
+
+        members = [(lambda: lazy(0), 'crop_0.png'), (lambda: lazy(1), 'crop_1.png'), self.member(2),
+                   (lambda: lazy(1), 'crop_1.png')]
+        with mock.patch('processor.archives.shutil.copyfile', wraps=shutil.copyfile) as copyfile:
+            self.assertTrue(append_to_archive(self.archive_path, members))
+        copyfile.assert_called_once()
+        self.assertEqual(written, [1])  # Only for members that were not in the archive yet
+        self.assertEqual(self.contents(), {f"crop_{index}.png": bytes([index]) * (index + 1) for index in range(3)})
+
+        # Nothing to add leaves the archive alone
+        mtime = os.stat(self.archive_path).st_mtime_ns
+        self.assertTrue(append_to_archive(self.archive_path, [self.member(2)]))
+        self.assertEqual(os.stat(self.archive_path).st_mtime_ns, mtime)
+        self.assertEqual(os.listdir(self.tmp).count('category_1_images.zip'), 1)
+        self.assertFalse([name for name in os.listdir(self.tmp) if name.endswith('.tmp')])
+
+    def test_unreadable_archive_is_removed(self):
+        with open(self.archive_path, 'wb') as fh:
+            fh.write(b'not a zip')
+        self.assertFalse(append_to_archive(self.archive_path, [self.member(0)]))
+        self.assertFalse(os.path.exists(self.archive_path))
+
+    @skipIf(archives.fcntl is None, "archives are only locked across processes with flock")
+    def test_concurrent_appends_from_several_processes(self):
+        build_archive(self.archive_path, [])
+        with ProcessPoolExecutor(max_workers=4, mp_context=get_context('fork')) as executor:
+            results = list(executor.map(_append_members, [self.archive_path] * 4, [self.tmp] * 4,
+                                        [[f"crop_{index}.png" for index in range(worker, 40, 4)] for worker in range(4)]))
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(sorted(self.contents()), sorted(f"crop_{index}.png" for index in range(40)))
+
+
+class LabelCountsTests(LabelTestCase):
+    def test_counts_are_per_job(self):
+        other_job = self.create_job()
+        self.assertEqual(_save_labels(self.job, {'group_0.png': '1', 'group_1.png': '1', 'group_2.png': '2'}), 3)
+        self.assertEqual(_save_labels(other_job, {'group_0.png': '1', 'group_1.png': '1', 'group_2.png': '1'}), 3)
+        self.assertEqual(_save_labels(self.job, {'group_1.png': '2'}), 1)
+        self.assertEqual(LabeledImage.label_counts(self.job), {'1': 1, '2': 2, '': 3})
+        self.assertEqual(LabeledImage.label_counts(other_job), {'1': 3, '': 3})
+        self.assertFalse(Category.objects.exists())  # Labels write no shared counter rows
+
+
+class ApplyLabelsTests(LabelTestCase):
+    def labels_version(self):
+        self.job.refresh_from_db()
+        return self.job.labels_version
+
+    def test_changes_are_grouped_by_previous_label(self):
+        changes = LabeledImage.apply_labels(self.job, {'group_0.png': '1', 'group_1.png': '1', 'group_2.png': '2',
+                                                       'missing.png': '1'})
+        self.assertEqual(sorted(changes), [('', '1', ['group_0.png', 'group_1.png'], 2), ('', '2', ['group_2.png'], 1)])
+        self.assertEqual(LabeledImage.label_counts(self.job), {'1': 2, '2': 1, '': 3})
+        self.assertEqual(self.labels_version(), 1)
+
+        changes = LabeledImage.apply_labels(self.job, {'group_0.png': '1', 'group_1.png': '2'})
+        self.assertEqual(changes, [('1', '2', ['group_1.png'], 1)])
+        self.assertEqual(LabeledImage.label_counts(self.job), {'1': 1, '2': 2, '': 3})
+        self.assertEqual(self.labels_version(), 2)
+
+    def test_unchanged_labels_are_skipped(self):
+        LabeledImage.apply_labels(self.job, {'group_0.png': '1'})
+        self.assertEqual(LabeledImage.apply_labels(self.job, {'group_0.png': '1', 'missing.png': '2'}), [])
+        self.assertEqual(self.labels_version(), 1)
+
+    def test_crops_relabeled_concurrently_are_not_counted(self):
+        LabeledImage.apply_labels(self.job, {'group_0.png': '2'})
+        # Another request labeled the crop between this one's read and its update
+        with mock.patch.object(QuerySet, 'values_list', return_value=[('group_0.png', '')]):
+            changes = LabeledImage.apply_labels(self.job, {'group_0.png': '1'})
+        self.assertEqual(changes, [('', '1', ['group_0.png'], 0)])
+        self.assertEqual(LabeledImage.label_counts(self.job), {'2': 1, '': 5})
+        self.assertEqual(self.labels_version(), 1)
+
+    def test_archives_follow_labels(self):
+        workspace = self.job.workspace_path
+        for index, path in enumerate(self.paths):
+            Image.new('RGB', (4, 4), (index, 0, 0)).save(os.path.join(workspace, path))
+        build_archive(category_archive_path(workspace, '1'), [])
+        build_archive(category_archive_path(workspace, '2'), [])
+
+        with mock.patch('processor.views.append_to_archive', wraps=append_to_archive) as append:
+            self.assertEqual(_save_labels(self.job, {path: '1' for path in self.paths[:4]}), 4)
+        append.assert_called_once()  # One pass for the whole request
+        with ZipFile(category_archive_path(workspace, '1')) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), self.paths[:4])
+
+        # Relabelling drops both archives involved; they are rebuilt on download
+        self.assertEqual(_save_labels(self.job, {'group_0.png': '2'}), 1)
+        self.assertFalse(os.path.exists(category_archive_path(workspace, '1')))
+        self.assertFalse(os.path.exists(category_archive_path(workspace, '2')))
+
+
+# Spot centers of a synthetic structure, with a distinct longest border
+SPOTS = np.array([[20, 30], [80, 60], [40, 90], [70, 20], [50, 50]])
+
+
+def _spot_crop(centers, size=120):
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    for x, y in centers:
+        cv2.circle(image, (int(x), int(y)), 3, (255, 255, 255), -1)
+    return image
+
+
+class OrientationTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_spot_centers(self):
+        centers = spot_centers(_spot_crop(SPOTS))
+        self.assertEqual(sorted(map(tuple, centers.tolist())), sorted(map(tuple, SPOTS.tolist())))
+
+    def test_border_edge_is_the_longest_clear_hull_edge(self):
+        # The bottom edge is longest but has a spot on its line
+        centers = np.array([[0, 0], [100, 0], [100, 40], [0, 40], [50, 1]])
+        self.assertEqual(sorted(border_edge(centers).tolist()), [2, 3])
+        self.assertIsNone(border_edge(np.array([[0, 0], [10, 10], [20, 20]])))
+
+    def test_border_is_rotated_horizontal_with_the_spots_on_one_side(self):
+        edge = border_edge(SPOTS)
+        matrix, _ = orientation_matrix(SPOTS, edge)
+        rotated = np.column_stack((SPOTS, np.ones(len(SPOTS)))) @ matrix.T
+        self.assertAlmostEqual(rotated[edge[0], 1], rotated[edge[1], 1])
+        others = np.delete(rotated[:, 1], edge) - rotated[edge[0], 1]
+        self.assertTrue((others > 0).all() or (others < 0).all())
+
+    def test_orient_image(self):
+        input_path = os.path.join(self.tmp, 'group_0.png')
+        blank_path = os.path.join(self.tmp, 'group_1.png')
+        cv2.imwrite(input_path, _spot_crop(SPOTS))
+        cv2.imwrite(blank_path, _spot_crop([]))
+        output_dir = os.path.join(self.tmp, 'rotated')
+        os.makedirs(output_dir)
+
+        angle = orient_image(input_path, os.path.join(output_dir, 'group_0.png'))
+        _, expected_angle = orientation_matrix(SPOTS, border_edge(SPOTS))
+        self.assertAlmostEqual(angle, expected_angle)
+        self.assertEqual(cv2.imread(os.path.join(output_dir, 'group_0.png')).shape, (120, 120, 3))
+        # Crops without a border are copied unchanged
+        self.assertIsNone(orient_image(blank_path, os.path.join(output_dir, 'group_1.png')))
+        self.assertTrue((cv2.imread(os.path.join(output_dir, 'group_1.png')) == 0).all())
+
+    def test_workers_give_the_same_angles(self):
+        rng = np.random.default_rng(0)
+        paths = []
+        for index in range(40):
+            path = os.path.join(self.tmp, f"group_{index}.png")
+            cv2.imwrite(path, _spot_crop(rng.integers(10, 110, size=(6, 2))))
+            paths.append(path)
+        serial = orient_images(paths, os.path.join(self.tmp, 'serial'), workers=1)
+        parallel = orient_images(paths, os.path.join(self.tmp, 'parallel'), workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, 'parallel'))),
+                         sorted(os.path.basename(path) for path in paths))
+
+
+def collect_group_data(hdf5_file, dataset_name):
+    """The analysis notebook's grouping (Origami_Analysis.ipynb), kept as the reference."""
+    group_data_list = []
+
+    with h5py.File(hdf5_file, 'r') as f:
+        dataset = f[dataset_name]
+        group_data = dataset['group'][:]
+        x_data = dataset['x'][:]
+        y_data = dataset['y'][:]
+
+        unique_groups = np.unique(group_data)
+
+        for group in unique_groups:
+            indices = np.where(group_data == group)
+            group_dict = {
+                'group': int(group),
+                'x': x_data[indices].tolist(),
+                'y': y_data[indices].tolist()
+            }
+            group_data_list.append(group_dict)
+
+    return group_data_list
+
+
+class GroupLocsTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        rng = np.random.default_rng(0)
+        locs = np.empty(5000, dtype=[('frame', 'u4'), ('x', 'f4'), ('y', 'f4'), ('group', 'i4')])
+        locs['frame'] = np.arange(len(locs))
+        locs['x'] = rng.random(len(locs)) * 100
+        locs['y'] = rng.random(len(locs)) * 100
+        # Unsorted ids with gaps, and a smaller id only showing up late in the file
+        locs['group'] = rng.choice([3, 7, 8, 20, 1000], size=len(locs))
+        locs['group'][-10:] = -4
+        self.path = os.path.join(tmp, 'picked_locs.hdf5')
+        with h5py.File(self.path, 'w') as f:
+            f.create_dataset('locs', data=locs)
+
+    def test_same_partition_as_notebook(self):
+        reference = collect_group_data(self.path, 'locs')
+        for chunk_rows in (7, 1000, 1 << 20):
+            with self.subTest(chunk_rows=chunk_rows):
+                grouped = group_locs(self.path, chunk_rows=chunk_rows)
+                self.assertEqual([group for group, _ in grouped], [entry['group'] for entry in reference])
+                for entry in reference:
+                    rows = grouped[entry['group']]
+                    self.assertEqual(rows['x'].tolist(), entry['x'])
+                    self.assertEqual(rows['y'].tolist(), entry['y'])
+
+    def test_points_and_fields(self):
+        grouped = group_locs(self.path, fields=('x', 'y', 'frame'), chunk_rows=100)
+        self.assertEqual(len(grouped), 6)
+        points = grouped.points(7)
+        self.assertEqual(points.shape, (len(grouped[7]), 2))
+        np.testing.assert_array_equal(points[:, 0], grouped[7]['x'])
+        self.assertTrue(np.all(np.diff(grouped[7]['frame'].astype(np.int64)) > 0))  # File order within a group
+
+    def test_read_locs(self):
+        with h5py.File(self.path, 'r') as f:
+            expected = f['locs'][:]
+        locs = read_locs(self.path, fields=('x', 'group'), chunk_rows=333)
+        self.assertEqual(locs.dtype.names, ('x', 'group'))
+        np.testing.assert_array_equal(locs['x'], expected['x'])
+        np.testing.assert_array_equal(locs['group'], expected['group'])
+
+
+def _bar_crop(vertical, seed):
+    """A noisy crop of a horizontal or vertical bar."""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 40, size=(40, 40)).astype(np.uint8)
+    if vertical:
+        pixels[:, 16:24] += 200
+    else:
+        pixels[16:24, :] += 200
+    return Image.fromarray(pixels)
+
+
+class DescriptorTestCase(LabelTestCase):
+    """A job whose even crops are horizontal bars and odd crops vertical bars."""
+
+    def setUp(self):
+        super().setUp()
+        crops = [_bar_crop(index % 2, index) for index in range(len(self.paths))]
+        for path, crop in zip(self.paths, crops):
+            crop.save(os.path.join(self.job.workspace_path, path))
+        write_descriptors(os.path.join(self.job.workspace_path, DESCRIPTORS_FILENAME),
+                          [crop_descriptor(crop) for crop in crops])
+        self.job.status = ProcessingJob.STATUS_DONE
+        self.job.result = {'group_images_paths': self.paths}
+        self.job.save()
+        session = self.client.session
+        session['job_id'] = self.job.pk
+        session.save()
+
+    def queue(self):
+        return list(self.job.labeled_images.order_by('position').values_list('image_path', flat=True))
+
+
+class SimilarityTests(DescriptorTestCase):
+    def test_crop_descriptor_ignores_brightness_and_contrast(self):
+        crop = _bar_crop(False, 0)
+        descriptor = crop_descriptor(crop)
+        self.assertEqual(descriptor.shape, (DESCRIPTOR_SIZE * DESCRIPTOR_SIZE,))
+        self.assertAlmostEqual(float(np.linalg.norm(descriptor)), 1, places=5)
+        brighter = Image.fromarray((np.asarray(crop) // 2 + 20).astype(np.uint8))
+        self.assertGreater(float(descriptor @ crop_descriptor(brighter)), 0.99)
+        self.assertFalse(crop_descriptor(Image.new('L', (40, 40), 100)).any())
+
+    def test_crops_like_the_reference_rank_first(self):
+        descriptors = load_descriptors(os.path.join(self.job.workspace_path, DESCRIPTORS_FILENAME))
+        order, scores = rank_by_similarity(descriptors, descriptors[1])
+        self.assertEqual(order[0], 1)
+        self.assertAlmostEqual(float(scores[1]), 1, places=5)
+        self.assertEqual(set(order[:3].tolist()), {1, 3, 5})
+
+    def test_view_reorders_the_queue(self):
+        response = self.client.post(reverse('label-similar'), {'reference': 'group_3.png'},
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['ranked'], len(self.paths))
+        self.assertEqual(response.json()['images'][0]['image'], 'group_3.png')
+        self.assertEqual(set(self.queue()[:3]), {'group_1.png', 'group_3.png', 'group_5.png'})
+
+    def test_view_ranks_an_uploaded_reference(self):
+        reference = io.BytesIO()
+        _bar_crop(False, 100).save(reference, 'PNG')
+        reference.seek(0)
+        reference.name = 'reference.png'
+        response = self.client.post(reverse('label-similar'), {'reference_image': reference})
+        self.assertRedirects(response, reverse('label-image'), fetch_redirect_response=False)
+        self.assertEqual(set(self.queue()[:3]), {'group_0.png', 'group_2.png', 'group_4.png'})
+
+    def test_view_rejects_unknown_references(self):
+        response = self.client.post(reverse('label-similar'), {'reference': 'missing.png'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SuggestionTests(DescriptorTestCase):
+    def test_category_centroids(self):
+        descriptors = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1], [0, 0, 2]], dtype=np.float32)
+        names, counts, centroids = category_centroids(descriptors, ['a', 'a', 'b', '', 'c'])
+        self.assertEqual((names, counts), (['a', 'b', 'c'], [2, 1, 1]))
+        np.testing.assert_allclose(centroids, [[2 ** -0.5, 2 ** -0.5, 0], [0, 0, 1], [0, 0, 1]], rtol=1e-6)
+
+        names, counts, centroids = category_centroids(descriptors, ['a', 'a', 'b', '', 'c'], min_examples=2)
+        self.assertEqual((names, counts, centroids.shape), (['a'], [2], (1, 3)))
+        names, _, centroids = category_centroids(descriptors, [''] * 5)
+        self.assertEqual((names, centroids.shape), ([], (0, 3)))
+
+    def test_nearest_centroid_confidence_is_the_margin(self):
+        centroids = np.array([[1, 0], [0, 1]], dtype=np.float32)
+        predicted, confidence = nearest_centroid(np.array([[0.9, 0.1], [0.2, 0.6]], dtype=np.float32), centroids)
+        self.assertEqual(predicted.tolist(), [0, 1])
+        np.testing.assert_allclose(confidence, [0.8, 0.4], rtol=1e-6)
+        # A single centroid gives its correlation
+        predicted, confidence = nearest_centroid(np.array([[0.5, 0.5]], dtype=np.float32), centroids[:1])
+        self.assertEqual((predicted.tolist(), confidence.tolist()), ([0], [0.5]))
+
+    @mock.patch('processor.views.AUTO_LABEL_MIN_EXAMPLES', 1)
+    def test_unlabeled_crops_get_the_label_of_their_kind(self):
+        LabeledImage.apply_labels(self.job, {'group_0.png': '1', 'group_1.png': '2'})
+        response = self.client.get(reverse('label-suggestions')).json()
+        self.assertEqual(response['examples'], {'1': 1, '2': 1})
+        self.assertEqual({suggestion['image']: suggestion['label'] for suggestion in response['suggestions']},
+                         {'group_2.png': '1', 'group_3.png': '2', 'group_4.png': '1', 'group_5.png': '2'})
+
+        response = self.client.post(reverse('label-suggestions'), {'min_confidence': '0'},
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['labeled'], 4)
+        self.assertEqual(LabeledImage.label_counts(self.job), {'1': 3, '2': 3})
+
+    def test_no_suggestions_without_enough_examples(self):
+        LabeledImage.apply_labels(self.job, {'group_0.png': '1', 'group_1.png': '2'})
+        response = self.client.get(reverse('label-suggestions')).json()
+        self.assertEqual(response['examples'], {})
+        self.assertEqual(response['suggestions'], [])
+
+
+class StageTimerTests(TestCase):
+    def test_overlapping_stages_do_not_reset_each_other(self):
+        timer, other = StageTimer(report=False), StageTimer(report=False)
+        with mock.patch('processor.metrics.reset_peak_rss') as reset_peak_rss:
+            with timer.stage('decode'):
+                with other.stage('overlay'):  # As another job thread would
+                    pass
+            self.assertEqual(reset_peak_rss.call_count, 1)
+            with other.stage('overlay'):
+                pass
+            self.assertEqual(reset_peak_rss.call_count, 2)
+        self.assertEqual(other.stages['overlay']['calls'], 2)
+
+    def test_interleaved_stages_are_recorded_once(self):
+        timer = StageTimer(report=False)
+        with mock.patch('processor.metrics.reset_peak_rss') as reset_peak_rss:
+            with timer.interleaved(calls=3) as seconds:
+                for _ in range(3):
+                    seconds['crops'] += 0.5
+                    seconds['atlas'] += 0.25
+        reset_peak_rss.assert_called_once()
+        self.assertEqual({name: (record['seconds'], record['calls']) for name, record in timer.stages.items()},
+                         {'crops': (1.5, 3), 'atlas': (0.75, 3)})
+
+    def test_stages_are_entered_per_image_not_per_group(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        resets = {}
+        for origami in (1, 10):
+            image, _ = synthetic_field(1024, 1024, origami)
+            image_path = os.path.join(tmp, f"field_{origami}.png")
+            Image.fromarray(image).save(image_path)
+            timer = StageTimer(report=False)
+            with mock.patch('processor.metrics.reset_peak_rss') as reset_peak_rss:
+                process_images(image_path, GROUP_RADIUS, MIN_DOTS, THRESHOLD, output_dir=os.path.join(tmp, str(origami)),
+                               workers=1, use_cache=False, timer=timer)
+            resets[origami] = reset_peak_rss.call_count
+            self.assertEqual(timer.counts['groups'], origami)
+            for stage in ('crops', 'descriptors', 'atlas'):
+                self.assertEqual(timer.stages[stage]['calls'], origami)
+        self.assertEqual(resets[1], resets[10])
+
+
+class InputTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        image, _ = synthetic_field(1024, 1024, 10, seed=3)
+        self.gray = image[..., 0]
+        self.gray16 = self.gray.astype(np.uint16) * 257
+        self.paths = {'rgb': os.path.join(self.tmp, 'rgb.png'), 'gray16': os.path.join(self.tmp, 'gray16.png'),
+                      'npy': os.path.join(self.tmp, 'field.npy'), 'raw': os.path.join(self.tmp, 'field.raw')}
+        Image.fromarray(image).save(self.paths['rgb'])
+        Image.fromarray(self.gray16).save(self.paths['gray16'])
+        np.save(self.paths['npy'], self.gray16)
+        self.gray16.astype('>u2').tofile(self.paths['raw'])
+        with open(os.path.join(self.tmp, 'field.yaml'), 'w') as fh:
+            fh.write("Byte Order: '>'\nData Type: uint16\nFrames: 1\nHeight: 1024\nWidth: 1024\n")
+
+    def test_single_channel_inputs_keep_their_pixels(self):
+        for kind in ('gray16', 'npy', 'raw'):
+            input_image = open_input(self.paths[kind])
+            self.assertEqual((input_image.channels, input_image.dtype.itemsize), (1, 2), kind)
+            np.testing.assert_array_equal(input_image.rows(0, input_image.height), self.gray16, kind)
+            # Thresholds are in the units of the data; crops are scaled to 8 bits
+            np.testing.assert_array_equal(input_image.mask(THRESHOLD * 257, band_rows=100),
+                                          self.gray > THRESHOLD, kind)
+            crop = input_image.crop((10, 20, 110, 70))
+            self.assertEqual((crop.mode, crop.size), ('L', (100, 50)), kind)
+        self.assertIsInstance(open_input(self.paths['npy']).array, np.memmap)
+        self.assertIsInstance(open_input(self.paths['raw']).array, np.memmap)
+
+    def test_unreadable_arrays_are_rejected(self):
+        np.save(os.path.join(self.tmp, 'stack.npy'), np.zeros((2, 4, 4), dtype=np.uint16))
+        with self.assertRaises(ValueError):
+            open_input(os.path.join(self.tmp, 'stack.npy'))
+        os.remove(os.path.join(self.tmp, 'field.yaml'))
+        with self.assertRaises(ValueError):
+            open_input(self.paths['raw'])
+
+    def test_every_format_finds_the_same_groups(self):
+        results = {}
+        for kind, path in self.paths.items():
+            threshold = THRESHOLD if kind == 'rgb' else THRESHOLD * 257
+            _, _, _, group_images_paths = process_images(path, GROUP_RADIUS, MIN_DOTS, threshold, workers=1,
+                                                         output_dir=os.path.join(self.tmp, kind), use_cache=False)
+            with open(os.path.join(self.tmp, kind, DESCRIPTORS_FILENAME), 'rb') as fh:
+                results[kind] = (group_images_paths, np.load(fh).round(4).tolist())
+        self.assertEqual(len(results['rgb'][0]), 10)
+        for kind in ('gray16', 'npy', 'raw'):
+            self.assertEqual(results[kind], results['rgb'], kind)
+
+
+class LRUCacheTests(TestCase):
+    def test_least_recently_used_values_are_evicted(self):
+        cache = LRUCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (b'1234', None, b'1234'))
+        self.assertEqual(cache.size, 8)
+        # Values larger than the cache are not kept
+        cache.put('d', b'x' * 11)
+        self.assertIsNone(cache.get('d'))
+        cache.put('a', b'12')
+        self.assertEqual(cache.size, 6)
+
+
+class LazyCropTests(LabelTestCase):
+    def setUp(self):
+        super().setUp()
+        image, _ = synthetic_field(1024, 1024, 10, seed=4)
+        image_path = os.path.join(self.media_root, 'field.png')
+        Image.fromarray(image).save(image_path)
+        self.eager_dir = os.path.join(self.media_root, 'eager')
+        _, _, _, self.names = process_images(image_path, GROUP_RADIUS, MIN_DOTS, THRESHOLD, workers=1,
+                                             output_dir=self.eager_dir, use_cache=False)
+        process_images(image_path, GROUP_RADIUS, MIN_DOTS, THRESHOLD, workers=1,
+                       output_dir=self.job.workspace_path, use_cache=False, lazy_crops=True)
+        self.job.status = ProcessingJob.STATUS_DONE
+        self.job.result = {'group_images_paths': self.names, 'lazy_crops': True}
+        self.job.save()
+
+    def assertSamePixels(self, data, name):
+        with Image.open(io.BytesIO(data)) as crop, Image.open(os.path.join(self.eager_dir, name)) as expected:
+            np.testing.assert_array_equal(np.asarray(crop), np.asarray(expected))
+
+    def test_crops_are_indexed_not_written(self):
+        workspace = self.job.workspace_path
+        self.assertEqual(len(self.names), 10)
+        self.assertEqual(sorted(load_crop_index(workspace)['crops']), sorted(self.names))
+        self.assertFalse(any(os.path.exists(os.path.join(workspace, name)) for name in self.names))
+        for name in self.names:
+            self.assertSamePixels(crop_bytes(workspace, name), name)
+
+    def test_crop_file_writes_the_crop_once(self):
+        workspace = self.job.workspace_path
+        path = crop_file(workspace, self.names[0])
+        self.assertEqual(path, os.path.join(workspace, self.names[0]))
+        with open(path, 'rb') as fh:
+            self.assertSamePixels(fh.read(), self.names[0])
+        self.assertEqual(crop_file(workspace, 'missing.png'), os.path.join(workspace, 'missing.png'))
+        self.assertFalse(os.path.exists(os.path.join(workspace, 'missing.png')))
+
+    def test_crop_view(self):
+        response = self.client.get(reverse('job-crop', args=[self.job.pk, self.names[0]]))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertSamePixels(response.content, self.names[0])
+        thumbnail = self.client.get(reverse('job-crop', args=[self.job.pk, self.names[0]]), {'width': 160})
+        with Image.open(io.BytesIO(thumbnail.content)) as image:
+            self.assertLessEqual(image.width, 160)
+        # Only names in the index are served
+        for name in ('missing.png', '..%2Fcrop_index.json', 'crop_index.json'):
+            self.assertEqual(self.client.get(reverse('job-crop', args=[self.job.pk, name])).status_code, 404, name)
+
+    def test_crops_zip_view(self):
+        response = self.client.get(reverse('job-crops-zip', args=[self.job.pk]))
+        with ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zip_file:
+            self.assertEqual(zip_file.namelist(), self.names)
+            for name in self.names:
+                self.assertSamePixels(zip_file.read(name), name)
+
+
+class ResultPageTests(LabelTestCase):
+    def finish_job(self, **result):
+        self.job.status = ProcessingJob.STATUS_DONE
+        self.job.result = dict({'full_image_path': 'all_groups.png', 'group_images_paths': self.paths,
+                                'thumbnails': True, 'lazy_crops': False}, **result)
+        self.job.save()
+        return self.client.get(reverse('processing-job', args=[self.job.pk])).content.decode()
+
+    def test_crops_come_from_the_atlas(self):
+        image, _ = synthetic_field(1024, 1024, 3)
+        Image.fromarray(image).save(os.path.join(self.media_root, 'field.png'))
+        _, _, full_image_path, group_images_paths = process_images(
+            os.path.join(self.media_root, 'field.png'), GROUP_RADIUS, MIN_DOTS, THRESHOLD,
+            output_dir=self.job.workspace_path, workers=1, use_cache=False)
+        page = self.finish_job(full_image_path=full_image_path, group_images_paths=group_images_paths)
+        self.assertEqual(page.count('class="atlas-crop"'), len(group_images_paths))
+        for path in group_images_paths:
+            self.assertIn(f'href="{self.job.workspace_url}{path}"', page)
+
+    def test_crops_without_an_atlas_link_their_files(self):
+        page = self.finish_job()
+        for path in self.paths:
+            self.assertIn(f'<img src="{self.job.workspace_url}{path}"', page)
+            self.assertNotIn(derivative_path(path, 160), page)
@@ -1,7 +1,17 @@
 from django.urls import path
 from .views import (
     image_upload_view, 
+    origami_upload_view,
+    processing_job_view,
+    job_status_view,
+    job_crop_view,
+    job_crops_zip_view,
+    metrics_view,
     label_image_view, 
+    label_batch_view,
+    label_stats_view,
+    label_similarity_view,
+    label_suggestions_view,
     download_labeled_data_view, 
     all_labeled_view, 
     image_result_view,  
@@ -12,7 +22,17 @@ from .views import (
 
 urlpatterns = [
     path('', image_upload_view, name='image-upload'),
+    path('origami/', origami_upload_view, name='origami-upload'),
+    path('job/<int:job_id>/', processing_job_view, name='processing-job'),
+    path('job/<int:job_id>/status/', job_status_view, name='job-status'),
+    path('job/<int:job_id>/crops/<str:name>', job_crop_view, name='job-crop'),
+    path('job/<int:job_id>/crops.zip', job_crops_zip_view, name='job-crops-zip'),
+    path('metrics/', metrics_view, name='metrics'),
     path('label/', label_image_view, name='label-image'),
+    path('label/batch/', label_batch_view, name='label-batch'),
+    path('label/stats/', label_stats_view, name='label-stats'),
+    path('label/similar/', label_similarity_view, name='label-similar'),
+    path('label/suggestions/', label_suggestions_view, name='label-suggestions'),
     path('download-labeled-data/', download_labeled_data_view, name='download-labeled-data'),
     path('all-labeled/', all_labeled_view, name='all_labeled'),
     path('image-result/', image_result_view, name='image-result'),
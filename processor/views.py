@@ -1,9 +1,19 @@
+import logging
 import os
-from django.http import HttpResponse, Http404
-from django.shortcuts import render
-from .forms import ImageUploadForm, ImageProcessingOptionsForm
-from .models import ImageUpload
-from .image_processing import process_images  # Ensure this handles both single and multiple images correctly
+from django.http import FileResponse, HttpResponse, Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from .forms import ImageUploadForm, ImageProcessingOptionsForm, OrigamiAnalysisForm
+from .models import ImageUpload, ProcessingJob
+from .archives import (append_to_archive, archive_etag, build_archive, category_archive_path, remove_archive,
+                       stream_zip)
+from .atlas import load_atlas
+from .crops import crop_bytes, crop_file
+from .derivatives import DERIVATIVE_FORMAT, THUMBNAIL_WIDTHS
+from .jobs import enqueue_job, fail_stale_jobs
+from .metrics import summarize
+from .similarity import (DESCRIPTORS_FILENAME, category_centroids, crop_descriptor, load_descriptors,
+                         nearest_centroid, rank_by_similarity)
+from PIL import Image, UnidentifiedImageError
 from django.conf import settings
 from zipfile import ZipFile
 from .models import LabeledImage
@@ -14,15 +24,20 @@ from django.urls import reverse
 import shutil
 from django.core.files.storage import FileSystemStorage
 import csv
+import json
+from functools import partial
+from itertools import chain
+import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from .models import Category
 
-def image_upload_view(request):
-    clear_media_directory()
+logger = logging.getLogger(__name__)
 
+def image_upload_view(request):
     context = {
         'image_form': ImageUploadForm(),
         'options_form': ImageProcessingOptionsForm(),
@@ -33,114 +48,225 @@ def image_upload_view(request):
         options_form = ImageProcessingOptionsForm(request.POST)
         if image_form.is_valid() and options_form.is_valid():
             obj = image_form.save()
-            group_radius = options_form.cleaned_data.get('group_radius')
-            min_dots = options_form.cleaned_data.get('min_dots')
-            threshold = options_form.cleaned_data.get('threshold')
-            circle_color = options_form.cleaned_data.get('circle_color')
-            circle_width = options_form.cleaned_data.get('circle_width')
             num_categories = options_form.cleaned_data.get('num_categories')  # Capture number of categories
 
             # Store num_categories in session
             request.session['num_categories'] = num_categories
-            print(f"Stored {num_categories} categories in session.")  # Debugging
+            logger.debug("Stored %s categories in session.", num_categories)
+
+            # Processing runs in the background; the job page polls until it finishes
+            job = ProcessingJob.objects.create(upload=obj, options={
+                'group_radius': options_form.cleaned_data.get('group_radius'),
+                'min_dots': options_form.cleaned_data.get('min_dots'),
+                'threshold': options_form.cleaned_data.get('threshold'),
+                'circle_color': options_form.cleaned_data.get('circle_color'),
+                'circle_width': options_form.cleaned_data.get('circle_width'),
+                'engine': options_form.cleaned_data.get('clustering_engine'),
+                'coarse_factor': options_form.cleaned_data.get('coarse_factor'),
+                'tile_memory_mb': options_form.cleaned_data.get('tile_memory_mb'),
+                'orient': options_form.cleaned_data.get('orient_crops'),
+                'lazy_crops': options_form.cleaned_data.get('lazy_crops'),
+            })
+            enqueue_job(job)
+            request.session['job_id'] = job.pk
+
+            return redirect('processing-job', job_id=job.pk)
+
+    return render(request, 'processor/image_upload.html', context)
 
-            full_images_zip_filename, groups_zip_filename, full_image_path, group_images_paths = process_images(
-                obj.image.path, group_radius, min_dots, threshold, circle_color, circle_width
-            )
 
-            context = {
-                'full_image_path': full_image_path,
-                'group_images_paths': group_images_paths,
-                'full_images_zip': full_images_zip_filename,
-                'groups_zip': groups_zip_filename,
-            }
+def origami_upload_view(request):
+    form = OrigamiAnalysisForm(request.POST or None, request.FILES or None)
+    if request.method == 'POST' and form.is_valid():
+        # The locs file is kept like an uploaded image, so reaping a job removes it too
+        upload = ImageUpload.objects.create(image=form.cleaned_data['locs_file'])
+        job = ProcessingJob.objects.create(upload=upload, kind=ProcessingJob.KIND_ORIGAMI, options={
+            'k': form.cleaned_data['sites'],
+            'eps': form.cleaned_data['eps'],
+            'min_samples': form.cleaned_data['min_samples'],
+            'flipped': form.cleaned_data['flipped'],
+        })
+        enqueue_job(job)
+        return redirect('processing-job', job_id=job.pk)
+    return render(request, 'processor/origami_upload.html', {'form': form})
+
+
+def processing_job_view(request, job_id):
+    job = get_object_or_404(ProcessingJob, pk=job_id)
+    if job.status == ProcessingJob.STATUS_DONE and job.kind == ProcessingJob.KIND_ORIGAMI:
+        return render(request, 'processor/origami_result.html', dict(job.result, workspace_url=job.workspace_url))
+    if job.status == ProcessingJob.STATUS_DONE:
+        # Labeling and downloads work on the workspace of the job last viewed
+        request.session['job_id'] = job.pk
+        return render(request, 'processor/image_result.html',
+                      dict(job.result, workspace_url=job.workspace_url, job_id=job.pk, atlas_crops=_atlas_crops(job)))
+    return render(request, 'processor/processing_job.html', {'job': job})
+
+
+def job_status_view(request, job_id):
+    # A job whose process died stops being polled as running
+    fail_stale_jobs(job_id)
+    job = get_object_or_404(ProcessingJob, pk=job_id)
+    return JsonResponse({
+        'id': job.pk,
+        'status': job.status,
+        'progress': job.progress,
+        'finished': job.is_finished,
+        'error': job.error_summary,
+        'result_url': reverse('processing-job', args=[job.pk]),
+    })
 
-            return render(request, 'processor/image_result.html', context)
 
-    return render(request, 'processor/image_upload.html', context)
+# Crops of a job never change, so browsers may keep them
+CROP_MAX_AGE = 60 * 60 * 24 * 30
+
+
+def _crop_url(job, image_path):
+    """URL of a crop of ``job``: its file, or the crop view if crops are cut on demand."""
+    if job.result and job.result.get('lazy_crops'):
+        return reverse('job-crop', args=[job.pk, image_path])
+    return job.workspace_url + image_path
+
+
+def _atlas_crops(job, image_paths=None):
+    """Crops of ``job`` with their URL and position in the thumbnail atlas, as dicts for the
+    templates; all crops unless ``image_paths`` is given. None for jobs without an atlas."""
+    if image_paths is None:
+        image_paths = job.result.get('group_images_paths', [])
+    entries = load_atlas(job.workspace_path, image_paths)
+    if entries is None:
+        return None
+    return [
+        dict(entry or {}, path=path, url=_crop_url(job, path),
+             sheet_url=job.workspace_url + entry['sheet'] if entry else None)
+        for path, entry in zip(image_paths, entries)
+    ]
+
+
+def job_crop_view(request, job_id, name):
+    """One crop of a job processed with on-demand crops, as PNG or as a thumbnail ``width`` wide."""
+    job = get_object_or_404(ProcessingJob, pk=job_id)
+    width = request.GET.get('width')
+    if width is not None:
+        if not width.isdigit() or int(width) not in THUMBNAIL_WIDTHS:
+            return JsonResponse({'error': f"width must be one of {', '.join(map(str, THUMBNAIL_WIDTHS))}"},
+                                status=400)
+        width = int(width)
+    try:
+        data = crop_bytes(job.workspace_path, name, width)
+    except KeyError:
+        raise Http404("No such crop.")
+    response = HttpResponse(data, content_type='image/png' if width is None else f"image/{DERIVATIVE_FORMAT.lower()}")
+    patch_cache_control(response, max_age=CROP_MAX_AGE, immutable=True)
+    return response
+
+
+def job_crops_zip_view(request, job_id):
+    """Every crop of a job processed with on-demand crops, streamed as a ZIP."""
+    job = get_object_or_404(ProcessingJob, pk=job_id, status=ProcessingJob.STATUS_DONE)
+    workspace = job.workspace_path
+    # Crops are written to the workspace as the archive reaches them
+    members = ((crop_file(workspace, path), path) for path in job.result.get('group_images_paths', []))
+    response = StreamingHttpResponse(stream_zip(members), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=all_group_images.zip'
+    return response
+
+
+# Metrics aggregate at most this many of the latest jobs
+METRICS_MAX_JOBS = 1000
+
+
+def metrics_view(request):
+    """Stage time percentiles (p50/p95) and throughput of the latest finished jobs, as JSON.
+
+    ``kind`` selects image processing (the default) or origami jobs and ``jobs`` how many of
+    the latest ones are included (100 by default).
+    """
+    kind = request.GET.get('kind', ProcessingJob.KIND_IMAGES)
+    if kind not in dict(ProcessingJob.KIND_CHOICES):
+        return JsonResponse({'error': f"kind must be one of {', '.join(dict(ProcessingJob.KIND_CHOICES))}"},
+                            status=400)
+    try:
+        limit = min(int(request.GET.get('jobs', 100)), METRICS_MAX_JOBS)
+    except ValueError:
+        return JsonResponse({'error': 'jobs must be an integer'}, status=400)
+    records = list(ProcessingJob.objects.filter(kind=kind, status=ProcessingJob.STATUS_DONE, metrics__isnull=False)
+                   .order_by('-finished_at').values_list('metrics', flat=True)[:max(limit, 0)])
+    return JsonResponse(dict(summarize(records), kind=kind))
+
+
+def get_session_job(request):
+    """The processing job of this session; its workspace holds every file the views below serve."""
+    job_id = request.session.get('job_id')
+    job = ProcessingJob.objects.filter(pk=job_id).first() if job_id is not None else None
+    if job is None:
+        raise Http404("No processed images for this session.")
+    return job
 
 
 import os
 from django.conf import settings
 def label_image_view(request):
-    # Ensure the media directory exists
-    if not os.path.exists(settings.MEDIA_ROOT):
-        os.makedirs(settings.MEDIA_ROOT)
-
-    csv_file_path = os.path.join(settings.MEDIA_ROOT, 'image_labels.csv')
-
-    # Initialize the CSV file if it doesn't exist
-    if not os.path.exists(csv_file_path):
-        with open(csv_file_path, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Image', 'Label'])
+    job = get_session_job(request)
+    workspace = job.workspace_path
+    queue = job.labeled_images
 
     num_categories = request.session.get('num_categories', 1)  # Default to 1 if not set
     categories_range = range(1, int(num_categories) + 1)
 
-    images = [f for f in os.listdir(os.path.join(settings.MEDIA_ROOT)) if f.startswith('group_') and f.endswith('.png')]
-    images.sort()
-
-    # Read the CSV file to get the list of already labeled images and their counts
-    labeled_images_data = []
-    category_counts = {str(i): 0 for i in categories_range}  # Initialize category counts
-    
-    with open(csv_file_path, 'r', newline='') as file:
-        reader = csv.reader(file)
-        labeled_images_data = list(reader)[1:]  # Skipping the header row
-
-    labeled_images = [row[0] for row in labeled_images_data]  # List of already labeled images
+    # One GROUP BY gives the count of every label, unlabeled crops ('') included
+    label_counts = LabeledImage.label_counts(job)
+    if not label_counts and job.result:
+        # Jobs processed before labels lived in the database get their queue on first use
+        LabeledImage.create_queue(job, job.result.get('group_images_paths', []))
+        label_counts = LabeledImage.label_counts(job)
 
-    # Count the occurrences of each label to update the category counts
-    for row in labeled_images_data:
-        label = row[1]
-        if label in category_counts:
-            category_counts[label] += 1
-    
-    remaining_images = [img for img in images if img not in labeled_images]
-    current_image = remaining_images[0] if remaining_images else None
+    unlabeled = list(queue.filter(label='').order_by('position')[:LABEL_QUEUE_PREVIEW + 1])
+    current = unlabeled[0] if unlabeled else None
+    current_image = current.image_path if current else None
 
     if request.method == 'POST' and current_image:
-        print(f"POST data received: {request.POST}")  # Debugging
+        logger.debug("POST data received: %s", request.POST)
         
         # Get the selected label from POST data
         label = request.POST.get('label', '')
 
         if not label:
-            print("Label not found in POST data.")  # Debugging
+            logger.debug("Label not found in POST data.")
         else:
-            print(f"Label received: {label}")  # Debugging
+            logger.debug("Label received: %s", label)
 
-            # Append the label to the CSV file
-            with open(csv_file_path, 'a', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([current_image, label])
-            
-            print(f"Labeled image {current_image} with {label}")  # Debugging
+            # The label filter makes a resubmitted form a no-op instead of a relabel
+            labeled = LabeledImage.objects.filter(pk=current.pk, label='').update(label=label, labeled_at=timezone.now())
+            if labeled:
+                logger.debug("Labeled image %s with %s", current_image, label)
+                job.bump_labels_version()
 
-            # Update the category count in the dictionary
-            if label in category_counts:
-                category_counts[label] += 1
+                # Grow the category's prebuilt archive
+                append_to_archive(category_archive_path(workspace, label),
+                                  [(partial(crop_file, workspace, current_image), current_image)])
 
         # Redirect to refresh the view with the next image
         return HttpResponseRedirect(reverse('label-image'))
 
-    # Update the category counts in the database
-    for label, count in category_counts.items():
-        category_obj, created = Category.objects.get_or_create(key=label)
-        category_obj.count = count
-        category_obj.save()
-        print(f"Category {label} - Updated Count in DB: {category_obj.count}")  # Debugging
+    category_counts = {str(i): label_counts.get(str(i), 0) for i in categories_range}  # Initialize category counts
 
-    analyzed_images = len(images) - len(remaining_images)
-    total_images = len(images)
+    total_images = sum(label_counts.values())
+    remaining_images = label_counts.get('', 0)
+    analyzed_images = total_images - remaining_images
     progress = (analyzed_images / total_images) * 100 if total_images > 0 else 0
 
     context = {
     'image_path': current_image,
-    'image_url': os.path.join(settings.MEDIA_URL, current_image) if current_image else None,
-    'remaining_images': len(remaining_images),
-    'total_images': len(images),
+    'image_position': current.position if current else None,
+    'batch_size': LABEL_BATCH_SIZE if request.GET.get('batch') else None,
+    'auto_label_min_confidence': AUTO_LABEL_MIN_CONFIDENCE,
+    'image_url': _crop_url(job, current_image) if current_image else None,
+    # The next crops in the queue, drawn from the thumbnail atlas
+    'upcoming': _atlas_crops(job, [item.image_path for item in unlabeled[1:]]),
+    'queue_preview': LABEL_QUEUE_PREVIEW,
+    'remaining_images': remaining_images,
+    'total_images': total_images,
     'analyzed_images': analyzed_images,
     'progress': progress,
     'category_counts': {str(key): value for key, value in category_counts.items()},  # Ensure keys are strings
@@ -151,34 +277,225 @@ def label_image_view(request):
 
 
 
+# Crops preloaded and labels sent per request in the batch labeling mode
+LABEL_BATCH_SIZE = 20
+LABEL_BATCH_MAX = 500
+LABEL_QUEUE_PREVIEW = 8  # Upcoming crops shown under the one being labeled
+AUTO_LABEL_MIN_EXAMPLES = 10  # Labeled crops a category needs before it is predicted
+AUTO_LABEL_MIN_CONFIDENCE = 0.1
+
+
+def _label_progress(request, job):
+    num_categories = request.session.get('num_categories', 1)
+    label_counts = LabeledImage.label_counts(job)
+    total_images = sum(label_counts.values())
+    return {
+        'total': total_images,
+        'remaining': label_counts.get('', 0),
+        'category_counts': {str(i): label_counts.get(str(i), 0) for i in range(1, int(num_categories) + 1)},
+    }
+
+
+def _save_labels(job, labels):
+    """Label (or relabel) ``{image_path: label}`` crops of ``job``, keeping the category archives
+    in step; returns the number of crops changed."""
+    # Large sets (auto-labeling) are written in batches to bound the size of each query
+    items = list(labels.items())
+    changes = []
+    for start in range(0, len(items), LABEL_BATCH_MAX):
+        changes.extend(LabeledImage.apply_labels(job, dict(items[start:start + LABEL_BATCH_MAX])))
+    workspace = job.workspace_path
+    appends = {}
+    for previous_label, label, images, updated in changes:
+        if not updated:
+            continue
+        if previous_label:
+            # Relabelling invalidates both archives involved; they are rebuilt on download
+            remove_archive(category_archive_path(workspace, previous_label))
+            remove_archive(category_archive_path(workspace, label))
+        elif updated < len(images):
+            # Which crops were labeled here is unknown, so the archive is rebuilt on download
+            remove_archive(category_archive_path(workspace, label))
+        else:
+            appends.setdefault(label, []).extend(images)
+    for label, images in appends.items():
+        # Each archive is grown once for the whole request. On-demand crops are only written
+        # if the archive exists; otherwise it is built on download
+        append_to_archive(category_archive_path(workspace, label),
+                          [(partial(crop_file, workspace, image), image) for image in images])
+    return sum(updated for *_, updated in changes)
+
+
+def label_batch_view(request):
+    """JSON labeling API.
+
+    GET returns up to ``count`` unlabeled crops after queue position ``after``; POST takes
+    ``{"labels": [{"image": ..., "label": ...}, ...]}`` and labels (or relabels) them at once.
+    Both answer with the labeling progress.
+    """
+    job = get_session_job(request)
+
+    if request.method == 'POST':
+        try:
+            labels = {str(item['image']): str(item['label']) for item in json.loads(request.body)['labels']}
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': 'Expected {"labels": [{"image": ..., "label": ...}, ...]}'}, status=400)
+        if len(labels) > LABEL_BATCH_MAX:
+            return JsonResponse({'error': f"At most {LABEL_BATCH_MAX} labels per request"}, status=400)
+        if not all(0 < len(label) <= 50 for label in labels.values()):
+            return JsonResponse({'error': 'Labels must be 1 to 50 characters'}, status=400)
+
+        labeled = _save_labels(job, labels)
+        return JsonResponse(dict(_label_progress(request, job), labeled=labeled))
+
+    try:
+        after = int(request.GET.get('after', -1))
+        count = min(int(request.GET.get('count', LABEL_BATCH_SIZE)), LABEL_BATCH_MAX)
+    except ValueError:
+        return JsonResponse({'error': 'after and count must be integers'}, status=400)
+    queued = list(job.labeled_images.filter(label='', position__gt=after).order_by('position')[:count]
+                  .values_list('image_path', 'position'))
+    # Thumbnails are the crop's box on an atlas sheet, or None for jobs without an atlas
+    thumbnails = _atlas_crops(job, [image_path for image_path, _ in queued]) or [None] * len(queued)
+    images = [
+        {'image': image_path, 'url': _crop_url(job, image_path), 'position': position,
+         'thumbnail': {key: thumbnail[key] for key in ('sheet_url', 'x', 'y', 'width', 'height')}
+         if thumbnail and thumbnail['sheet_url'] else None}
+        for (image_path, position), thumbnail in zip(queued, thumbnails)
+    ]
+    return JsonResponse(dict(_label_progress(request, job), images=images))
+
+
+def label_similarity_view(request):
+    """Sort the labeling queue by similarity to a reference structure.
+
+    POST either an image file as ``reference_image`` or the name of one of the job's crops as
+    ``reference``. All crops are ranked at once against their precomputed descriptors; the
+    response is the top of the ranking as JSON if asked for, else a redirect to labeling.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a reference_image or reference'}, status=405)
+    job = get_session_job(request)
+    descriptors_path = os.path.join(job.workspace_path, DESCRIPTORS_FILENAME)
+    if not os.path.exists(descriptors_path):
+        raise Http404("This job has no similarity descriptors; process the image again.")
+    descriptors = load_descriptors(descriptors_path)
+    image_paths = job.result['group_images_paths']
+
+    if 'reference_image' in request.FILES:
+        try:
+            reference = crop_descriptor(Image.open(request.FILES['reference_image']))
+        except (UnidentifiedImageError, OSError):
+            return JsonResponse({'error': 'reference_image is not an image'}, status=400)
+    elif request.POST.get('reference') in image_paths:
+        reference = descriptors[image_paths.index(request.POST['reference'])]
+    else:
+        return JsonResponse({'error': 'POST a reference_image or the name of a crop as reference'}, status=400)
+
+    order, scores = rank_by_similarity(descriptors, reference)
+    ranked_paths = [image_paths[i] for i in order]
+    LabeledImage.reorder_queue(job, ranked_paths)
+
+    if 'application/json' in request.headers.get('Accept', ''):
+        return JsonResponse({
+            'ranked': len(ranked_paths),
+            'images': [{'image': image_paths[i], 'score': round(float(scores[i]), 4)} for i in order[:LABEL_BATCH_SIZE]],
+        })
+    return HttpResponseRedirect(reverse('label-image'))
+
+
+def _label_suggestions(job):
+    """Predict a label for every unlabeled crop of ``job`` from the crops labeled so far.
+
+    Each category with enough examples gets the mean descriptor of its crops as centroid, and
+    all unlabeled crops are matched against all centroids in one matrix product. Returns the
+    examples per category and ``(image, label, confidence)`` by decreasing confidence.
+    """
+    descriptors_path = os.path.join(job.workspace_path, DESCRIPTORS_FILENAME)
+    if not os.path.exists(descriptors_path):
+        raise Http404("This job has no similarity descriptors; process the image again.")
+    descriptors = load_descriptors(descriptors_path)
+    image_paths = job.result['group_images_paths']
+    current = dict(job.labeled_images.values_list('image_path', 'label'))
+    labels = [current.get(path, '') for path in image_paths]
+
+    names, counts, centroids = category_centroids(descriptors, labels, AUTO_LABEL_MIN_EXAMPLES)
+    unlabeled = [row for row, label in enumerate(labels) if label == '' and image_paths[row] in current]
+    if not names or not unlabeled:
+        return dict(zip(names, counts)), []
+    predicted, confidence = nearest_centroid(descriptors[unlabeled], centroids)
+    order = np.argsort(-confidence, kind='stable')
+    suggestions = [(image_paths[unlabeled[i]], names[predicted[i]], float(confidence[i])) for i in order]
+    return dict(zip(names, counts)), suggestions
+
+
+def label_suggestions_view(request):
+    """Auto-labeling by nearest centroid.
+
+    GET lists the predicted label and confidence of unlabeled crops (``min_confidence``
+    defaults to 0); POST labels every crop predicted with at least ``min_confidence``.
+    POST answers with the labeling progress as JSON if asked for, else redirects to labeling.
+    """
+    job = get_session_job(request)
+    default_confidence = AUTO_LABEL_MIN_CONFIDENCE if request.method == 'POST' else 0
+    try:
+        min_confidence = float(request.POST.get('min_confidence') or request.GET.get('min_confidence')
+                               or default_confidence)
+    except ValueError:
+        return JsonResponse({'error': 'min_confidence must be a number'}, status=400)
+    examples, suggestions = _label_suggestions(job)
+    suggestions = [suggestion for suggestion in suggestions if suggestion[2] >= min_confidence]
+
+    if request.method == 'POST':
+        labeled = _save_labels(job, {image: label for image, label, _ in suggestions})
+        if 'application/json' in request.headers.get('Accept', ''):
+            return JsonResponse(dict(_label_progress(request, job), labeled=labeled))
+        return HttpResponseRedirect(reverse('label-image'))
+
+    return JsonResponse({
+        'examples': examples,
+        'min_examples': AUTO_LABEL_MIN_EXAMPLES,
+        'suggestions': [
+            {'image': image, 'label': label, 'confidence': round(confidence, 4)}
+            for image, label, confidence in suggestions
+        ],
+    })
+
+
 def landing_page(request):
     return render(request, 'processor/landing_page.html')
 
 def download_zip(request, zip_file):
-    zip_path = os.path.join(settings.MEDIA_ROOT, zip_file)
+    zip_path = os.path.join(get_session_job(request).workspace_path, os.path.basename(zip_file))
     if os.path.exists(zip_path):
-        with open(zip_path, 'rb') as fh:
-            response = HttpResponse(fh.read(), content_type="application/zip")
-            response['Content-Disposition'] = f'attachment; filename="{os.path.basename(zip_path)}"'
-            return response
+        # FileResponse streams the archive from disk in blocks
+        return FileResponse(open(zip_path, 'rb'), as_attachment=True, filename=os.path.basename(zip_path),
+                            content_type="application/zip")
     raise Http404
 
 
+class _Echo:
+    """File-like object whose write returns the value, so csv.writer rows can be streamed."""
+
+    def write(self, value):
+        return value
+
+
 def download_labeled_data_view(request):
-    # Specify the path to the CSV file that contains the labels
-    csv_file_path = os.path.join(settings.MEDIA_ROOT, 'image_labels.csv')
-    
-    # Check if the file exists before attempting to download
-    if os.path.exists(csv_file_path):
-        with open(csv_file_path, 'rb') as file:
-            response = HttpResponse(file.read(), content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename="{os.path.basename(csv_file_path)}"'
-            return response
-    else:
-        # Handle the case where the file does not exist
+    # Labels live in the database; the CSV is only produced here as an export
+    labeled = get_session_job(request).labeled_images.exclude(label='').order_by('labeled_at', 'position')
+    if not labeled.exists():
+        # Handle the case where nothing has been labeled yet
         response = HttpResponse("No labeled data available for download.", content_type='text/plain')
         return response
 
+    writer = csv.writer(_Echo())
+    rows = labeled.values_list('image_path', 'label').iterator()
+    response = StreamingHttpResponse((writer.writerow(row) for row in chain([('Image', 'Label')], rows)),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="image_labels.csv"'
+    return response
+
 
 
 
@@ -186,8 +503,7 @@ def all_labeled_view(request):
     num_categories = request.session.get('num_categories', 1)
     categories_range = range(1, int(num_categories) + 1)
     
-    print(f"Number of categories: {num_categories}")  # Debugging
-    print(f"Categories range: {list(categories_range)}")  # Debugging
+    logger.debug("Number of categories: %s, range: %s", num_categories, list(categories_range))
     
     return render(request, 'processor/labeling_complete.html', {
         'categories_range': categories_range,
@@ -195,94 +511,54 @@ def all_labeled_view(request):
 
 
 def image_result_view(request):
+    job_id = request.session.get('job_id')
+    if job_id is not None:
+        return processing_job_view(request, job_id)
     return render(request, 'processor/image_result.html')
 
-def clear_media_directory():
-    # Path to the media directory
-    media_dir_path = settings.MEDIA_ROOT
-
-    # Remove the entire directory
-    if os.path.isdir(media_dir_path):
-        shutil.rmtree(media_dir_path)
-        
 # views.py
 
 def download_labeled_group_images_view(request):
-    csv_file_path = os.path.join(settings.MEDIA_ROOT, 'image_labels.csv')
+    job = get_session_job(request)
+    workspace = job.workspace_path
     
-    if os.path.exists(csv_file_path):
-        # Read the CSV and filter out the rows where the label is '1'
-        with open(csv_file_path, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            labeled_images = [row['Image'] for row in reader if row['Label'] == '1']
+    if job.labeled_images.exclude(label='').exists():
+        # Select the images where the label is '1'
+        labeled_images = job.labeled_images.filter(label='1').order_by('position').values_list('image_path', flat=True)
 
-        # Create a zip file with all the images labeled '1'
+        # Stream a zip of all the images labeled '1' as it is written
         zip_filename = "labeled_group_images.zip"
-        zip_file_path = os.path.join(settings.MEDIA_ROOT, zip_filename)
-        
-        with ZipFile(zip_file_path, 'w') as zip_file:
-            for image_filename in labeled_images:
-                image_path = os.path.join(settings.MEDIA_ROOT, image_filename)
-                if os.path.exists(image_path):
-                    zip_file.write(image_path, arcname=image_filename)
-        
-        # Serve the zip file
-        with open(zip_file_path, 'rb') as file:
-            response = HttpResponse(file.read(), content_type='application/zip')
-            response['Content-Disposition'] = f'attachment; filename={zip_filename}'
-            return response
+        members = ((crop_file(workspace, image_filename), image_filename) for image_filename in labeled_images)
+        response = StreamingHttpResponse(stream_zip(members), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename={zip_filename}'
+        return response
 
     raise Http404("No labeled group images available for download.")
 
 
-#method to get the number of images with label 1 vs total images and displaying the piechart
-def labeled_images_piechart(request):
-    csv_file_path = os.path.join(settings.MEDIA_ROOT, 'image_labels.csv')
-    
-    if os.path.exists(csv_file_path):
-        with open(csv_file_path, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            labeled_images = [row['Image'] for row in reader if row['Label'] == '1']
-            total_images = len([row['Image'] for row in reader])
-            remaining_images = total_images - len(labeled_images)
-            print(f"Total images: {total_images}")
-            print(f"Labeled images: {len(labeled_images)}")
-            print(f"Remaining images: {remaining_images}")
-            print("\n")
-            
-            #pie chart
-            import matplotlib.pyplot as plt
-            labels = 'Labeled Images', 'Remaining Images'
-            sizes = [len(labeled_images), remaining_images]
-            colors = ['gold', 'yellowgreen']
-            explode = (0.1, 0)  # explode 1st slice
-            plt.pie(sizes, explode=explode, labels=labels, colors=colors, autopct='%1.1f%%', shadow=True, startangle=140)
-            plt.axis('equal')
-            plt.savefig('media/pie_chart.png')
-            plt.show()
-            
-            return render(request, 'processor/piechart.html')
-    else:
-        raise Http404("No labeled group images available for download.")
-    
-
-import matplotlib.pyplot as plt
 import os
 from django.http import HttpResponse
 from io import BytesIO
+from matplotlib.figure import Figure
+from django.core.cache import cache
+from django.views.decorators.http import condition
 from .models import Category
 
-def generate_pie_chart(request):
-    # Fetch category counts from the database
-    categories = Category.objects.all()
-    category_labels = [f"Category {cat.key}" for cat in categories]
-    category_sizes = [cat.count for cat in categories]
+# Rendered charts are cached per (job, labels version, number of categories)
+CHART_CACHE_SECONDS = 60 * 60
+
+
+def _render_category_chart(category_labels, category_sizes):
+    """Pie and bar chart of the category counts as PNG bytes.
 
+    Uses a standalone Figure rather than pyplot, whose global state is not thread safe.
+    """
     # Define a new color palette with more colors
     colors = ['#ca6abd', '#55A8E6', '#ffcc5c', '#96ceb4', '#ffeead', '#ff6f69', '#88d8b0', '#2e8b57', '#d8bfd8', '#4682b4']
 
     # Creating the plot
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 10))
+    fig = Figure(figsize=(20, 10))
+    ax1, ax2 = fig.subplots(1, 2)
 
     # Pie chart for category distribution
     ax1.pie(
@@ -319,17 +595,47 @@ def generate_pie_chart(request):
     ax2.set_ylim(0, max(category_sizes) + max(category_sizes) * 0.2)
 
     # Adjusting the layout
-    plt.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.1, wspace=0.8, hspace=0.8)
+    fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.1, wspace=0.8, hspace=0.8)
     
     # Save it to a temporary buffer.
     buf = BytesIO()
-    plt.savefig(buf, format='png', transparent=True)  # Set transparent to True here
-    buf.seek(0)
+    fig.savefig(buf, format='png', transparent=True)  # Set transparent to True here
+    return buf.getvalue()
 
-    plt.close(fig)  # Close the figure after saving to buffer
 
-    # Send buffer in an HTTP response to the browser with the mime type image/png set
-    return HttpResponse(buf.getvalue(), content_type='image/png')
+def _labels_etag(request):
+    # Label writes bump labels_version, so this changes exactly when the counts do
+    job = get_session_job(request)
+    return f"{job.pk}-{job.labels_version}-{request.session.get('num_categories', 1)}"
+
+
+@condition(etag_func=_labels_etag)
+def generate_pie_chart(request):
+    cache_key = f"category-chart:{_labels_etag(request)}"
+    chart = cache.get(cache_key)
+    if chart is None:
+        # Count this session's labels per category with one GROUP BY
+        label_counts = LabeledImage.label_counts(get_session_job(request))
+        num_categories = request.session.get('num_categories', 1)
+        category_keys = [str(i) for i in range(1, int(num_categories) + 1)]
+        category_labels = [f"Category {key}" for key in category_keys]
+        category_sizes = [label_counts.get(key, 0) for key in category_keys]
+        chart = _render_category_chart(category_labels, category_sizes)
+        cache.set(cache_key, chart, CHART_CACHE_SECONDS)
+
+    # Send the PNG to the browser; no-cache makes it revalidate with the ETag
+    response = HttpResponse(chart, content_type='image/png')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@condition(etag_func=_labels_etag)
+def label_stats_view(request):
+    """Label counts as JSON, for charts drawn in the browser."""
+    job = get_session_job(request)
+    response = JsonResponse(dict(_label_progress(request, job), version=job.labels_version))
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 
@@ -338,49 +644,47 @@ from django.conf import settings
 import os
 from zipfile import ZipFile
 import csv
+import datetime
 
-def download_images_by_category_view(request, category_label):
-    print(f"Attempting to download images for category: {category_label}")  # Debugging
+def _category_archive(request, category_label):
+    """Path of the category's prebuilt archive, built from the label store if missing; None if it has no images."""
+    job = get_session_job(request)
+    workspace = job.workspace_path
+    archive_path = category_archive_path(workspace, category_label)
+    if os.path.exists(archive_path):
+        return archive_path
 
-    csv_file_path = os.path.join(settings.MEDIA_ROOT, 'image_labels.csv')
-    print(f"Looking for CSV file at: {csv_file_path}")  # Debugging
-    
-    if os.path.exists(csv_file_path):
-        print("CSV file found. Reading the file...")  # Debugging
+    logger.debug("Building %s", archive_path)
+    labeled_images = list(job.labeled_images.filter(label=str(category_label)).order_by('position')
+                          .values_list('image_path', flat=True))
+    logger.debug("Found %d images for category %s", len(labeled_images), category_label)
+    if not labeled_images:
+        return None
 
-        # Read the CSV and filter out the rows where the label matches the category
-        with open(csv_file_path, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            labeled_images = [row['Image'] for row in reader if row['Label'] == str(category_label)]
+    build_archive(archive_path, [(crop_file(workspace, image), image) for image in labeled_images])
+    return archive_path
 
-        print(f"Found {len(labeled_images)} images for category {category_label}")  # Debugging
 
-        if not labeled_images:
-            print(f"No images found for category {category_label}.")  # Debugging
-            raise Http404(f"No images found for category {category_label}.")
+def _category_archive_etag(request, category_label):
+    archive_path = _category_archive(request, category_label)
+    return archive_etag(archive_path) if archive_path else None
 
-        # Create a zip file with all the images matching the category label
-        zip_filename = f"category_{category_label}_images.zip"
-        zip_file_path = os.path.join(settings.MEDIA_ROOT, zip_filename)
-        print(f"Creating zip file at: {zip_file_path}")  # Debugging
-        
-        with ZipFile(zip_file_path, 'w') as zip_file:
-            for image_filename in labeled_images:
-                image_path = os.path.join(settings.MEDIA_ROOT, image_filename)
-                if os.path.exists(image_path):
-                    print(f"Adding image {image_filename} to zip file.")  # Debugging
-                    zip_file.write(image_path, arcname=image_filename)
-                else:
-                    print(f"Image {image_filename} not found at {image_path}. Skipping...")  # Debugging
-        
-        print("Zip file creation complete.")  # Debugging
 
-        # Serve the zip file
-        with open(zip_file_path, 'rb') as file:
-            response = HttpResponse(file.read(), content_type='application/zip')
-            response['Content-Disposition'] = f'attachment; filename={zip_filename}'
-            print(f"Serving zip file: {zip_filename}")  # Debugging
-            return response
+def _category_archive_last_modified(request, category_label):
+    archive_path = _category_archive(request, category_label)
+    return datetime.datetime.fromtimestamp(os.path.getmtime(archive_path), tz=datetime.timezone.utc) if archive_path else None
+
+
+@condition(etag_func=_category_archive_etag, last_modified_func=_category_archive_last_modified)
+def download_images_by_category_view(request, category_label):
+    logger.debug("Attempting to download images for category: %s", category_label)
+
+    archive_path = _category_archive(request, category_label)
+    if archive_path is None:
+        logger.debug("No images found for category %s.", category_label)
+        raise Http404(f"No images found for category {category_label}.")
 
-    print("CSV file not found or no images for the specified category.")  # Debugging
-    raise Http404(f"No images found for category {category_label}.")
\ No newline at end of file
+    # The archive is kept up to date as labels arrive, so it is served as is
+    logger.debug("Serving zip file: %s", archive_path)
+    return FileResponse(open(archive_path, 'rb'), as_attachment=True, filename=os.path.basename(archive_path),
+                        content_type='application/zip')
@@ -0,0 +1,120 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# Every processing job writes its crops, overlays, archives and labels into its own
+# directory under MEDIA_ROOT, so concurrent jobs never see or delete each other's files
+WORKSPACES_DIRNAME = 'jobs'
+
+logger = logging.getLogger(__name__)
+
+_reaper_lock = threading.Lock()
+_reaper_thread = None
+
+
+def new_workspace_id():
+    return uuid.uuid4().hex
+
+
+def workspace_path(workspace_id):
+    return os.path.join(settings.MEDIA_ROOT, WORKSPACES_DIRNAME, workspace_id)
+
+
+def workspace_url(workspace_id):
+    return f"{settings.MEDIA_URL}{WORKSPACES_DIRNAME}/{workspace_id}/"
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def delete_job(job):
+    """Remove a job's workspace, its uploaded image and the database rows."""
+    shutil.rmtree(job.workspace_path, ignore_errors=True)
+    upload = job.upload
+    upload.image.delete(save=False)
+    upload.delete()  # Cascades to the job
+
+
+def reap_workspaces(max_age=None, max_bytes=None):
+    """Delete finished jobs older than ``max_age`` seconds, then the oldest ones until all
+    workspaces together fit in ``max_bytes``. Returns the number of jobs deleted.
+
+    Defaults come from PROCESSOR_WORKSPACE_MAX_AGE and PROCESSOR_WORKSPACE_MAX_BYTES.
+    Queued and running jobs are never touched.
+    """
+    from .models import ProcessingJob
+
+    if max_age is None:
+        max_age = getattr(settings, 'PROCESSOR_WORKSPACE_MAX_AGE', None)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'PROCESSOR_WORKSPACE_MAX_BYTES', None)
+
+    now = time.time()
+    finished = list(ProcessingJob.objects.filter(
+        status__in=[ProcessingJob.STATUS_DONE, ProcessingJob.STATUS_FAILED]).select_related('upload').order_by('created_at'))
+    deleted = 0
+
+    if max_age is not None:
+        expired = [job for job in finished if now - job.created_at.timestamp() > max_age]
+        for job in expired:
+            delete_job(job)
+        deleted += len(expired)
+        finished = finished[len(expired):]
+
+    if max_bytes is not None:
+        root = os.path.join(settings.MEDIA_ROOT, WORKSPACES_DIRNAME)
+        total = directory_size(root)
+        for job in finished:
+            if total <= max_bytes:
+                break
+            total -= directory_size(job.workspace_path)
+            delete_job(job)
+            deleted += 1
+
+    # Workspaces whose job row is gone (e.g. deleted from the admin) are removed by age
+    root = os.path.join(settings.MEDIA_ROOT, WORKSPACES_DIRNAME)
+    if max_age is not None and os.path.isdir(root):
+        known = set(ProcessingJob.objects.values_list('workspace', flat=True))
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name not in known and now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+    return deleted
+
+
+def _reap_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            reap_workspaces()
+        except Exception:
+            logger.exception("Workspace reaper failed")
+        finally:
+            close_old_connections()
+
+
+def start_reaper():
+    """Start the background reaper thread of this process if it is not running yet."""
+    global _reaper_thread
+    interval = getattr(settings, 'PROCESSOR_WORKSPACE_REAP_INTERVAL', None)
+    if not interval:
+        return
+    with _reaper_lock:
+        if _reaper_thread is None or not _reaper_thread.is_alive():
+            _reaper_thread = threading.Thread(target=_reap_forever, args=(interval,), name='workspace-reaper', daemon=True)
+            _reaper_thread.start()